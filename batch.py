@@ -0,0 +1,245 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# Межпроцессный семафор лимита запросов к LLM (задается в инициализаторе воркера)
+_llm_semaphore = None
+
+
+def load_batch(path: str) -> List[Tuple[int, Any]]:
+    """
+    Читает JSONL-файл с предпочтениями
+
+    Args:
+        path: Путь к файлу
+
+    Returns:
+        List[Tuple[int, Any]]: Пары (номер строки, объект предпочтений или ошибка разбора)
+    """
+    jobs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                jobs.append((line_no, json.loads(line)))
+            except json.JSONDecodeError as e:
+                jobs.append((line_no, e))
+    return jobs
+
+
+def validate_preferences(preferences: Any) -> Optional[str]:
+    """
+    Проверяет, что объект совпадает по форме с артефактом preferences
+
+    Returns:
+        Optional[str]: Описание ошибки или None
+    """
+    if isinstance(preferences, Exception):
+        return f"Ошибка разбора JSON: {preferences}"
+    if not isinstance(preferences, dict):
+        return "Ожидается JSON-объект"
+    if not isinstance(preferences.get("concept"), dict):
+        return "Нет секции concept"
+    book_size = preferences.get("book_size")
+    if not isinstance(book_size, dict) or not isinstance(book_size.get("chapters"), int):
+        return "Нет секции book_size с числом chapters"
+    return None
+
+
+async def generate_one(line_no: int, preferences: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Создает проект и генерирует одну книгу по готовым предпочтениям
+
+    Returns:
+        Dict[str, Any]: Запись отчета о книге
+    """
+    from gorky_agent import create_agent
+    from stages.preferences import PreferencesStage
+    from utils.llm import ConcurrencyLimitedLLM
+    from utils.run_control import BudgetExceeded
+    from utils.usage import BookUsage
+
+    started = time.time()
+    entry = {"line": line_no, "project_id": None, "status": "failed", "error": None}
+    agent = None
+    try:
+        agent, storage, project, pipeline, _ = create_agent()
+        await storage.setup()
+        await project.setup()
+        agent.plugin_manager.register_plugin("storage", storage)
+        agent.plugin_manager.register_plugin("project", project)
+        if _llm_semaphore is not None:
+            agent.llm = ConcurrencyLimitedLLM(agent.llm, _llm_semaphore)
+        await agent.start()
+
+        genre = preferences["concept"].get("genre", "")
+        agent.current_project = await project.create({
+            "name": f"Пакет, строка {line_no}" + (f": {genre}" if genre else ""),
+            "description": "Книга в процессе генерации (пакетный режим)",
+            "metadata": {
+                "stage": 1,
+                "status": "new",
+                "batch_line": line_no
+            }
+        })
+        entry["project_id"] = agent.current_project.id
+
+        # Предпочтения уже есть, поэтому интерактивный этап будет пропущен
+        if not await PreferencesStage().set_artefact(agent, "preferences", preferences):
+            entry["error"] = "Не удалось сохранить предпочтения"
+            return entry
+
+        try:
+            success = await agent.generate_book()
+            entry["status"] = "done" if success else "failed"
+            if not success:
+                entry["error"] = "Пайплайн завершился с ошибкой"
+        except BudgetExceeded as e:
+            # Книгу можно продолжить в интерактивном режиме после увеличения бюджета
+            entry["status"] = "budget"
+            entry["error"] = str(e)
+        usage = BookUsage.for_book(agent.current_project.id)
+        entry["cost"] = round(usage.cost, 4)
+        await project.update(agent.current_project.id, {
+            "metadata": {
+                **agent.current_project.metadata,
+                # Как и в интерактивном режиме: первый невыполненный этап по манифесту
+                "stage": agent.first_incomplete_stage(),
+                "status": entry["status"],
+                "batch_line": line_no,
+                "usage": usage.summary()
+            }
+        })
+    except Exception as e:
+        logger.exception(f"Ошибка при генерации книги из строки {line_no}")
+        entry["error"] = str(e)
+    finally:
+        entry["duration"] = round(time.time() - started, 1)
+        if agent is not None:
+            try:
+                await agent.cleanup()
+            except Exception as e:
+                logger.error(f"Ошибка при завершении агента: {e}")
+    return entry
+
+
+async def _run_chunk(jobs: List[Tuple[int, Dict[str, Any]]], books_per_worker: int) -> List[Dict[str, Any]]:
+    """Генерирует книги одного воркера, не более books_per_worker одновременно"""
+    from utils.profiling import profiling
+
+    limit = asyncio.Semaphore(books_per_worker)
+
+    async def run(line_no, preferences):
+        async with limit:
+            return await generate_one(line_no, preferences)
+
+    # Под --profile каждый воркер пишет собственный отчет
+    async with profiling("batch-worker"):
+        return await asyncio.gather(*(run(line_no, prefs) for line_no, prefs in jobs))
+
+
+def _init_worker(semaphore) -> None:
+    """Инициализатор процесса пакетной генерации"""
+    global _llm_semaphore
+    _llm_semaphore = semaphore
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s [pid {os.getpid()}] %(levelname)s %(name)s: %(message)s")
+
+
+def _worker_main(jobs: List[Tuple[int, Dict[str, Any]]], books_per_worker: int) -> List[Dict[str, Any]]:
+    """Точка входа процесса: собственный цикл событий на группу книг"""
+    return asyncio.run(_run_chunk(jobs, books_per_worker))
+
+
+async def run_batch(path: str, workers: int = 1, books_per_worker: int = 2,
+                    llm_concurrency: int = 8, report_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Пакетная генерация книг без участия пользователя
+
+    Каждая строка файла — объект предпочтений; для нее создается проект,
+    и пайплайн запускается в пуле процессов. Одновременные запросы к LLM
+    ограничены общим для всех процессов семафором.
+
+    Args:
+        path: JSONL-файл с предпочтениями
+        workers: Количество процессов
+        books_per_worker: Количество книг, одновременно генерируемых в процессе
+        llm_concurrency: Общий лимит одновременных запросов к LLM
+        report_path: Путь к отчету (по умолчанию data/batch_report_<время>.json)
+
+    Returns:
+        Dict[str, Any]: Итоговый отчет
+    """
+    started_at = datetime.now()
+    jobs = load_batch(path)
+    entries = []
+
+    valid_jobs = []
+    for line_no, preferences in jobs:
+        error = validate_preferences(preferences)
+        if error:
+            entries.append({"line": line_no, "project_id": None, "status": "invalid", "error": error, "duration": 0})
+        else:
+            valid_jobs.append((line_no, preferences))
+
+    print(f"📦 Пакетная генерация: {len(valid_jobs)} книг, {workers} процессов, "
+          f"лимит запросов к LLM: {llm_concurrency}")
+
+    if valid_jobs:
+        workers = max(1, min(workers, len(valid_jobs)))
+        # Раскладываем книги по воркерам по кругу
+        chunks = [valid_jobs[i::workers] for i in range(workers)]
+
+        # spawn: дочерние процессы не наследуют работающий цикл событий
+        ctx = multiprocessing.get_context("spawn")
+        semaphore = ctx.BoundedSemaphore(llm_concurrency)
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                 initializer=_init_worker, initargs=(semaphore,)) as pool:
+            results = await asyncio.gather(*(
+                loop.run_in_executor(pool, _worker_main, chunk, books_per_worker)
+                for chunk in chunks
+            ), return_exceptions=True)
+
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, Exception):
+                logger.error(f"Воркер завершился с ошибкой: {result}")
+                entries.extend({"line": line_no, "project_id": None, "status": "failed",
+                                "error": f"Воркер завершился с ошибкой: {result}", "duration": 0}
+                               for line_no, _ in chunk)
+            else:
+                entries.extend(result)
+
+    entries.sort(key=lambda entry: entry["line"])
+    finished_at = datetime.now()
+    report = {
+        "source": os.path.abspath(path),
+        "started_at": started_at.isoformat(timespec="seconds"),
+        "finished_at": finished_at.isoformat(timespec="seconds"),
+        "duration": round((finished_at - started_at).total_seconds(), 1),
+        "total": len(entries),
+        "done": sum(1 for entry in entries if entry["status"] == "done"),
+        "failed": sum(1 for entry in entries if entry["status"] != "done"),
+        "cost": round(sum(entry.get("cost", 0) for entry in entries), 4),
+        "books": entries
+    }
+
+    if not report_path:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        report_path = os.path.join(DATA_DIR, f"batch_report_{started_at.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"✅ Готово: {report['done']}/{report['total']}, ошибок: {report['failed']}, потрачено: ${report['cost']:.4f}")
+    print(f"📄 Отчет: {report_path}")
+    return report
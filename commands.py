@@ -1,5 +1,10 @@
 from typing import Optional, Dict, Any
 from cognistruct.core import IOMessage
+from stages.preferences import PreferencesStage
+from utils.jobs import GenerationJob, CANCELLED, BUDGET
+from utils.manifest import BookManifest, COMPLETE
+from utils.storage import ShardedStoragePlugin, ARCHIVED
+from utils.usage import BookUsage, book_budget, cache_hit_rate
 import logging
 
 logger = logging.getLogger(__name__)
@@ -49,12 +54,71 @@ class CommandHandler:
             print(result)
             return
                 
+        # Архивирование книги и возврат из архива
+        if cmd.startswith("/archive "):
+            result = await self._archive_book(text[9:].strip())
+            print(result)
+            return
+            
+        if cmd.startswith("/restore "):
+            result = await self._restore_book(text[9:].strip())
+            print(result)
+            return
+                
+        # Перестроение поискового индекса
+        if cmd == "/reindex":
+            result = await self._reindex()
+            print(result)
+            return
+            
         # Запуск/продолжение генерации
         if cmd == "/start":
             result = await self._start_generation()
             print(result)
             return
             
+        # Бюджет текущей книги
+        if cmd == "/budget" or cmd.startswith("/budget "):
+            result = await self._set_budget(text[7:].strip())
+            print(result)
+            return
+            
+        # Состояние текущей книги
+        if cmd == "/status":
+            result = await self._get_status()
+            print(result)
+            return
+            
+        # Список фоновых задач
+        if cmd == "/jobs":
+            result = self._list_jobs()
+            print(result)
+            return
+            
+        # Отмена фоновой задачи
+        if cmd.startswith("/cancel "):
+            result = self._cancel_job(text[8:].strip())
+            print(result)
+            return
+            
+        # Пауза фоновой задачи
+        if cmd.startswith("/pause "):
+            result = self._pause_job(text[7:].strip())
+            print(result)
+            return
+            
+        # Продолжение приостановленной задачи
+        if cmd.startswith("/resume "):
+            result = self._resume_job(text[8:].strip())
+            print(result)
+            return
+            
+        # Состояние провайдеров LLM
+        if cmd == "/llm":
+            result = self._get_llm_stats()
+            print(result)
+            return
+            
         # Неизвестная команда
         print("❌ Неизвестная команда. Введите /help для просмотра списка доступных команд.")
             
@@ -66,7 +130,17 @@ class CommandHandler:
 /open <id> - открыть существующую книгу
 /list - показать список книг
 /delete <id> - удалить книгу
-/start - начать/продолжить генерацию текущей книги
+/archive <id> - перенести файл книги в архив (режим --sharded-storage)
+/restore <id> - вернуть книгу из архива
+/start - начать/продолжить генерацию текущей книги в фоне
+/status - показать состояние текущей книги
+/budget <usd|off> - задать бюджет текущей книги в долларах (без аргумента — показать)
+/jobs - показать фоновые задачи генерации
+/pause <id> - приостановить фоновую задачу перед следующим запросом к LLM
+/resume <id> - продолжить приостановленную задачу
+/cancel <id> - остановить фоновую задачу (текущий запрос к LLM будет сохранен)
+/llm - показать задержки и состояние провайдеров LLM
+/reindex - перестроить поисковый индекс по всем книгам
 /help - показать эту справку
         """
         
@@ -105,9 +179,50 @@ class CommandHandler:
         for p in projects:
             stage = p.metadata.get("stage", 1)
             status = p.metadata.get("status", "new")
+            if isinstance(self.agent.storage, ShardedStoragePlugin):
+                state = self.agent.storage.book_state(p.id)
+                if state and state["status"] == ARCHIVED:
+                    status += ", в архиве"
             result += f"- {p.id}: {p.name} (этап {stage}, статус: {status})\n"
         return result
         
+    async def _archive_book(self, project_id: str) -> str:
+        """Переносит файл книги в архив"""
+        if not isinstance(self.agent.storage, ShardedStoragePlugin):
+            return "❌ Архивирование доступно в режиме --sharded-storage"
+        try:
+            project_id = int(project_id)
+        except ValueError:
+            return "❌ Неверный ID книги"
+            
+        project = await self.agent.project.read(project_id)
+        if not project:
+            return "❌ Книга не найдена"
+        job = self.agent.jobs.running_for(project_id)
+        if job:
+            return f"❌ Книга генерируется (задача #{job.id}), сначала выполните /cancel {job.id}"
+            
+        path = await self.agent.storage.archive_book(project_id)
+        if path is None:
+            return "❌ Книга уже в архиве или хранится в общем хранилище"
+        if self.agent.current_project and self.agent.current_project.id == project_id:
+            self.agent.current_project = None
+        return f"📦 Книга '{project.name}' перенесена в архив: {path}"
+        
+    async def _restore_book(self, project_id: str) -> str:
+        """Возвращает книгу из архива"""
+        if not isinstance(self.agent.storage, ShardedStoragePlugin):
+            return "❌ Архивирование доступно в режиме --sharded-storage"
+        try:
+            project_id = int(project_id)
+        except ValueError:
+            return "❌ Неверный ID книги"
+            
+        path = await self.agent.storage.restore_book(project_id)
+        if path is None:
+            return "❌ Книги нет в архиве"
+        return f"📖 Книга {project_id} возвращена из архива, /open {project_id} откроет ее"
+        
     async def _delete_book(self, project_id: str) -> str:
         """Удаляет книгу и все связанные с ней артефакты"""
         try:
@@ -118,6 +233,10 @@ class CommandHandler:
             if not project:
                 return "❌ Книга не найдена"
                 
+            job = self.agent.jobs.running_for(project_id)
+            if job:
+                return f"❌ Книга генерируется (задача #{job.id}), сначала выполните /cancel {job.id}"
+                
             # Формируем шаблон для поиска артефактов
             book_prefix = f"book{project_id}/"
             
@@ -126,11 +245,19 @@ class CommandHandler:
                 "key_prefix": book_prefix
             })
             
-            # Удаляем все артефакты
-            deleted_count = 0
-            for artifact in artifacts:
-                await self.agent.storage.delete(artifact["key"])
-                deleted_count += 1
+            # Удаляем все артефакты: файл книги целиком или, в общем хранилище, по ключам
+            deleted_count = len(artifacts)
+            if not (isinstance(self.agent.storage, ShardedStoragePlugin)
+                    and await self.agent.storage.drop_book(project_id)):
+                for artifact in artifacts:
+                    await self.agent.storage.delete(artifact["key"])
+                
+            # Удаляем книгу из поискового индекса и ее манифест
+            self.agent.search_index.delete_book(project_id)
+            BookManifest.for_book(project_id).delete()
+            BookUsage.for_book(project_id).delete()
+            if self.agent.task_queue is not None:
+                self.agent.task_queue.delete_book(project_id)
                 
             # Удаляем сам проект
             if await self.agent.project.delete(project_id):
@@ -147,21 +274,199 @@ class CommandHandler:
             return f"❌ Ошибка при удалении: {str(e)}"
             
     async def _start_generation(self) -> str:
-        """Запускает/продолжает генерацию книги"""
-        if not self.agent.current_project:
+        """Запускает/продолжает генерацию книги в фоновой задаче"""
+        project = self.agent.current_project
+        if not project:
+            return "❌ Сначала откройте или создайте книгу"
+            
+        job = self.agent.jobs.running_for(project.id)
+        if job:
+            return f"⏳ Книга уже генерируется (задача #{job.id})"
+            
+        # У задачи своя копия агента: команды /open не меняют книгу фоновой генерации
+        book_agent = self.agent.for_project(project)
+        
+        # Опрос интерактивный, поэтому проходит до запуска фоновой задачи
+        preferences_stage = next(
+            (stage for stage in self.agent.stages if isinstance(stage, PreferencesStage)), None
+        )
+        if preferences_stage and preferences_stage.manifest_status(book_agent) != COMPLETE:
+            if not await preferences_stage.run(None, self.agent.llm, book_agent):
+                return "❌ Предпочтения не собраны, генерация не запущена"
+                
+        def run(control):
+            # Этапы проверяют паузу и остановку между запросами к LLM
+            book_agent.run_control = control
+            return self.agent.generate_book(book_agent=book_agent)
+            
+        job = self.agent.jobs.start(
+            project,
+            run,
+            on_finish=lambda job: self._finish_generation(job, book_agent)
+        )
+        return f"🚀 Генерация книги '{project.name}' запущена в фоне (задача #{job.id}). Прогресс: /jobs"
+        
+    async def _finish_generation(self, job: GenerationJob, book_agent) -> None:
+        """Сохраняет этап и статус книги после завершения фоновой задачи"""
+        # Генерация продолжится с первого невыполненного этапа по манифесту книги
+        stage = self.agent.first_incomplete_stage(book_agent)
+        done = stage > len(self.agent.stages)
+        # Метаданные заменяются целиком, поэтому сохраняем бюджет и другие поля
+        project = await self.agent.project.read(job.book_id)
+        await self.agent.project.update(job.book_id, {
+            "metadata": {
+                **(project.metadata if project else {}),
+                "stage": stage,
+                "status": "done" if done else "in_progress",
+                "usage": BookUsage.for_book(job.book_id).summary()
+            }
+        })
+        
+        if job.status == BUDGET:
+            print(f"\n💰 Задача #{job.id} остановлена: {job.error}. "
+                  f"Увеличьте бюджет (/budget) и выполните /start — генерация продолжится с этапа {stage}")
+        elif job.status == CANCELLED:
+            print(f"\n⏹ Задача #{job.id} остановлена, генерация продолжится с этапа {stage}")
+        elif job.result:
+            if done:
+                print(f"\n✨ Книга '{job.book_name}' готова! (задача #{job.id})")
+            else:
+                print(f"\n✨ Задача #{job.id} завершена, генерация продолжится с этапа {stage}")
+        else:
+            print(f"\n❌ Ошибка при генерации книги '{job.book_name}' (задача #{job.id}, этап {stage})")
+            
+    async def _get_status(self) -> str:
+        """Возвращает состояние текущей книги"""
+        project = self.agent.current_project
+        if not project:
+            return "❌ Сначала откройте или создайте книгу"
+            
+        job = self.agent.jobs.running_for(project.id)
+        if job:
+            status = f"📖 '{project.name}' (ID: {project.id}) генерируется:\n{job.describe()}"
+        else:
+            stage = self.agent.first_incomplete_stage()
+            if stage > len(self.agent.stages):
+                status = f"📖 '{project.name}' (ID: {project.id}): книга готова"
+            else:
+                stage_name = self.agent.stages[stage - 1].stage_name
+                status = f"📖 '{project.name}' (ID: {project.id}): следующий этап {stage} ({stage_name}), /start для продолжения"
+                
+        book_usage = BookUsage.for_book(project.id)
+        totals = book_usage.totals
+        budget = book_budget(project.metadata)
+        if totals["requests"]:
+            status += (f"\n🧮 Запросов к LLM: {totals['requests']}, токенов: "
+                       f"{totals['prompt_tokens']} в промптах, {totals['completion_tokens']} в ответах")
+            status += f"\n💵 Потрачено: ${book_usage.cost:.4f}" + (f" из ${budget:g}" if budget is not None else "")
+            rate = cache_hit_rate(totals)
+            if rate is not None:
+                status += f"\n♻️ Из кэша промптов: {rate:.0%} ({totals['cache_hit_tokens']} токенов)"
+            if totals.get("edits_skipped"):
+                status += f"\n🎯 Пропущено итераций редактирования (текст устоялся): {totals['edits_skipped']}"
+        return status
+        
+    async def _set_budget(self, value: str) -> str:
+        """Задает или показывает бюджет текущей книги"""
+        project = self.agent.current_project
+        if not project:
             return "❌ Сначала откройте или создайте книгу"
             
-        stage = self.agent.current_project.metadata.get("stage", 1)
-        success = await self.agent.generate_book(stage)
-        
-        if success:
-            # Обновляем статус и этап
-            stage += 1
-            await self.agent.project.update(self.agent.current_project.id, {
-                "metadata": {
-                    "stage": stage,
-                    "status": "in_progress"
-                }
+        if not value:
+            budget = book_budget(project.metadata)
+            spent = BookUsage.for_book(project.id).cost
+            if budget is None:
+                return f"💵 Бюджет не ограничен, потрачено ${spent:.4f}"
+            return f"💵 Бюджет ${budget:g}, потрачено ${spent:.4f}"
+            
+        if value.lower() == "off":
+            budget = None
+        else:
+            try:
+                budget = float(value.lstrip("$").replace(",", "."))
+            except ValueError:
+                return "❌ Укажите бюджет в долларах, например /budget 2.5"
+            if budget <= 0:
+                return "❌ Бюджет должен быть больше нуля"
+                
+        # None явно отменяет и бюджет по умолчанию из GORKY_BOOK_BUDGET
+        metadata = {**project.metadata, "budget": budget}
+        await self.agent.project.update(project.id, {"metadata": metadata})
+        project.metadata = metadata
+        return f"💵 Бюджет книги: ${budget:g}" if budget is not None else "💵 Бюджет книги не ограничен"
+        
+    def _list_jobs(self) -> str:
+        """Возвращает список фоновых задач"""
+        jobs = self.agent.jobs.list()
+        if not jobs:
+            return "📋 Фоновых задач нет"
+        return "📋 Фоновые задачи:\n" + "\n".join(job.describe() for job in jobs)
+        
+    def _find_job(self, job_id: str):
+        """Возвращает (задача, сообщение об ошибке) по ID из команды"""
+        try:
+            job = self.agent.jobs.get(int(job_id.lstrip("#")))
+        except ValueError:
+            return None, "❌ Неверный ID задачи"
+        if not job:
+            return None, "❌ Задача не найдена"
+        if not job.running:
+            return None, f"❌ Задача #{job.id} уже завершена ({job.status})"
+        return job, None
+        
+    def _cancel_job(self, job_id: str) -> str:
+        """Останавливает фоновую задачу после текущего запроса к LLM"""
+        job, error = self._find_job(job_id)
+        if error:
+            return error
+        self.agent.jobs.cancel(job.id)
+        return f"⏹ Задача #{job.id} остановится после текущего запроса, /start продолжит с этого места"
+        
+    def _pause_job(self, job_id: str) -> str:
+        """Приостанавливает фоновую задачу"""
+        job, error = self._find_job(job_id)
+        if error:
+            return error
+        self.agent.jobs.pause(job.id)
+        return f"⏸ Задача #{job.id} встанет на паузу перед следующим запросом, /resume {job.id} для продолжения"
+        
+    def _resume_job(self, job_id: str) -> str:
+        """Продолжает приостановленную задачу"""
+        job, error = self._find_job(job_id)
+        if error:
+            return error
+        self.agent.jobs.resume(job.id)
+        return f"▶️ Задача #{job.id} продолжается"
+        
+    def _get_llm_stats(self) -> str:
+        """Возвращает статистику провайдеров LLM"""
+        stats = getattr(self.agent.llm, "stats", None)
+        if not callable(stats):
+            return "❌ Статистика провайдеров недоступна"
+        result = "🧠 Провайдеры LLM:\n"
+        for name, item in stats().items():
+            health = "✅" if item["healthy"] else "⚠️"
+            latency = f"p50 {item['p50']} с, p95 {item['p95']} с" if item["p95"] is not None else "задержки еще не известны"
+            result += (f"{health} {name}: {latency}, запросов {item['requests']}, ошибок {item['failures']} "
+                       f"(таймаутов {item['timeouts']}), выиграно страховок {item['hedges_won']}\n")
+        return result
+        
+    async def _reindex(self) -> str:
+        """Перестраивает поисковый индекс по всем книгам из хранилища"""
+        projects = await self.agent.project.search({})
+        indexed = 0
+        for p in projects:
+            book_prefix = f"book{p.id}/"
+            self.agent.search_index.delete_book(p.id)
+            artifacts = await self.agent.storage.search({
+                "key_prefix": book_prefix
             })
-            return f"✨ Этап {stage-1} успешно завершен!"
-        return "❌ Произошла ошибка при генерации" 
\ No newline at end of file
+            # В выдаче могут быть несколько версий одного ключа, берем последнюю
+            keys = {artifact["key"] for artifact in artifacts}
+            for key in keys:
+                latest = await self.agent.storage.read(key)
+                if latest and self.agent.search_index.update_artifact(
+                    p.id, key[len(book_prefix):], latest.get("value")
+                ):
+                    indexed += 1
+        return f"🔎 Проиндексировано {indexed} артефактов в {len(projects)} книгах"
@@ -1,67 +1,224 @@
 import sys
 import os
 import logging
-import json
 import asyncio
+import argparse
+import copy
+import subprocess
 import threading
-import uvicorn
 from pathlib import Path
-from functools import partial
-from typing import Optional, Dict, Any
-
-from cognistruct import BaseAgent
-from cognistruct.plugins.storage.versioned.plugin import VersionedStoragePlugin
-from cognistruct.plugins.storage.project.plugin import ProjectStoragePlugin
-from cognistruct.llm import LLMRouter
-from cognistruct.utils import Config
-from cognistruct.utils.prompts import prompt_manager
-from cognistruct.utils.pipeline import StageChain
-from stages.preferences import PreferencesStage
-from stages.prompt_generation import PromptGenerationStage
-from stages.scene_generation import SceneGenerationStage
-from stages.book_assembly import BookAssemblyStage
-from stages.update_title import UpdateProjectTitleStage
-from commands import CommandHandler
-from web.server import app
+from typing import Optional
+
+from utils import DATA_DIR
+from utils.manifest import COMPLETE
+from utils.profiling import profiling
+
+# Веб-стек (uvicorn, FastAPI, web.server), cognistruct и модули этапов
+# импортируются в функциях, которые их используют: пакетные воркеры и
+# запуск без веб-интерфейса не платят за лишние импорты при старте
+# (проверка: gorky_agent.py --check-import-time)
 
 logger = logging.getLogger(__name__)
 
-# Добавляем директорию с промптами проекта
-project_prompts = os.path.join(Path(__file__).parent, "prompts")
-if os.path.exists(project_prompts):
-    prompt_manager.add_prompt_dir(project_prompts)
+# Директория с промптами проекта (регистрируется при создании агента)
+PROJECT_PROMPTS = os.path.join(Path(__file__).parent, "prompts")
+_prompts_registered = False
 
 # Системный промпт для агента
 SYSTEM_PROMPT = """
 Ты профессоральный писатель.
 """.strip()
 
-def run_web_server():
+# Сколько секунд при выходе ждать завершения текущих запросов к LLM фоновых задач
+SHUTDOWN_GRACE = 120
+
+def run_web_server(host: str = "0.0.0.0", port: int = 8000):
     """Запускает веб-сервер в отдельном потоке"""
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import uvicorn
+    from web.server import app
+    uvicorn.run(app, host=host, port=port)
+
+def start_web_process(data_dir: str, workers: int = 2, host: str = "0.0.0.0", port: int = 8000) -> subprocess.Popen:
+    """
+    Запускает веб-интерфейс в отдельных процессах (uvicorn с несколькими воркерами)
+    
+    Воркеры открывают хранилище только на чтение, а события пайплайна
+    получают из файла, в который их дублирует процесс генерации
+    
+    Args:
+        data_dir: Директория с данными
+        workers: Количество процессов веб-сервера
+        host: Адрес для прослушивания
+        port: Порт для прослушивания
+        
+    Returns:
+        subprocess.Popen: Процесс веб-сервера
+    """
+    from utils.events import event_bus
+    
+    events_file = os.path.join(data_dir, "events.jsonl")
+    event_bus.attach_file(events_file)
+    
+    env = dict(os.environ)
+    env["GORKY_STORAGE_READONLY"] = "1"
+    env["GORKY_EVENTS_FILE"] = events_file
+    env["GORKY_SEARCH_INDEX"] = os.path.join(data_dir, "search.db")
+    
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "web.server:app",
+            "--host", host,
+            "--port", str(port),
+            "--workers", str(workers)
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env
+    )
+
+def parse_args(argv=None):
+    """Разбирает аргументы командной строки"""
+    parser = argparse.ArgumentParser(description="Горький AI - генератор книг")
+    parser.add_argument(
+        "--web",
+        choices=["thread", "process", "off"],
+        default="thread",
+        help="Режим веб-интерфейса: в потоке процесса генерации, в отдельных процессах или выключен"
+    )
+    parser.add_argument("--web-workers", type=int, default=2, help="Количество процессов веб-сервера (режим process)")
+    parser.add_argument("--port", type=int, default=8000, help="Порт веб-интерфейса")
+    parser.add_argument("--batch", metavar="FILE", help="Пакетная генерация: JSONL-файл с предпочтениями (по одному объекту на строку)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Количество процессов пакетной генерации")
+    parser.add_argument("--books-per-worker", type=int, default=2, help="Количество книг, одновременно генерируемых в одном процессе")
+    parser.add_argument("--llm-concurrency", type=int, default=8, help="Общий лимит одновременных запросов к LLM в пакетном режиме")
+    parser.add_argument("--report", metavar="FILE", help="Путь к отчету пакетной генерации")
+    parser.add_argument("--task-queue", metavar="FILE", nargs="?", const="",
+                        help="Генерировать сцены через очередь задач SQLite (по умолчанию data/tasks.db), "
+                             "которую вместе с этим процессом разбирают воркеры --worker")
+    parser.add_argument("--sharded-storage", metavar="DIR", nargs="?", const="",
+                        help="Хранить артефакты каждой книги в отдельном файле (по умолчанию в data/books) "
+                             "с каталогом книг; книги, созданные раньше, остаются в общем хранилище")
+    parser.add_argument("--worker", action="store_true",
+                        help="Воркер очереди задач: выполняет сцены книг из --task-queue, пока его не остановят")
+    parser.add_argument("--worker-idle-exit", type=float, default=0, metavar="SEC",
+                        help="Завершить воркер после стольких секунд без задач (0 — работать постоянно)")
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument("--record", metavar="FILE", help="Записывать запросы к LLM и ответы в кассету")
+    cassette.add_argument("--replay", metavar="FILE", help="Воспроизводить ответы LLM из кассеты без обращения к сети")
+    parser.add_argument("--profile", action="store_true",
+                        help="Профилирование: процессорное время этапов, задержка цикла событий и блокирующие вызовы "
+                             "(отчеты в data/profiles, в том числе для процессов веб-сервера и пакетной генерации)")
+    parser.add_argument("--profile-block-ms", type=float, default=100,
+                        help="Порог блокировки цикла событий для отчета профилирования, мс")
+    parser.add_argument("--check-import-time", nargs="?", type=float, const=-1, metavar="MS",
+                        help="Проверить время импорта и ленивую загрузку тяжелых модулей и выйти "
+                             "(бюджет в мс, по умолчанию GORKY_IMPORT_BUDGET_MS или 250)")
+    return parser.parse_args(argv)
+
+def create_llm(llm_service="deepseek", model="deepseek-chat"):
+    """
+    Создает LLM с таймаутами, резервными провайдерами и страховочными запросами
+    
+    Резервные провайдеры задаются переменной окружения GORKY_LLM_FALLBACKS
+    в виде "провайдер:модель,провайдер:модель"; ключи API берутся из Config
+    (атрибут <провайдер>_api_key). GORKY_LLM_TIMEOUT — таймаут одного запроса
+    в секундах, GORKY_LLM_HEDGE_AFTER — задержка страховочного запроса, пока
+    не накоплена статистика задержек основного провайдера.
+    
+    GORKY_LLM_RECORD — путь кассеты для записи всех запросов и ответов,
+    GORKY_LLM_REPLAY — путь кассеты для воспроизведения без сети.
+    """
+    from utils.cassette import CassetteLLM, RECORD, REPLAY
+    from utils.llm import HedgedLLM, LLMProvider
+    
+    replay = os.environ.get("GORKY_LLM_REPLAY")
+    if replay:
+        return CassetteLLM(replay, REPLAY)
+    
+    from cognistruct.llm import LLMRouter
+    from cognistruct.utils import Config
+    
+    config = Config.load()
+    timeout = float(os.environ.get("GORKY_LLM_TIMEOUT", 300))
+    hedge_after = os.environ.get("GORKY_LLM_HEDGE_AFTER")
+    
+    routes = [(llm_service, model)]
+    for item in os.environ.get("GORKY_LLM_FALLBACKS", "").split(","):
+        if item.strip():
+            provider_name, _, provider_model = item.strip().partition(":")
+            routes.append((provider_name, provider_model or None))
+    
+    router = LLMRouter()
+    providers = []
+    for provider_name, provider_model in routes:
+        api_key = getattr(config, f"{provider_name}_api_key", None)
+        if not api_key:
+            logger.warning(f"Нет ключа API для провайдера {provider_name}, пропускаем")
+            continue
+        llm_config = {
+            "provider": provider_name,
+            "api_key": api_key,
+            "temperature": 0.7
+        }
+        if provider_model:
+            llm_config["model"] = provider_model
+        providers.append(LLMProvider(
+            f"{provider_name}/{provider_model}" if provider_model else provider_name,
+            router.create_instance(**llm_config),
+            timeout=timeout
+        ))
+    
+    llm = HedgedLLM(providers, hedge_after=float(hedge_after) if hedge_after else None)
+    record = os.environ.get("GORKY_LLM_RECORD")
+    if record:
+        return CassetteLLM(record, RECORD, llm)
+    return llm
+
+def register_prompts() -> None:
+    """Добавляет директорию промптов проекта в менеджер промптов (один раз)"""
+    global _prompts_registered
+    if _prompts_registered:
+        return
+    from cognistruct.utils.prompts import prompt_manager
+    if os.path.exists(PROJECT_PROMPTS):
+        prompt_manager.add_prompt_dir(PROJECT_PROMPTS)
+    _prompts_registered = True
 
 def create_agent(llm_service="deepseek"):
     """Создает и возвращает настроенный экземпляр BaseAgent"""
-    # Конфигурация LLM
-    llm_config = {
-        "provider": llm_service,
-        "model": "deepseek-chat",
-        "api_key": Config.load().deepseek_api_key,
-        "temperature": 0.7
-    }
+    from cognistruct import BaseAgent
+    from cognistruct.plugins.storage.project.plugin import ProjectStoragePlugin
+    from cognistruct.utils.pipeline import StageChain
+    from stages.preferences import PreferencesStage
+    from stages.prompt_generation import PromptGenerationStage
+    from stages.scene_generation import SceneGenerationStage
+    from stages.book_assembly import BookAssemblyStage
+    from stages.update_title import UpdateProjectTitleStage
+    from commands import CommandHandler
+    from utils.book_context import BookContext
+    from utils.jobs import JobManager
+    from utils.search_index import SearchIndex
+    from utils.storage import create_storage
+    from utils.task_queue import TaskQueue
+    from utils.tracing import tracer, STATUS_ERROR
+    from utils.run_control import GenerationCancelled
     
-    # Инициализируем LLM
-    llm = LLMRouter().create_instance(**llm_config)
+    register_prompts()
+    
+    # Инициализируем LLM (основной провайдер и резервные)
+    llm = create_llm(llm_service)
     
     # Создаем базового агента
     agent = BaseAgent(llm=llm, auto_load_plugins=False)
     
-    # Создаем плагины
-    storage = VersionedStoragePlugin()
+    # Создаем плагины (GORKY_STORAGE_SHARDS — отдельный файл хранилища на каждую книгу)
+    storage = create_storage()
     project = ProjectStoragePlugin()
     
-    # Создаем цепочку этапов
-    pipeline = StageChain([
+    # Очередь задач сцен, общая с воркерами --worker (None — сцены генерируются в этом процессе)
+    task_queue = TaskQueue(os.environ["GORKY_TASK_QUEUE"]) if os.environ.get("GORKY_TASK_QUEUE") else None
+    
+    # Создаем этапы
+    stages = [
         # 1. Этап сбора предпочтений (интерактивный)
         PreferencesStage(),
         
@@ -104,31 +261,112 @@ def create_agent(llm_service="deepseek"):
         ),
         
         # 8. Этап генерации и редактирования сцен
-        SceneGenerationStage(iterations=2),
+        # (GORKY_SCENE_CANDIDATES > 1 — выбор лучшего из нескольких параллельных черновиков,
+        # GORKY_ADAPTIVE_EDITS=1 — остановка правок, когда текст перестает меняться,
+        # GORKY_EDIT_CHUNK_WORDS — параллельная правка длинных сцен частями такого размера,
+        # GORKY_TASK_QUEUE — сцены как задачи очереди, которые разбирают и воркеры --worker)
+        SceneGenerationStage(
+            iterations=2,
+            candidates=int(os.environ.get("GORKY_SCENE_CANDIDATES", 1)),
+            adaptive=os.environ.get("GORKY_ADAPTIVE_EDITS") == "1",
+            chunk_words=int(os.environ.get("GORKY_EDIT_CHUNK_WORDS", 0)) or None,
+            queue=task_queue
+        ),
         
         # 9. Этап финальной сборки книги
         BookAssemblyStage()
-    ])
+    ]
+    
+    # Создаем цепочку этапов
+    pipeline = StageChain(stages)
     
     # Добавляем необходимые атрибуты агенту
     agent.storage = storage
     agent.project = project
+    agent.search_index = SearchIndex(os.path.join(DATA_DIR, "search.db"))
     agent.current_project = None
+    agent.book_context = None
     agent.pipeline = pipeline
+    agent.stages = stages
+    agent.task_queue = task_queue
+    
+    agent.jobs = JobManager()
+    
+    def for_project(project):
+        """
+        Возвращает представление агента для одной книги
+        
+        Представление разделяет с агентом LLM, хранилище и плагины, но имеет
+        собственную текущую книгу, поэтому фоновые задачи разных книг не
+        мешают друг другу и командам, открывающим другие книги
+        """
+        book_agent = copy.copy(agent)
+        book_agent.current_project = project
+        return book_agent
+        
+    agent.for_project = for_project
+    
+    def first_incomplete_stage(book_agent=None) -> int:
+        """
+        Номер (с 1) первого невыполненного этапа книги по манифесту
+        
+        Args:
+            book_agent: Представление агента для книги (по умолчанию — текущая книга)
+        
+        Returns:
+            int: Номер этапа или len(stages) + 1, если все этапы выполнены
+        """
+        book_agent = book_agent or agent
+        for number, stage in enumerate(stages, 1):
+            if stage.manifest_status(book_agent) != COMPLETE:
+                return number
+        return len(stages) + 1
+        
+    agent.first_incomplete_stage = first_incomplete_stage
     
     # Добавляем метод generate_book
-    async def generate_book(start_stage=1):
-        """Генерирует книгу, начиная с указанного этапа"""
+    async def generate_book(start_stage: Optional[int] = None, book_agent=None):
+        """
+        Генерирует книгу, начиная с указанного этапа
+        
+        Args:
+            start_stage: Номер этапа (с 1); по умолчанию — первый невыполненный по манифесту
+            book_agent: Представление агента для книги (по умолчанию — текущая книга)
+        """
+        book_agent = book_agent or agent
         try:
-            # Запускаем пайплайн
-            success = await pipeline.run(None, llm, agent)
+            if start_stage is None:
+                start_stage = first_incomplete_stage(book_agent)
+            if start_stage > len(stages):
+                print("✓ Все этапы уже выполнены")
+                return True
+            chain = pipeline if start_stage <= 1 else StageChain(stages[start_stage - 1:])
+            
+            # Артефакты книги читаются и разбираются один раз на весь запуск
+            book_agent.book_context = BookContext(book_agent.current_project.id)
+            
+            # Запускаем пайплайн (agent.llm может быть обернут, например в пакетном режиме);
+            # каждый запуск — отдельная трасса
+            project = book_agent.current_project
+            with tracer.span("book", new_trace=True, book_id=project.id, book_name=project.name,
+                             start_stage=start_stage) as span:
+                success = await chain.run(None, book_agent.llm, book_agent)
+                if span and not success:
+                    span.status, span.message = STATUS_ERROR, "pipeline failed"
             if not success:
                 logger.error("Пайплайн завершился с ошибкой")
                 return False
             return True
+        except GenerationCancelled:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при генерации книги: {e}")
             return False
+        finally:
+            context = getattr(book_agent, "book_context", None)
+            if context:
+                context.close()
+                book_agent.book_context = None
             
     agent.generate_book = generate_book
     
@@ -140,9 +378,56 @@ def create_agent(llm_service="deepseek"):
 
 async def main():
     """Точка входа"""
+    args = parse_args()
+    if args.check_import_time is not None:
+        from utils.import_time import check_import_time, DEFAULT_IMPORT_BUDGET_MS
+        budget = args.check_import_time if args.check_import_time > 0 else DEFAULT_IMPORT_BUDGET_MS
+        ok, report = check_import_time(budget_ms=budget)
+        print(report)
+        return 0 if ok else 1
+    # Через окружение режим кассеты получают и процессы пакетной генерации
+    if args.record:
+        os.environ["GORKY_LLM_RECORD"] = os.path.abspath(args.record)
+    if args.replay:
+        os.environ["GORKY_LLM_REPLAY"] = os.path.abspath(args.replay)
+    if args.task_queue is not None or args.worker:
+        from utils.task_queue import DEFAULT_QUEUE_PATH
+        os.environ["GORKY_TASK_QUEUE"] = os.path.abspath(args.task_queue or DEFAULT_QUEUE_PATH)
+    if args.sharded_storage is not None:
+        from utils.storage import SHARD_DIR
+        os.environ["GORKY_STORAGE_SHARDS"] = os.path.abspath(args.sharded_storage or SHARD_DIR)
+    if args.profile:
+        os.environ["GORKY_PROFILE"] = "1"
+        os.environ["GORKY_PROFILE_BLOCK_MS"] = str(args.profile_block_ms)
+    label = "worker" if args.worker else "batch" if args.batch else "cli"
+    async with profiling(label, enabled=args.profile):
+        return await run(args)
+
+async def run(args):
+    """Воркер очереди, пакетная генерация или интерактивный режим с веб-интерфейсом"""
+    if args.worker:
+        # Воркер без веб-интерфейса и командного цикла
+        from worker import run_worker
+        return await run_worker(os.environ["GORKY_TASK_QUEUE"], idle_exit=args.worker_idle_exit)
+    if args.batch:
+        # Неинтерактивный режим: без веб-интерфейса и командного цикла
+        from batch import run_batch
+        report = await run_batch(
+            args.batch,
+            workers=args.workers,
+            books_per_worker=args.books_per_worker,
+            llm_concurrency=args.llm_concurrency,
+            report_path=args.report
+        )
+        return 0 if report["failed"] == 0 else 1
+    
+    from utils.console import ainput
+    from utils.storage import enable_concurrent_readers
+    
+    web_process = None
     try:
         # Создаем директорию для данных
-        data_dir = os.path.join(os.path.dirname(__file__), "data")
+        data_dir = DATA_DIR
         os.makedirs(data_dir, exist_ok=True)
         
         # Создаем агента и компоненты
@@ -156,10 +441,16 @@ async def main():
         agent.plugin_manager.register_plugin("storage", storage)
         agent.plugin_manager.register_plugin("project", project)
         
-        # Запускаем веб-сервер в отдельном потоке
-        web_thread = threading.Thread(target=run_web_server, daemon=True)
-        web_thread.start()
-        print("🌐 Веб-интерфейс доступен по адресу http://localhost:8000")
+        # Запускаем веб-сервер
+        if args.web == "process":
+            # Веб-воркеры читают хранилище параллельно с записью генерации
+            enable_concurrent_readers(storage)
+            web_process = start_web_process(data_dir, workers=args.web_workers, port=args.port)
+            print(f"🌐 Веб-интерфейс ({args.web_workers} процесса) доступен по адресу http://localhost:{args.port}")
+        elif args.web == "thread":
+            web_thread = threading.Thread(target=run_web_server, kwargs={"port": args.port}, daemon=True)
+            web_thread.start()
+            print(f"🌐 Веб-интерфейс доступен по адресу http://localhost:{args.port}")
         
         # Запускаем агента
         await agent.start()
@@ -176,9 +467,9 @@ async def main():
 📝 Как начать:
 1. Создайте новую книгу: /new <название>
 2. Или откройте существующую: /open <id>
-3. Запустите генерацию: /start
+3. Запустите генерацию: /start (идет в фоне, прогресс — /jobs)
 
-🌐 Веб-интерфейс: http://localhost:8000
+🌐 Веб-интерфейс: http://localhost:{args.port}
 
 ❓ Введите /help для просмотра всех команд
 {"="*50}
@@ -188,7 +479,8 @@ async def main():
         # Основной цикл обработки команд
         while True:
             try:
-                user_input = input("👤 ").strip()
+                # Ввод читается без блокировки цикла: фоновые генерации продолжаются
+                user_input = (await ainput("👤 ")).strip()
                 
                 if user_input.lower() == "exit":
                     print("\n👋 До свидания!")
@@ -196,7 +488,7 @@ async def main():
                     
                 await command_handler.handle_command(user_input)
                     
-            except KeyboardInterrupt:
+            except (KeyboardInterrupt, EOFError):
                 print("\n👋 Работа прервана пользователем")
                 break
             
@@ -204,11 +496,19 @@ async def main():
         print(f"\n❌ Неожиданная ошибка: {str(e)}")
         raise
     finally:
+        if web_process:
+            web_process.terminate()
         if 'agent' in locals():
+            running = agent.jobs.running()
+            if running:
+                # Текущие запросы доводим до конца и сохраняем, чтобы не оплачивать их повторно
+                print(f"⏹ Останавливаем фоновые задачи ({len(running)}) после текущих запросов к LLM... "
+                      f"(Ctrl+C — прервать немедленно)")
+            await agent.jobs.shutdown(grace=SHUTDOWN_GRACE)
             await agent.cleanup()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        sys.exit(asyncio.run(main()))
     except KeyboardInterrupt:
         print("\n👋 Работа прервана пользователем")
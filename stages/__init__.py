@@ -1,8 +1,14 @@
-from .base import GorkyStage
-from .preferences import PreferencesStage
-from .prompt_generation import PromptGenerationStage
-from .scene_generation import SceneGenerationStage
-from .book_assembly import BookAssemblyStage
+import importlib
+
+# Этапы импортируются по первому обращению: импорт одного модуля этапа
+# (например, stages.preferences) не тянет за собой остальные
+_MODULES = {
+    'GorkyStage': '.base',
+    'PreferencesStage': '.preferences',
+    'PromptGenerationStage': '.prompt_generation',
+    'SceneGenerationStage': '.scene_generation',
+    'BookAssemblyStage': '.book_assembly'
+}
 
 __all__ = [
     'GorkyStage',
@@ -10,4 +16,13 @@ __all__ = [
     'PromptGenerationStage',
     'SceneGenerationStage',
     'BookAssemblyStage'
-] 
\ No newline at end of file
+]
+
+
+def __getattr__(name):
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
@@ -4,17 +4,50 @@ import logging
 from typing import Any, Optional, Union, Tuple, Dict
 import asyncio
 import itertools
+import json
 import sys
 import time
 
+from utils.book_context import BookContext
+from utils.console import background
+from utils.events import event_bus, STAGE_START, STAGE_FINISH, TOKENS, ERROR
+from utils.manifest import BookManifest, COMPLETE, content_hash
+from utils.tokens import estimator, context_budget
+from utils.run_control import BudgetExceeded, GenerationCancelled
+from utils.tracing import tracer, STATUS_ERROR
+from utils.usage import BookUsage, book_budget, request_cost, usage_to_dict
+
 logger = logging.getLogger(__name__)
 
+def llm_model(llm) -> Optional[str]:
+    """Имя модели основного провайдера LLM (None если неизвестно)"""
+    return getattr(getattr(llm, 'provider', None), 'model', None)
+
 class GorkyStage(Stage):
     """Базовый класс для всех этапов генерации книги"""
     
     def __init__(self):
         super().__init__()
         self.stage_name = self.__class__.__name__.replace('Stage', '')
+        # Артефакты, от которых зависит результат этапа
+        self.required_artifacts = []
+        
+    @property
+    def unit_name(self) -> str:
+        """Имя этапа в манифесте книги"""
+        return self.__class__.__name__
+        
+    def get_manifest(self, agent) -> BookManifest:
+        """Возвращает манифест текущей книги"""
+        return BookManifest.for_book(agent.current_project.id)
+        
+    def inputs_hash(self, agent) -> Optional[str]:
+        """Хэш входных артефактов этапа (None если какой-то еще неизвестен)"""
+        return self.get_manifest(agent).inputs_hash(self.required_artifacts)
+        
+    def manifest_status(self, agent) -> str:
+        """Состояние этапа по манифесту (complete/partial/stale/missing)"""
+        return self.get_manifest(agent).status(self.unit_name, self.inputs_hash(agent))
     
     async def run(self, db, llm, agent):
         """
@@ -28,17 +61,50 @@ class GorkyStage(Stage):
         Returns:
             bool: True если этап выполнен успешно, False в противном случае
         """
+        with tracer.span("stage", stage=self.stage_name) as span:
+            result = await self._run(db, llm, agent)
+            if span and not result:
+                span.status, span.message = STATUS_ERROR, "stage failed"
+            return result
+            
+    async def _run(self, db, llm, agent):
         try:
+            # Готовый этап с неизменившимися входами пропускаем, не обращаясь к хранилищу
+            if self.manifest_status(agent) == COMPLETE:
+                print(f"✓ Этап {self.stage_name} уже выполнен, пропускаем")
+                return True
+                
+            await self.checkpoint(agent)
+            self.prefetch(agent)
             print(f"📝 Этап: {self.stage_name}")
+            self.publish(agent, STAGE_START)
             result = await self.process(db, llm, agent)
             if result:
                 print(f"✓ Этап {self.stage_name} завершен успешно")
+                # Хэш входов считаем после этапа: он мог прочитать их впервые
+                manifest = self.get_manifest(agent)
+                manifest.mark_complete(self.unit_name, self.inputs_hash(agent))
+                manifest.save()
             else:
                 print(f"⚠ Этап {self.stage_name} завершился с ошибкой")
+            self.publish(agent, STAGE_FINISH, success=bool(result))
             return result
+        except BudgetExceeded as e:
+            # Продолжение после увеличения бюджета начнется с этого же места по манифесту
+            print(f"💰 Этап {self.stage_name} остановлен: {e}")
+            self.publish(agent, ERROR, message=str(e))
+            self.publish(agent, STAGE_FINISH, success=False, cancelled=True)
+            raise
+        except (GenerationCancelled, asyncio.CancelledError):
+            # Остановка генерации: все сохраненное уже отмечено в манифесте
+            print(f"⏹ Этап {self.stage_name} остановлен")
+            self.publish(agent, STAGE_FINISH, success=False, cancelled=True)
+            raise
         except Exception as e:
             logger.exception(f"Ошибка в этапе {self.stage_name}")
             print(f"❌ Ошибка в этапе {self.stage_name}: {str(e)}")
+            self.publish(agent, ERROR, message=str(e))
+            self.publish(agent, STAGE_FINISH, success=False)
             return False
     
     async def process(self, db, llm, agent):
@@ -91,9 +157,70 @@ class GorkyStage(Stage):
                 
         return agent.storage.generate_hierarchical_id(*path_parts)
         
+    def book_context(self, agent) -> Optional[BookContext]:
+        """Общий контекст запуска пайплайна для текущей книги (None вне пайплайна)"""
+        context = getattr(agent, "book_context", None)
+        if context and agent.current_project and context.book_id == agent.current_project.id:
+            return context
+        return None
+        
+    def prefetch(self, agent) -> None:
+        """
+        Запускает фоновое чтение артефактов этого и следующего этапа
+        
+        Чтение идет, пока этап ждет ответа LLM
+        """
+        context = self.book_context(agent)
+        if not context:
+            return
+        stages = getattr(agent, "stages", None) or []
+        upcoming = stages[stages.index(self) + 1:][:1] if self in stages else []
+        keys = list(self.required_artifacts) + [key for stage in upcoming for key in stage.required_artifacts]
+        context.prefetch(keys, lambda key: self.read_artefact(agent, key))
+        
     async def get_artefact(self, agent, key: str) -> Any:
         """
-        Получает артефакт из хранилища
+        Получает артефакт (в пайплайне — через общий контекст книги)
+        
+        Args:
+            agent: Ссылка на агента для доступа к хранилищу
+            key: Ключ артефакта
+            
+        Returns:
+            Any: Значение артефакта или None если не найден
+        """
+        context = self.book_context(agent)
+        if context:
+            return await context.get(key, lambda k: self.read_artefact(agent, k))
+        return await self.read_artefact(agent, key)
+        
+    async def get_parsed_artefact(self, agent, key: str) -> Any:
+        """
+        Получает артефакт с JSON-строкой, разобранной в словарь
+        
+        В пайплайне разбор выполняется один раз на весь запуск
+        
+        Args:
+            agent: Ссылка на агента для доступа к хранилищу
+            key: Ключ артефакта
+            
+        Returns:
+            Any: Значение артефакта или None если не найден
+        """
+        context = self.book_context(agent)
+        if context:
+            return await context.get_parsed(key, lambda k: self.read_artefact(agent, k))
+        value = await self.read_artefact(agent, key)
+        if isinstance(value, str):
+            try:
+                return json.loads(value)
+            except json.JSONDecodeError:
+                pass
+        return value
+        
+    async def read_artefact(self, agent, key: str) -> Any:
+        """
+        Читает артефакт из хранилища
         
         Args:
             agent: Ссылка на агента для доступа к хранилищу
@@ -112,6 +239,8 @@ class GorkyStage(Stage):
             if not artifact:
                 return None
             
+            # Книги, начатые до появления манифеста, пополняют его при чтении
+            self.get_manifest(agent).observe_output(key, artifact.get("value"))
             return artifact.get("value")
             
         except Exception as e:
@@ -153,12 +282,177 @@ class GorkyStage(Stage):
                 "metadata": metadata
             })
             
+            context = self.book_context(agent)
+            if context:
+                context.update(key, value)
+            
+            # Запоминаем хэш новой версии в манифесте
+            manifest = self.get_manifest(agent)
+            manifest.record_output(key, value)
+            manifest.save()
+            
+            # Обновляем полнотекстовый индекс
+            search_index = getattr(agent, "search_index", None)
+            if search_index:
+                try:
+                    search_index.update_artifact(agent.current_project.id, key, value)
+                except Exception as e:
+                    logger.error(f"Ошибка при индексации артефакта {key}: {str(e)}")
+            
             return True
             
         except Exception as e:
             logger.error(f"Ошибка при сохранении артефакта {key}: {str(e)}")
             return False 
         
+    def publish(self, agent, event_type: str, **data) -> None:
+        """
+        Публикует событие этапа в шину событий
+        
+        Args:
+            agent: Ссылка на агента (для ID текущей книги)
+            event_type: Тип события
+            **data: Дополнительные поля события
+        """
+        book_id = agent.current_project.id if agent and agent.current_project else None
+        event_bus.publish(event_type, book_id=book_id, stage=self.stage_name, **data)
+        
+    async def checkpoint(self, agent) -> None:
+        """
+        Точка паузы и мягкой отмены между запросами к LLM
+        
+        Raises:
+            GenerationCancelled: Если запрошена остановка генерации
+        """
+        control = getattr(agent, "run_control", None)
+        if control:
+            await control.checkpoint()
+        
+    async def generate(self, agent, llm, messages, message: str, **kwargs):
+        """
+        Вызывает LLM со спиннером и публикует расход токенов
+        
+        Перед запросом проходит точку проверки: на паузе ждет продолжения,
+        при остановке не отправляет запрос. Размер промпта оценивается
+        локально; оценка и фактический prompt_tokens пишутся в лог, а
+        расхождение подстраивает оценщик. Запрос, который превысил бы
+        бюджет книги, не отправляется.
+        
+        Args:
+            agent: Ссылка на агента
+            llm: Объект языковой модели
+            messages: Сообщения для LLM
+            message: Сообщение для спиннера (None — без спиннера, например
+                при нескольких параллельных запросах под общим спиннером)
+            **kwargs: Дополнительные параметры generate_response
+            
+        Returns:
+            Any: Ответ LLM
+            
+        Raises:
+            GenerationCancelled: Если запрошена остановка генерации
+            BudgetExceeded: Если запрос превысил бы бюджет книги
+        """
+        await self.checkpoint(agent)
+        planned = estimator.count_messages(messages)
+        self.check_budget(agent, llm, planned, kwargs.get('max_tokens'))
+        budget = context_budget(llm_model(llm))
+        if planned > budget:
+            logger.warning(f"{self.stage_name}: промпт ~{planned} токенов превышает бюджет {budget}")
+        with tracer.span("llm", stage=self.stage_name, model=llm_model(llm),
+                         prompt_hash=content_hash(messages)[:16], planned_tokens=planned) as span:
+            request = llm.generate_response(messages, **kwargs)
+            response = await (self.show_spinner(message, request) if message else request)
+            usage = usage_to_dict(getattr(response, 'usage', None))
+            # Ответить мог резервный провайдер, а проигравшие страховочные запросы
+            # тоже стоят денег: каждый запрос оценивается по цене своей модели
+            attempts = getattr(response, 'llm_attempts', None) or []
+            model = next((attempt["model"] for attempt in attempts if attempt["won"]), None) or llm_model(llm)
+            interrupted_cost = sum(
+                self.record_usage(agent, attempt["usage"], attempt["model"], interrupted=True)["cost"]
+                for attempt in attempts if not attempt["won"]
+            )
+            if usage:
+                actual = usage.get('prompt_tokens') or 0
+                if actual:
+                    logger.info(f"{self.stage_name}: промпт ~{planned} токенов по оценке ({estimator.method}), фактически {actual}")
+                    estimator.calibrate(planned, actual)
+                counters = self.record_usage(agent, usage, model)
+                cost = counters["cost"] + interrupted_cost
+                if span:
+                    span.set(model=model, prompt_tokens=counters["prompt_tokens"],
+                             completion_tokens=counters["completion_tokens"],
+                             cache_hit_tokens=counters["cache_hit_tokens"], cost=round(cost, 6))
+                self.publish(agent, TOKENS, usage=usage, planned_tokens=planned,
+                             cache_hit_tokens=counters["cache_hit_tokens"], cost=cost)
+        return response
+        
+    def check_budget(self, agent, llm, planned: int, max_tokens: Optional[int] = None) -> None:
+        """
+        Проверяет, что запрос не выйдет за бюджет книги
+        
+        Стоимость запроса прогнозируется по оценке промпта (без учета кэша)
+        и средней длине ответа этапа (или книги, пока у этапа нет ответов). Параллельные запросы проверяются
+        независимо, поэтому итог может превысить бюджет на их стоимость.
+        
+        Args:
+            agent: Ссылка на агента
+            llm: Объект языковой модели
+            planned: Оценка промпта в токенах
+            max_tokens: Ограничение длины ответа (если задано в запросе)
+            
+        Raises:
+            BudgetExceeded: Если потраченное вместе с прогнозом превышает бюджет
+        """
+        budget = book_budget(getattr(agent.current_project, 'metadata', None))
+        if budget is None:
+            return
+        book_usage = BookUsage.for_book(agent.current_project.id)
+        # Первый запрос этапа оцениваем по средней длине ответа всей книги
+        completion = (book_usage.average_completion(self.stage_name) or max_tokens
+                      or book_usage.average_completion())
+        projected = request_cost({"prompt_tokens": planned, "completion_tokens": completion}, llm_model(llm))
+        if book_usage.cost + projected > budget:
+            raise BudgetExceeded(book_usage.cost, projected, budget)
+        
+    def record_usage(self, agent, usage: Dict[str, Any], model: Optional[str] = None,
+                     interrupted: bool = False) -> Dict[str, Any]:
+        """
+        Учитывает расход токенов и стоимость запроса в статистике книги
+        
+        Args:
+            agent: Ссылка на агента
+            usage: Словарь usage из ответа LLM
+            model: Имя модели (для стоимости)
+            interrupted: Прерванный запрос без ответа (см. BookUsage.record)
+            
+        Returns:
+            Dict[str, Any]: Счетчики запроса (в том числе попадания в кэш промптов и стоимость)
+        """
+        book_usage = BookUsage.for_book(agent.current_project.id)
+        counters = book_usage.record(self.stage_name, usage, model, interrupted)
+        try:
+            book_usage.save()
+        except OSError as e:
+            logger.error(f"Не удалось сохранить расход токенов: {e}")
+        return counters
+        
+    def record_metric(self, agent, name: str, value: int = 1) -> None:
+        """
+        Учитывает счетчик этапа в статистике книги
+        
+        Args:
+            agent: Ссылка на агента
+            name: Имя счетчика
+            value: Прибавляемое значение
+        """
+        book_usage = BookUsage.for_book(agent.current_project.id)
+        book_usage.add(self.stage_name, name, value)
+        try:
+            book_usage.save()
+        except OSError as e:
+            logger.error(f"Не удалось сохранить статистику книги: {e}")
+        
     async def show_spinner(self, message: str, coro):
         """
         Показывает анимированный спиннер во время выполнения корутины
@@ -170,6 +464,10 @@ class GorkyStage(Stage):
         Returns:
             Any: Результат выполнения корутины
         """
+        # В фоновой задаче анимация мешала бы вводу команд
+        if background.get():
+            return await coro
+
         spinner = itertools.cycle(['⠋', '⠙', '⠹', '⠸', '⠼', '⠴', '⠦', '⠧', '⠇', '⠏'])
         task = asyncio.create_task(coro)
         
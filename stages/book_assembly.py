@@ -1,16 +1,27 @@
 from .base import GorkyStage
+from utils.story import parse_story
+from utils.text import clean_editor_notes
+import asyncio
 import logging
 import os
 import json
 from datetime import datetime
 from typing import Optional, Dict, List
-import re
 
 logger = logging.getLogger(__name__)
 
 class BookAssemblyStage(GorkyStage):
     """Этап сборки финальной книги"""
     
+    def __init__(self):
+        super().__init__()
+        # "scenes" — сводный хэш всех сцен, который записывает этап генерации сцен
+        self.required_artifacts = ["title", "story_structure", "scenes"]
+        
+    @property
+    def unit_name(self) -> str:
+        return "book"
+    
     def _escape_yaml(self, text):
         """
         Экранирует специальные символы для YAML
@@ -24,14 +35,38 @@ class BookAssemblyStage(GorkyStage):
             return f'"{text}"'
         return text
 
+    async def _run_pandoc(self, *args: str) -> int:
+        """
+        Запускает pandoc, не блокируя цикл событий
+        
+        Args:
+            *args: Аргументы командной строки pandoc
+            
+        Returns:
+            int: Код возврата (-1 если pandoc не найден)
+        """
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "pandoc", *args,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except FileNotFoundError:
+            logger.error("pandoc не найден")
+            return -1
+        _, stderr = await process.communicate()
+        if process.returncode != 0 and stderr:
+            logger.error(f"pandoc: {stderr.decode(errors='replace').strip()}")
+        return process.returncode
+
     def assemble_book(self, title_json, story_structure, scenes_data):
         """
         Собирает всю книгу в единый markdown файл с оглавлением и главами
         
         Args:
             title_json (str): JSON с названием книги или строка с названием
-            story_structure (str|dict): Структура книги в формате JSON строки или словаря
-            scenes_data (dict): Словарь с текстами сцен, где ключи в формате chapter{N}_scene{M}
+            story_structure (str|dict|StoryModel): Структура книги (JSON строка, словарь или модель)
+            scenes_data (dict): Словарь с текстами сцен, где ключи в формате chapter{N}/scene{M}
         
         Returns:
             str: Путь к собранному файлу книги
@@ -50,13 +85,12 @@ class BookAssemblyStage(GorkyStage):
             logger.error("Ошибка при получении названия книги", exc_info=True)
             title = 'Без названия'
         
-        # Преобразуем story_structure в словарь, если это JSON строка
-        if isinstance(story_structure, str):
-            try:
-                story_structure = json.loads(story_structure)
-            except json.JSONDecodeError:
-                logger.error("Ошибка при парсинге story_structure", exc_info=True)
-                return None
+        # Преобразуем story_structure в модель, если это JSON строка или словарь
+        try:
+            story = parse_story(story_structure)
+        except ValueError:
+            logger.error("Ошибка при парсинге story_structure", exc_info=True)
+            return None
         
         logger.info(f"Сборка книги: {title}")
         
@@ -76,28 +110,24 @@ class BookAssemblyStage(GorkyStage):
                 
                 # Оглавление
                 f.write('## Оглавление\n\n')
-                for chapter in story_structure['chapters']:
-                    f.write(f"- [Глава {chapter['number']}. {chapter['title']}](#глава-{chapter['number']}-{chapter['title'].lower().replace(' ', '-')})\n")
+                for chapter in story.chapters:
+                    f.write(f"- [Глава {chapter.number}. {chapter.title}](#глава-{chapter.number}-{chapter.title.lower().replace(' ', '-')})\n")
                 f.write('\n---\n\n')
                 
                 # Собираем каждую главу
-                for chapter in story_structure['chapters']:
-                    chapter_title = chapter['title']
-                    chapter_number = chapter['number']
+                for chapter in story.chapters:
+                    chapter_title = chapter.title
+                    chapter_number = chapter.number
                     
                     # Собираем сцены для главы
-                    chapter_scenes = []
-                    for scene in chapter['scenes']:
-                        scene_key = f"chapter{chapter_number}_scene{scene['number']}"
-                        if scene_key in scenes_data:
-                            chapter_scenes.append(scenes_data[scene_key])
+                    chapter_scenes = [scenes_data[scene.key] for scene in chapter.scenes if scene.key in scenes_data]
                     
                     if chapter_scenes:
                         # Записываем главу
                         f.write(f'\n## Глава {chapter_number}. {chapter_title}\n\n')
                         f.write('\n\n'.join(chapter_scenes))
                         # Добавляем разделитель только между главами, не в конце
-                        if chapter != story_structure['chapters'][-1]:
+                        if chapter is not story.chapters[-1]:
                             f.write('\n---\n\n')
             
             return book_file
@@ -151,7 +181,12 @@ lang: ru
             html_file = markdown_file.replace('.md', '.html')
             
             # Конвертируем в HTML с помощью pandoc
-            result = os.system(f'pandoc "{metadata_file}" "{markdown_file}" -f markdown -t html -s --template="{template_path}" -o "{html_file}"')
+            result = await self._run_pandoc(
+                metadata_file, markdown_file,
+                "-f", "markdown", "-t", "html", "-s",
+                f"--template={template_path}",
+                "-o", html_file
+            )
             
             # Удаляем временный файл с метаданными
             if os.path.exists(metadata_file):
@@ -225,7 +260,11 @@ rights: © {datetime.now().year} AI Author
             fb2_file = markdown_file.replace('.md', '.fb2')
             
             # Конвертируем в FB2 с помощью pandoc
-            result = os.system(f'pandoc "{metadata_file}" "{markdown_file}" -f markdown -t fb2 -s -o "{fb2_file}"')
+            result = await self._run_pandoc(
+                metadata_file, markdown_file,
+                "-f", "markdown", "-t", "fb2", "-s",
+                "-o", fb2_file
+            )
             
             # Удаляем временный файл с метаданными
             if os.path.exists(metadata_file):
@@ -245,7 +284,7 @@ rights: © {datetime.now().year} AI Author
 
     def _clean_editor_notes(self, text: str) -> str:
         """
-        Очищает текст от примечаний редактора с помощью регулярных выражений
+        Очищает текст от примечаний редактора
         
         Args:
             text: Исходный текст
@@ -253,62 +292,41 @@ rights: © {datetime.now().year} AI Author
         Returns:
             str: Очищенный текст
         """
-        if not text:
-            return ""
-            
-        # Паттерн для поиска любого текста между знаками равенства
-        # (?s) - флаг DOTALL, позволяет . матчить переносы строк
-        # (?m) - флаг MULTILINE, обрабатывает текст построчно
-        # =+ - один или более знаков равенства
-        # .*? - любой текст (нежадный режим)
-        # =+ - один или более знаков равенства
-        pattern = r"(?sm)==+.*\n==+"
-        
-        # Заменяем найденные блоки на пустую строку
-        cleaned_text = re.sub(pattern, "", text)
-        
-        # Убираем двойные переносы строк
-        cleaned_text = re.sub(r"\n{3,}", "\n\n", cleaned_text)
-        
-        return cleaned_text.strip()
+        return clean_editor_notes(text)
 
     async def process(self, db, llm, agent):
         """Собирает книгу из всех сгенерированных артефактов"""
         try:
             # Получаем необходимые артефакты
             title = await self.get_artefact(agent, "title")
-            story_structure = await self.get_artefact(agent, "story_structure")
+            story_structure = await self.get_parsed_artefact(agent, "story_structure")
             
             if not all([title, story_structure]):
                 logger.error("Не найдены необходимые артефакты")
                 return False
                 
-            # Преобразуем в словари если нужно
-            if isinstance(story_structure, str):
-                story_structure = json.loads(story_structure)
+            story = parse_story(story_structure)
             
             # Получаем все сцены
             scenes_data = {}
-            for chapter in story_structure['chapters']:
-                for scene in chapter['scenes']:
-                    scene_key = f"chapter{chapter['number']}_scene{scene['number']}"
-                    scene_text = await self.get_artefact(agent, f"chapter{chapter['number']}/scene{scene['number']}")
-                    if scene_text:
-                        # Если текст в JSON формате, извлекаем его
-                        if isinstance(scene_text, str):
-                            try:
-                                scene_text = json.loads(scene_text)
-                                if isinstance(scene_text, dict):
-                                    scene_text = scene_text.get('scene_text', '')
-                            except json.JSONDecodeError:
-                                pass  # Оставляем как есть, если это просто текст
-                        elif isinstance(scene_text, dict):
-                            scene_text = scene_text.get('scene_text', '')
-                            
-                        # Очищаем текст от примечаний редактора
-                        scene_text = self._clean_editor_notes(scene_text)
-                        if scene_text:  # Добавляем только если есть текст
-                            scenes_data[scene_key] = scene_text
+            for scene in story.scenes:
+                scene_text = await self.get_artefact(agent, scene.key)
+                if scene_text:
+                    # Если текст в JSON формате, извлекаем его
+                    if isinstance(scene_text, str):
+                        try:
+                            scene_text = json.loads(scene_text)
+                            if isinstance(scene_text, dict):
+                                scene_text = scene_text.get('scene_text', '')
+                        except json.JSONDecodeError:
+                            pass  # Оставляем как есть, если это просто текст
+                    elif isinstance(scene_text, dict):
+                        scene_text = scene_text.get('scene_text', '')
+                        
+                    # Очищаем текст от примечаний редактора
+                    scene_text = self._clean_editor_notes(scene_text)
+                    if scene_text:  # Добавляем только если есть текст
+                        scenes_data[scene.key] = scene_text
             
             if not scenes_data:
                 logger.error("Не найдены сгенерированные сцены")
@@ -316,7 +334,7 @@ rights: © {datetime.now().year} AI Author
             
             # Собираем книгу
             print("📚 Сборка книги...")
-            book_file = self.assemble_book(title, story_structure, scenes_data)
+            book_file = self.assemble_book(title, story, scenes_data)
             if not book_file:
                 logger.error("Не удалось собрать книгу")
                 return False
@@ -5,11 +5,17 @@ from cognistruct.utils.prompts import prompt_manager
 import asyncio
 import json
 
+from utils.console import ainput
+
 logger = logging.getLogger(__name__)
 
 class PreferencesStage(GorkyStage):
     """Этап сбора предпочтений пользователя"""
     
+    @property
+    def unit_name(self) -> str:
+        return "preferences"
+    
     async def check_preferences_exist(self, agent) -> bool:
         """
         Проверяет, существуют ли уже предпочтения
@@ -43,7 +49,7 @@ class PreferencesStage(GorkyStage):
             prompt = f"{question['text']}"
             if default:
                 prompt += f"[{default}] "
-            answer = input(prompt) or default
+            answer = await ainput(prompt) or default
             
             # Если ответ пустой и вопрос опциональный
             if not answer and question.get("optional"):
@@ -109,7 +115,7 @@ class PreferencesStage(GorkyStage):
                     prompt = f"{section['text']}"
                     if default:
                         prompt += f"[{default}] "
-                    choice = input(prompt) or default
+                    choice = await ainput(prompt) or default
                     
                     # Находим выбранную опцию
                     try:
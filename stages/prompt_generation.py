@@ -1,8 +1,12 @@
 from .base import GorkyStage
+import asyncio
 import logging
 import json
 from typing import Dict, Any, List, Optional
 from cognistruct.utils.prompts import prompt_manager
+from utils.manifest import STALE
+from utils.run_control import GenerationCancelled
+from utils.structured_output import StructuredOutput, ARTIFACT_SCHEMAS
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +26,10 @@ class PromptGenerationStage(GorkyStage):
         self.required_artifacts = required_artifacts or []
         self.stage_name = artifact_name.replace('_', ' ').title()
         
+    @property
+    def unit_name(self) -> str:
+        return self.artifact_name
+        
     async def check_artifact_exists(self, agent) -> bool:
         """
         Проверяет, существует ли уже артефакт этого этапа
@@ -42,15 +50,20 @@ class PromptGenerationStage(GorkyStage):
         """Генерирует артефакт на основе промпта"""
         try:
             # Проверяем, существует ли уже артефакт
-            if await self.check_artifact_exists(agent):
+            # (если входные артефакты изменились, генерируем заново)
+            if self.manifest_status(agent) == STALE:
+                print(f"♻️ Входные данные {self.artifact_name} изменились, генерируем заново")
+            elif await self.check_artifact_exists(agent):
                 print(f"✓ Артефакт {self.artifact_name} уже существует")
                 return True
 
-            # Собираем контекст из предыдущих артефактов
+            # Собираем контекст из предыдущих артефактов (читаются параллельно)
             params = {}
             if self.required_artifacts:
-                for artifact_name in self.required_artifacts:
-                    artifact = await self.get_artefact(agent, artifact_name)
+                artifacts = await asyncio.gather(
+                    *(self.get_artefact(agent, artifact_name) for artifact_name in self.required_artifacts)
+                )
+                for artifact_name, artifact in zip(self.required_artifacts, artifacts):
                     if not artifact:
                         print(f"⚠️ Не найден артефакт {artifact_name}")
                         return False
@@ -69,33 +82,42 @@ class PromptGenerationStage(GorkyStage):
 
             # Генерируем ответ
             messages = [{"role": "user", "content": prompt}]
-            response = await self.show_spinner(
+            response = await self.generate(
+                agent,
+                llm,
+                messages,
                 f"Генерация {self.artifact_name}",
-                llm.generate_response(
-                    messages,
-                    response_format={"type": "json_object"}
-                )
+                response_format={"type": "json_object"}
             )
 
-            # Извлекаем контент и парсим JSON
-            content = response.content
+            # Извлекаем контент
+            content = response.content if response else None
             print(f"\nОтвет LLM:\n{content}\n")
 
             if not content:
                 print("⚠️ Получен пустой ответ от LLM")
                 return False
 
-            try:
-                result = json.loads(content)
-            except json.JSONDecodeError as e:
-                print(f"⚠️ Ошибка парсинга JSON: {str(e)}")
-                print(f"Контент: {content}")
+            # Разбираем JSON: дефекты исправляем локально или точечными запросами,
+            # а не повторной генерацией всего артефакта
+            async def follow_up(follow_messages, message, json_mode):
+                kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+                return await self.generate(agent, llm, follow_messages, message, **kwargs)
+
+            structured = StructuredOutput(ARTIFACT_SCHEMAS.get(self.artifact_name))
+            result, repairs = await structured.complete(follow_up, messages, content)
+            for repair in repairs:
+                print(f"🩹 {repair}")
+            if result is None:
+                print(f"⚠️ Не удалось получить корректный JSON для {self.artifact_name}")
                 return False
 
             # Сохраняем результат
-            await self.set_artefact(agent, self.artifact_name, result, prompt)
-            return True
+            return await self.set_artefact(agent, self.artifact_name, result, prompt)
 
+        except GenerationCancelled:
+            raise
         except Exception as e:
+            logger.exception(f"Ошибка при генерации {self.artifact_name}")
             print(f"⚠️ Ошибка при генерации {self.artifact_name}: {str(e)}")
             return False 
\ No newline at end of file
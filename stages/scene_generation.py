@@ -1,20 +1,206 @@
-from .base import GorkyStage
+from .base import GorkyStage, llm_model
+from utils.events import SCENE_DRAFTED, SCENE_EDITED, SCENE_DONE
+from utils.manifest import COMPLETE, PARTIAL, STALE, content_hash
+from utils.run_control import GenerationCancelled
+from utils.diff import change_ratio
+from utils.text import clean_editor_notes, split_paragraphs, group_paragraphs
+from utils.character_ledger import CharacterLedger
+from utils.text_metrics import score_scene
+from utils.story import StoryModel, parse_story
+from utils.tokens import ContextPlanner, context_budget, estimator, keep_tail
+from utils.task_queue import TaskQueue, LEASE_SECONDS, DONE, FAILED, run_leased, worker_id
+from utils.tracing import tracer
+from utils.usage import BookUsage
+import asyncio
+import copy
 import logging
 import json
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 logger = logging.getLogger(__name__)
 
+# Меньше этого предыдущую сцену не обрезаем, а убираем целиком
+MIN_PREV_SCENE_TOKENS = 300
+
+# Тип задачи очереди: одна сцена (черновик и все правки)
+SCENE_TASK = "scene"
+# Как часто проверять очередь, пока сцены книги выполняют другие воркеры (секунды)
+QUEUE_POLL_INTERVAL = 2.0
+
 class SceneGenerationStage(GorkyStage):
     """Этап генерации и редактирования сцен"""
     
-    def __init__(self, iterations: int = 3):
+    # Артефакты, от которых зависит каждая сцена (помимо предыдущей сцены);
+    # состояние персонажей выводится из них и структуры, поэтому в хэш не входит
+    SCENE_INPUTS = ["characters", "story_outline"]
+    
+    def __init__(self, iterations: int = 3, candidates: int = 1,
+                 candidate_iterations: Optional[int] = None, target_word_count: int = 1500,
+                 adaptive: bool = False, min_iterations: int = 1,
+                 change_threshold: float = 0.05, length_threshold: float = 0.03,
+                 chunk_words: Optional[int] = None, queue: Optional[TaskQueue] = None):
         """
         Args:
             iterations: Количество итераций редактирования каждой сцены
+                (в адаптивном режиме — максимальное)
+            candidates: Количество параллельных черновиков (best-of-k); лучший
+                выбирается локальной оценкой без запросов к LLM
+            candidate_iterations: Количество итераций редактирования при выборе
+                из нескольких черновиков (по умолчанию на одну меньше iterations)
+            target_word_count: Целевой объем сцены в словах
+            adaptive: Останавливать редактирование, когда итерация почти
+                не меняет текст
+            min_iterations: Минимальное количество итераций в адаптивном режиме
+            change_threshold: Доля измененных слов, ниже которой текст
+                считается устоявшимся
+            length_threshold: Допустимое относительное изменение длины текста
+            chunk_words: Размер части сцены в словах для параллельного
+                редактирования (None — сцена редактируется целиком)
+            queue: Очередь задач: сцены выполняются как задачи с арендой,
+                которые вместе с этим процессом разбирают воркеры --worker
+                (None — сцены генерируются здесь же по порядку)
         """
         super().__init__()
-        self.iterations = iterations
+        self.candidates = max(1, candidates)
+        if self.candidates > 1:
+            # Лучший из нескольких черновиков требует меньше последовательных правок
+            self.iterations = candidate_iterations if candidate_iterations is not None else max(iterations - 1, 1)
+        else:
+            self.iterations = iterations
+        self.target_word_count = target_word_count
+        self.adaptive = adaptive
+        self.min_iterations = min(max(min_iterations, 1), self.iterations)
+        self.change_threshold = change_threshold
+        self.length_threshold = length_threshold
+        self.chunk_words = chunk_words
+        self.queue = queue
+        self.required_artifacts = ["story_structure", "characters", "story_outline"]
+        
+    @property
+    def unit_name(self) -> str:
+        return "scenes"
+        
+    def build_messages(self, book_prompt: str, scene_prompt: str, task_prompt: str) -> List[Dict[str, str]]:
+        """
+        Собирает сообщения запроса: от самого стабильного к самому изменчивому
+        
+        Args:
+            book_prompt: Общий контекст книги (системное сообщение, одно на все сцены)
+            scene_prompt: Контекст сцены (общий для черновика и правок)
+            task_prompt: Задание конкретного вызова
+            
+        Returns:
+            List[Dict[str, str]]: Сообщения для LLM
+        """
+        return [
+            {"role": "system", "content": book_prompt},
+            {"role": "user", "content": f"{scene_prompt}\n\n{task_prompt}"}
+        ]
+        
+    def plan_messages(self, llm, params: Dict[str, Any], task_prompt: str) -> List[Dict[str, str]]:
+        """
+        Собирает сообщения сцены, укладывая их в бюджет контекста модели
+        
+        Если промпт не помещается, сокращаются наименее важные части: сначала
+        начало предыдущей сцены (ее конец важнее), затем она целиком, затем
+        недавние изменения персонажей и, наконец, подробности сюжета. Сокращения
+        сохраняются в params, поэтому остальные вызовы сцены получают тот же
+        префикс и не теряют кэш провайдера.
+        
+        Args:
+            llm: Объект языковой модели (для бюджета по модели)
+            params: Параметры контекста сцены и книги
+            task_prompt: Задание конкретного вызова
+            
+        Returns:
+            List[Dict[str, str]]: Сообщения для LLM
+        """
+        def render(p: Dict[str, Any]) -> List[Dict[str, str]]:
+            if 'book_prompt' not in p:
+                p['book_prompt'] = self.load_prompt("book_context.jinja2",
+                    params={
+                        'story_outline': p['story_outline']
+                    }
+                )
+            scene_prompt = self.load_prompt("scene_context.jinja2", params=p)
+            return self.build_messages(p['book_prompt'], scene_prompt, task_prompt)
+            
+        planner = ContextPlanner(context_budget(llm_model(llm)))
+        messages, _ = planner.fit(render, params, [
+            ("начало предыдущей сцены", self._trim_prev_scene),
+            ("текст предыдущей сцены", self._drop_prev_scene),
+            ("история персонажей", self._drop_cast_changes),
+            ("подробности сюжета", self._keep_synopsis),
+        ])
+        return messages
+        
+    @staticmethod
+    def _trim_prev_scene(params: Dict[str, Any], excess: int) -> bool:
+        text = params.get('prev_scene_text')
+        if not text:
+            return False
+        size = estimator.count(text)
+        keep = size - excess
+        if keep < MIN_PREV_SCENE_TOKENS:
+            return False
+        trimmed = keep_tail(text, keep)
+        if estimator.count(trimmed) >= size:
+            return False
+        params['prev_scene_text'] = trimmed
+        return True
+        
+    @staticmethod
+    def _drop_prev_scene(params: Dict[str, Any], excess: int) -> bool:
+        # Описание предыдущей сцены остается, уходит только ее текст
+        if not params.get('prev_scene_text'):
+            return False
+        params['prev_scene_text'] = None
+        return True
+        
+    @staticmethod
+    def _drop_cast_changes(params: Dict[str, Any], excess: int) -> bool:
+        changed = False
+        for entry in params.get('cast', []):
+            if entry['state'].pop('changes', None):
+                changed = True
+        return changed
+        
+    @staticmethod
+    def _keep_synopsis(params: Dict[str, Any], excess: int) -> bool:
+        outline = params['story_outline']
+        if not isinstance(outline, dict):
+            return False
+        short = {key: outline[key] for key in ('title', 'synopsis', 'themes') if key in outline}
+        if len(short) == len(outline):
+            return False
+        params['story_outline'] = short
+        params.pop('book_prompt', None)
+        return True
+        
+    def has_converged(self, previous_text: str, edited_text: str) -> tuple[bool, float]:
+        """
+        Проверяет, что итерация редактирования почти не изменила текст
+        
+        Args:
+            previous_text: Текст до итерации
+            edited_text: Текст после итерации
+            
+        Returns:
+            tuple[bool, float]: (текст устоялся, доля измененных слов; для
+                неустоявшегося текста — оценка не ниже change_threshold)
+        """
+        before = clean_editor_notes(previous_text)
+        after = clean_editor_notes(edited_text)
+        length_delta = abs(len(after) - len(before)) / max(len(before), 1)
+        # Точный дифф нужен только ниже порога: сильную правку change_ratio
+        # отсекает по разнице длин и ограниченному поиску, не блокируя цикл событий
+        change = change_ratio(before, after, limit=self.change_threshold)
+        return change < self.change_threshold and length_delta < self.length_threshold, change
+        
+    @staticmethod
+    def format_prompt(messages: List[Dict[str, str]]) -> str:
+        """Текст промпта для сохранения в метаданных артефакта"""
+        return "\n\n".join(message["content"] for message in messages)
         
     async def get_scene_version(self, agent, chapter_num: int, scene_num: int) -> int:
         """
@@ -45,13 +231,13 @@ class SceneGenerationStage(GorkyStage):
             logger.error(f"Ошибка при получении версии сцены: {str(e)}")
             return 0
 
-    async def get_previous_scene(self, agent, story_structure: dict, chapter_number: int, scene_number: int) -> tuple[str, dict]:
+    async def get_previous_scene(self, agent, story: StoryModel, chapter_number: int, scene_number: int) -> tuple[str, dict]:
         """
         Получает текст и информацию о предыдущей сцене
         
         Args:
             agent: Ссылка на агента
-            story_structure: Структура истории
+            story: Модель структуры книги
             chapter_number: Номер текущей главы
             scene_number: Номер текущей сцены
             
@@ -59,201 +245,589 @@ class SceneGenerationStage(GorkyStage):
             tuple[str, dict]: (текст предыдущей сцены, информация о предыдущей сцене)
         """
         try:
-            # Если это первая сцена первой главы
-            if chapter_number == 1 and scene_number == 1:
+            current = story.scene(chapter_number, scene_number)
+            prev_scene = current.prev if current else None
+            if prev_scene is None:
                 return None, None
                 
-            # Если это первая сцена главы
-            if scene_number == 1:
-                prev_chapter = next(
-                    (ch for ch in story_structure['chapters'] if ch['number'] == chapter_number - 1),
-                    None
-                )
-                if prev_chapter:
-                    prev_scene = prev_chapter['scenes'][-1]  # Последняя сцена предыдущей главы
-                    scene_key = f"chapter{chapter_number-1}/scene{prev_scene['number']}"
-            else:
-                current_chapter = next(
-                    (ch for ch in story_structure['chapters'] if ch['number'] == chapter_number),
-                    None
-                )
-                if current_chapter:
-                    prev_scene = next(
-                        (sc for sc in current_chapter['scenes'] if sc['number'] == scene_number - 1),
-                        None
-                    )
-                    if prev_scene:
-                        scene_key = f"chapter{chapter_number}/scene{scene_number-1}"
-                    else:
-                        return None, None
-                else:
-                    return None, None
-            
-            if prev_scene:
-                prev_scene_text = await self.get_artefact(agent, scene_key)
-                if isinstance(prev_scene_text, str):
-                    try:
-                        prev_scene_text = json.loads(prev_scene_text)
-                        prev_scene_text = prev_scene_text.get('scene_text', '')
-                    except json.JSONDecodeError:
-                        pass
-                
-                prev_scene_info = {
-                    'title': prev_scene['title'],
-                    'description': prev_scene['description'],
-                    'characters': prev_scene['characters'],
-                    'location': prev_scene['location'],
-                    'time': prev_scene['time'],
-                    'dramatic_info': prev_scene['dramatic_info']
-                }
-                return prev_scene_text, prev_scene_info
+            prev_scene_text = await self.get_artefact(agent, prev_scene.key)
+            if isinstance(prev_scene_text, str):
+                try:
+                    prev_scene_text = json.loads(prev_scene_text)
+                    prev_scene_text = prev_scene_text.get('scene_text', '')
+                except json.JSONDecodeError:
+                    pass
+            return prev_scene_text, prev_scene.info()
                 
         except Exception as e:
             logger.error(f"Ошибка при получении предыдущей сцены: {e}")
         
         return None, None
 
+    async def load_context(self, agent) -> Optional[Dict[str, Any]]:
+        """
+        Общие артефакты сцен книги
+        
+        Returns:
+            Optional[Dict[str, Any]]: story, story_outline, ledger и book_prompt
+                или None, если каких-то артефактов нет
+        """
+        # Получаем необходимые артефакты
+        story_structure, characters, story_outline = await asyncio.gather(
+            self.get_parsed_artefact(agent, "story_structure"),
+            self.get_parsed_artefact(agent, "characters"),
+            self.get_parsed_artefact(agent, "story_outline")
+        )
+        
+        if not all([story_structure, characters, story_outline]):
+            logger.error("Не найдены необходимые артефакты")
+            return None
+        
+        context = {
+            'story': parse_story(story_structure),
+            'story_outline': story_outline,
+            # Состояние персонажей: в промпт сцены попадают только ее действующие лица
+            'ledger': CharacterLedger.from_characters(characters)
+        }
+        # Общий префикс всех запросов книги: провайдер кэширует его между вызовами
+        context['book_prompt'] = self.load_prompt("book_context.jinja2",
+            params={
+                'story_outline': story_outline
+            }
+        )
+        return context
+        
+    def scene_status(self, manifest, scene_ref) -> tuple[List[str], str]:
+        """
+        Состояние сцены по манифесту
+        
+        Returns:
+            tuple[List[str], str]: (ключи входных артефактов сцены, состояние)
+        """
+        # Сцена зависит от персонажей, сюжета, своего описания и предыдущей сцены
+        input_keys = self.SCENE_INPUTS + ([scene_ref.prev.key] if scene_ref.prev else [])
+        inputs_hash = manifest.inputs_hash(input_keys, scene_ref.chapter.data['title'], scene_ref.data)
+        return input_keys, manifest.status(scene_ref.key, inputs_hash)
+        
+    @staticmethod
+    def scene_progress(story: StoryModel, scene_ref) -> Dict[str, int]:
+        """Поля прогресса сцены для событий"""
+        return {
+            'chapter': scene_ref.chapter.number,
+            'scene': scene_ref.number,
+            'scene_index': scene_ref.index + 1,
+            'scene_total': story.total
+        }
+        
     async def process(self, db, llm, agent):
         """Генерирует и редактирует все сцены книги"""
         try:
-            # Получаем необходимые артефакты
-            story_structure = await self.get_artefact(agent, "story_structure")
-            characters = await self.get_artefact(agent, "characters")
-            story_outline = await self.get_artefact(agent, "story_outline")
-            
-            if not all([story_structure, characters, story_outline]):
-                logger.error("Не найдены необходимые артефакты")
+            context = await self.load_context(agent)
+            if context is None:
                 return False
+            if self.queue is not None:
+                return await self.process_queued(agent, llm, context)
+            
+            story = context['story']
+            manifest = self.get_manifest(agent)
             
-            # Преобразуем в словари если нужно
-            if isinstance(story_structure, str):
-                story_structure = json.loads(story_structure)
-            if isinstance(characters, str):
-                characters = json.loads(characters)
-            if isinstance(story_outline, str):
-                story_outline = json.loads(story_outline)
+            all_done = True
             
             # Проходим по всем главам и сценам из story_structure
-            for chapter in story_structure['chapters']:
-                print(f"\n📖 Глава {chapter['number']}/{len(story_structure['chapters'])} {chapter['title']}")
+            for chapter_ref in story.chapters:
+                chapter = chapter_ref.data
+                print(f"\n📖 Глава {chapter['number']}/{len(story.chapters)} {chapter['title']}")
                 
-                for scene in chapter['scenes']:
+                for scene_ref in chapter_ref.scenes:
+                    scene = scene_ref.data
+                    scene_key = scene_ref.key
+                    progress = self.scene_progress(story, scene_ref)
                     print(f"\n🎬 Сцена {scene['number']}/{len(chapter['scenes'])} {scene['title']}")
                     
-                    # Проверяем версию сцены
-                    version = await self.get_scene_version(agent, chapter['number'], scene['number'])
+                    input_keys, status = self.scene_status(manifest, scene_ref)
                     
-                    # Если версий нет - генерируем с нуля
-                    if version == 0:
-                        print("✍️ Генерация текста...")
-                        
-                        # Получаем предыдущую сцену
-                        prev_scene_text, prev_scene_info = await self.get_previous_scene(
-                            agent, 
-                            story_structure, 
-                            chapter['number'], 
-                            scene['number']
-                        )
-                        
-                        prompt = self.load_prompt("scene_generation.jinja2",
-                            params={
-                                'scene': scene,
-                                'chapter': chapter,
-                                'characters': characters,
-                                'story_structure': story_structure,
-                                'story_outline': story_outline,  # Передаем для контекста
-                                'prev_scene_text': prev_scene_text,
-                                'prev_scene_info': prev_scene_info,
-                                'target_word_count': 1500  # TODO: сделать настраиваемым
-                            }
-                        )
-                        
-                        messages = [{"role": "user", "content": prompt}]
-                        scene_text = await self.show_spinner(
-                            "Генерация текста сцены",
-                            llm.generate_response(
-                                messages
+                    if status == COMPLETE:
+                        print(f"✓ Сцена {chapter['number']}/{scene['number']} уже готова, пропускаем")
+                    else:
+                        with tracer.span("scene", scene=scene_key, status=status):
+                            done = await self.process_scene(
+                                agent, llm, context, chapter, scene, status, progress, input_keys
                             )
-                        )
-                        
-                        if not scene_text:
-                            logger.error(f"Не удалось сгенерировать сцену {chapter['number']}/{scene['number']}")
-                            continue
-                            
-                        # Получаем текст из LLMResponse
-                        scene_text = scene_text.content
-                        
-                        print("\n📄 Сгенерированный текст:")
-                        print("=" * 80)
-                        print(scene_text)
-                        print("=" * 80)
-                        
-                        # Сохраняем первичный текст
-                        await self.set_artefact(
-                            agent,
-                            f"chapter{chapter['number']}/scene{scene['number']}",
-                            scene_text,
-                            prompt
-                        )
-                        version = 1
+                        all_done = all_done and done
                     
-                    # Если версий меньше чем нужно итераций - продолжаем редактировать
-                    if version <= self.iterations:
-                        # Получаем последнюю версию текста
-                        current_text = await self.get_artefact(agent, f"chapter{chapter['number']}/scene{scene['number']}")
-                        
-                        # Продолжаем редактирование с текущей версии
-                        for i in range(version - 1, self.iterations):
-                            print(f"📝 Итерация редактирования {i+1}/{self.iterations}...")
-                            
-                            prompt = self.load_prompt("editing.jinja2",
-                                params={
-                                    'text': current_text,
-                                    'scene': scene,
-                                    'chapter': chapter,
-                                    'characters': characters,
-                                    'prev_scene_text': prev_scene_text,
-                                    'prev_scene_info': prev_scene_info,
-                                    'iteration': i+1
-                                }
-                            )
-                            
-                            messages = [{"role": "user", "content": prompt}]
-                            edited_text = await self.show_spinner(
-                                f"Редактирование (итерация {i+1}/{self.iterations})",
-                                llm.generate_response(
-                                    messages
-                                )
-                            )
-                            
-                            if not edited_text:
-                                logger.error(f"Не удалось отредактировать сцену {chapter['number']}/{scene['number']} на итерации {i+1}")
-                                continue
-                                
-                            # Получаем текст из LLMResponse
-                            edited_text = edited_text.content
-                            
-                            print(f"\n📄 Текст после редактирования (итерация {i+1}):")
-                            print("=" * 80)
-                            print(edited_text)
-                            print("=" * 80)
-                            
-                            current_text = edited_text
-                            
-                            # Сохраняем новую версию текста
-                            await self.set_artefact(
-                                agent,
-                                f"chapter{chapter['number']}/scene{scene['number']}",
-                                edited_text,
-                                prompt
-                            )
-                        
-                        print(f"✅ Сцена {chapter['number']}/{scene['number']} завершена")
-                    else:
-                        print(f"✓ Сцена {chapter['number']}/{scene['number']} уже отредактирована {version-1} раз(а), пропускаем")
+                    # Итоги сцены переходят в состояние ее персонажей
+                    context['ledger'].update(scene_key, scene)
+                    if status != COMPLETE:
+                        await self.set_artefact(agent, "character_ledger", context['ledger'].to_dict())
+                    
+                    self.publish(agent, SCENE_DONE, **progress)
             
-            return True
+            return self.finish_scenes(manifest, story, all_done)
             
+        except GenerationCancelled:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при генерации сцен: {str(e)}")
-            return False 
\ No newline at end of file
+            return False
+            
+    def finish_scenes(self, manifest, story: StoryModel, all_done: bool) -> bool:
+        """Записывает сводный хэш сцен, если все сцены готовы"""
+        # Сводный хэш сцен — вход этапа сборки книги
+        scenes_hash = manifest.inputs_hash(scene_ref.key for scene_ref in story.scenes)
+        if all_done and scenes_hash:
+            manifest.outputs['scenes'] = scenes_hash
+            manifest.save()
+        
+        # Если какая-то сцена не получилась, этап не считается выполненным,
+        # и следующий запуск продолжит с нее
+        return all_done
+        
+    async def process_queued(self, agent, llm, context: Dict[str, Any]) -> bool:
+        """
+        Генерирует сцены книги через очередь задач
+        
+        Каждая незавершенная сцена становится задачей, зависящей от задачи
+        предыдущей сцены (в промпт входит ее текст). Задачи выполняет и этот
+        процесс, и воркеры --worker, делящие с ним директорию данных;
+        пока готовых задач книги нет, процесс ждет их выполнения другими.
+        """
+        story = context['story']
+        book_id = agent.current_project.id
+        manifest = self.get_manifest(agent)
+        # Воркеры прошлых запусков могли продвинуться дальше, чем знает этот процесс
+        manifest.load()
+        
+        pending = {}
+        previous_task = None
+        for scene_ref in story.scenes:
+            _, status = self.scene_status(manifest, scene_ref)
+            task_key = f"book{book_id}/{scene_ref.key}"
+            if status == COMPLETE:
+                previous_task = None
+                continue
+            # Выполненная в очереди, но не готовая по манифесту сцена устарела
+            await asyncio.to_thread(
+                self.queue.enqueue, task_key, SCENE_TASK, book_id,
+                {'chapter': scene_ref.chapter.number, 'scene': scene_ref.number},
+                depends_on=previous_task, reset=True
+            )
+            pending[task_key] = scene_ref
+            previous_task = task_key
+        
+        if pending:
+            print(f"📬 Сцен в очереди задач: {len(pending)} (их могут выполнять воркеры --worker)")
+        
+        owner = worker_id()
+        finished = set()
+        all_done = True
+        while pending.keys() - finished:
+            await self.checkpoint(agent)
+            task = await asyncio.to_thread(self.queue.claim, owner, LEASE_SECONDS, book_id)
+            if task is not None:
+                await run_leased(self.queue, task, owner, lambda: self.run_scene_task(agent, llm, task.payload))
+            
+            states = {item['key']: item for item in await asyncio.to_thread(self.queue.book_tasks, book_id)}
+            for task_key, scene_ref in pending.items():
+                state = states.get(task_key, {})
+                if task_key not in finished and state.get('status') == DONE:
+                    finished.add(task_key)
+                    self.publish(agent, SCENE_DONE, **self.scene_progress(story, scene_ref))
+            failed = [key for key in pending if states.get(key, {}).get('status') == FAILED]
+            if failed:
+                # Зависящие от проваленной сцены задачи не будут выданы; повторный запуск вернет их в очередь
+                logger.error(f"Сцена {failed[0]} не выполнена: {states[failed[0]].get('error')}")
+                all_done = False
+                break
+            if task is None and pending.keys() - finished:
+                await asyncio.sleep(QUEUE_POLL_INTERVAL)
+        
+        # Сцены и расход могли записать другие процессы
+        manifest.load()
+        BookUsage.for_book(book_id).load()
+        ledger = context['ledger']
+        for scene_ref in story.scenes:
+            ledger.update(scene_ref.key, scene_ref.data)
+        if pending:
+            await self.set_artefact(agent, "character_ledger", ledger.to_dict())
+        
+        all_done = all_done and all(
+            self.scene_status(manifest, scene_ref)[1] == COMPLETE for scene_ref in story.scenes
+        )
+        return self.finish_scenes(manifest, story, all_done)
+        
+    async def run_scene_task(self, agent, llm, payload: Dict[str, Any]) -> bool:
+        """
+        Выполняет задачу очереди: генерирует и редактирует одну сцену
+        
+        Args:
+            agent: Представление агента для книги задачи
+            llm: Объект языковой модели
+            payload: Параметры задачи (chapter, scene)
+            
+        Returns:
+            bool: True если сцена полностью готова
+        """
+        # Соседние сцены пишут другие процессы, поэтому артефакты читаем из хранилища
+        agent = copy.copy(agent)
+        agent.book_context = None
+        manifest = self.get_manifest(agent)
+        manifest.load()
+        BookUsage.for_book(agent.current_project.id).load()
+        
+        context = await self.load_context(agent)
+        if context is None:
+            return False
+        story = context['story']
+        scene_ref = story.scene(payload['chapter'], payload['scene'])
+        if scene_ref is None:
+            raise ValueError(f"Сцены {payload['chapter']}/{payload['scene']} нет в структуре книги")
+        
+        # Состояние персонажей к началу сцены выводится из описаний предыдущих сцен
+        for prev_ref in story.scenes[:scene_ref.index]:
+            context['ledger'].update(prev_ref.key, prev_ref.data)
+        if scene_ref.prev:
+            prev_text = await self.read_artefact(agent, scene_ref.prev.key)
+            if prev_text is not None:
+                manifest.record_output(scene_ref.prev.key, prev_text)
+        
+        input_keys, status = self.scene_status(manifest, scene_ref)
+        if status == COMPLETE:
+            return True
+        print(f"\n🎬 Книга {agent.current_project.id}, сцена {scene_ref.chapter.number}/{scene_ref.number} {scene_ref.title}")
+        # У воркера нет родительского интервала книги: book_id задаем явно,
+        # иначе интервалы сцены не попадут в трассу книги
+        with tracer.span("scene", book_id=agent.current_project.id, scene=scene_ref.key, status=status):
+            return await self.process_scene(
+                agent, llm, context, scene_ref.chapter.data, scene_ref.data, status,
+                self.scene_progress(story, scene_ref), input_keys
+            )
+            
+    async def process_scene(self, agent, llm, context: dict, chapter: dict, scene: dict,
+                            status: str, progress: dict, input_keys: List[str]) -> bool:
+        """
+        Генерирует и редактирует одну сцену, продолжая с места остановки
+        
+        Args:
+            agent: Ссылка на агента
+            llm: Объект языковой модели
+            context: Общие артефакты (story, characters, story_outline)
+            chapter: Описание главы
+            scene: Описание сцены
+            status: Состояние сцены по манифесту
+            progress: Поля прогресса для событий
+            input_keys: Ключи артефактов, от которых зависит сцена
+            
+        Returns:
+            bool: True если сцена полностью готова
+        """
+        manifest = self.get_manifest(agent)
+        scene_key = f"chapter{chapter['number']}/scene{scene['number']}"
+        
+        # Определяем, с какого места продолжать
+        if status == STALE:
+            print("♻️ Входные данные сцены изменились, генерируем заново")
+            version = 0
+            edits_done = 0
+        elif status == PARTIAL:
+            # Продолжаем с контрольной точки; текст берем последний сохраненный
+            checkpoint = manifest.unit(scene_key)
+            edits_done = checkpoint.get('edits', 0)
+            version = 1
+        else:
+            # Манифест ничего не знает о сцене — сверяемся с хранилищем
+            version = await self.get_scene_version(agent, chapter['number'], scene['number'])
+            edits_done = max(version - 1, 0)
+            
+        if version > 0 and edits_done >= self.iterations:
+            print(f"✓ Сцена {chapter['number']}/{scene['number']} уже отредактирована {edits_done} раз(а), пропускаем")
+            manifest.mark_complete(scene_key, manifest.inputs_hash(input_keys, chapter['title'], scene), edits=edits_done)
+            manifest.save()
+            return True
+        
+        # Предыдущая сцена нужна и для черновика, и для редактирования
+        prev_scene_text, prev_scene_info = await self.get_previous_scene(
+            agent, 
+            context['story'], 
+            chapter['number'], 
+            scene['number']
+        )
+        inputs_hash = manifest.inputs_hash(input_keys, chapter['title'], scene)
+        
+        # Контекст сцены одинаков для черновика и всех правок и идет сразу
+        # после префикса книги, поэтому тоже попадает в кэш провайдера
+        prompt_params = {
+            'scene': scene,
+            'chapter': chapter,
+            'prev_scene_text': prev_scene_text,
+            'prev_scene_info': prev_scene_info,
+            'target_word_count': self.target_word_count,
+            'story_outline': context['story_outline'],
+            # Снимок состояния до сцены: после нее записи обновятся
+            'cast': copy.deepcopy(context['ledger'].for_cast(scene.get('characters', []))),
+            'book_prompt': context['book_prompt']
+        }
+        
+        # Если версий нет - генерируем с нуля
+        if version == 0:
+            print("✍️ Генерация текста...")
+            
+            task_prompt = self.load_prompt("scene_generation.jinja2",
+                params={
+                    'scene': scene,
+                    'chapter': chapter,
+                    'target_word_count': self.target_word_count
+                }
+            )
+            
+            messages = self.plan_messages(llm, prompt_params, task_prompt)
+            prompt = self.format_prompt(messages)
+            with tracer.span("draft", scene=scene_key, candidates=self.candidates):
+                if self.candidates > 1:
+                    current_text = await self.generate_best_draft(agent, llm, messages, scene)
+                else:
+                    scene_text = await self.generate(
+                        agent,
+                        llm,
+                        messages,
+                        "Генерация текста сцены"
+                    )
+                    # Получаем текст из LLMResponse
+                    current_text = scene_text.content if scene_text else None
+            
+            if not current_text:
+                logger.error(f"Не удалось сгенерировать сцену {chapter['number']}/{scene['number']}")
+                return False
+            
+            print("\n📄 Сгенерированный текст:")
+            print("=" * 80)
+            print(current_text)
+            print("=" * 80)
+            
+            # Сохраняем первичный текст
+            if not await self.set_artefact(agent, scene_key, current_text, prompt):
+                return False
+            # Контрольная точка: число правок и хэш текущего текста сцены
+            manifest.update_unit(scene_key, inputs_hash, edits=0, text=content_hash(current_text))
+            manifest.save()
+            self.publish(agent, SCENE_DRAFTED, **progress)
+            edits_done = 0
+        else:
+            # Получаем последнюю версию текста
+            current_text = await self.get_artefact(agent, scene_key)
+            if current_text is None:
+                logger.error(f"Не найден текст сцены {chapter['number']}/{scene['number']}")
+                return False
+            # Итерация могла сохраниться в хранилище, но не попасть в контрольную точку
+            # (остановка между записями) — засчитываем ее, а не оплачиваем повторно
+            if status == PARTIAL and checkpoint.get('text') not in (None, content_hash(current_text)):
+                edits_done += 1
+                print(f"↪️ Найдена несохраненная в манифесте итерация, продолжаем с {edits_done + 1}")
+                manifest.update_unit(scene_key, inputs_hash, edits=edits_done, text=content_hash(current_text))
+                manifest.save()
+        
+        # Продолжаем редактирование с текущей версии
+        edits_total = self.iterations
+        for i in range(edits_done, self.iterations):
+            print(f"📝 Итерация редактирования {i+1}/{self.iterations}...")
+            
+            with tracer.span("edit", scene=scene_key, iteration=i+1):
+                if self.chunk_words and len(clean_editor_notes(current_text).split()) > self.chunk_words * 1.5:
+                    # Длинную сцену редактируем частями параллельно
+                    edited_text, prompt = await self.edit_in_chunks(
+                        agent, llm, prompt_params, current_text, i+1
+                    )
+                else:
+                    task_prompt = self.load_prompt("editing.jinja2",
+                        params={
+                            'text': current_text,
+                            'scene': scene,
+                            'chapter': chapter,
+                            'iteration': i+1
+                        }
+                    )
+                    
+                    messages = self.plan_messages(llm, prompt_params, task_prompt)
+                    prompt = self.format_prompt(messages)
+                    response = await self.generate(
+                        agent,
+                        llm,
+                        messages,
+                        f"Редактирование (итерация {i+1}/{self.iterations})"
+                    )
+                    # Получаем текст из LLMResponse
+                    edited_text = response.content if response else None
+            
+            if not edited_text:
+                # Сцена остается незавершенной и продолжится с этой итерации
+                logger.error(f"Не удалось отредактировать сцену {chapter['number']}/{scene['number']} на итерации {i+1}")
+                return False
+            
+            print(f"\n📄 Текст после редактирования (итерация {i+1}):")
+            print("=" * 80)
+            print(edited_text)
+            print("=" * 80)
+            
+            previous_text = current_text
+            current_text = edited_text
+            
+            # Сохраняем новую версию текста
+            if not await self.set_artefact(agent, scene_key, edited_text, prompt):
+                return False
+            manifest.update_unit(scene_key, inputs_hash, edits=i+1, text=content_hash(current_text))
+            manifest.save()
+            self.publish(agent, SCENE_EDITED, iteration=i+1, iterations=self.iterations, **progress)
+            
+            # Устоявшийся текст дальше не редактируем
+            if self.adaptive and i + 1 >= self.min_iterations and i + 1 < self.iterations:
+                converged, change = self.has_converged(previous_text, current_text)
+                if converged:
+                    edits_total = i + 1
+                    skipped = self.iterations - edits_total
+                    print(f"🎯 Итерация изменила {change:.1%} слов, пропускаем оставшиеся итерации: {skipped}")
+                    self.record_metric(agent, "edits_skipped", skipped)
+                    break
+        
+        manifest.mark_complete(scene_key, inputs_hash, edits=edits_total)
+        manifest.save()
+        print(f"✅ Сцена {chapter['number']}/{scene['number']} завершена")
+        return True
+        
+    async def generate_best_draft(self, agent, llm, messages: list, scene: dict) -> Optional[str]:
+        """
+        Генерирует несколько черновиков параллельно и выбирает лучший
+        
+        Черновики оцениваются локально: объем относительно целевого,
+        присутствие персонажей сцены и повторы
+        
+        Args:
+            agent: Ссылка на агента
+            llm: Объект языковой модели
+            messages: Сообщения для LLM
+            scene: Описание сцены
+            
+        Returns:
+            Optional[str]: Текст лучшего черновика или None, если ни один не получен
+        """
+        async def draft_all():
+            return await asyncio.gather(
+                *(self.generate(agent, llm, messages, None) for _ in range(self.candidates)),
+                return_exceptions=True
+            )
+            
+        results = await self.show_spinner(f"Генерация {self.candidates} вариантов сцены", draft_all())
+        
+        drafts = []
+        for result in results:
+            # Остановка (в том числе по бюджету) прерывает этап, а не пропускает вариант
+            if isinstance(result, (GenerationCancelled, asyncio.CancelledError)):
+                raise result
+            if isinstance(result, Exception):
+                logger.warning(f"Не удалось получить вариант сцены: {result}")
+                continue
+            if result and result.content:
+                drafts.append(result.content)
+        if not drafts:
+            return None
+            
+        scored = [
+            (score_scene(text, self.target_word_count, scene.get('characters', [])), text)
+            for text in drafts
+        ]
+        best = max(range(len(scored)), key=lambda i: scored[i][0]['score'])
+        print(f"🎯 Варианты сцены (целевой объем {self.target_word_count} слов):")
+        for i, (metrics, _) in enumerate(scored):
+            marker = "👉" if i == best else "  "
+            print(f"{marker} {i+1}. оценка {metrics['score']:.2f}: {metrics['word_count']} слов, "
+                  f"персонажи {metrics['characters']:.0%}, повторы {metrics['repetition']:.0%}")
+        return scored[best][1]
+        
+    async def edit_in_chunks(self, agent, llm, prompt_params: Dict[str, Any], text: str,
+                             iteration: int) -> tuple[Optional[str], str]:
+        """
+        Редактирует сцену частями параллельно
+        
+        Сцена делится на части по границам абзацев; каждая часть получает
+        соседние абзацы как контекст, который не редактируется. Время правки
+        ограничено самой длинной частью, а не всей сценой.
+        
+        Args:
+            agent: Ссылка на агента
+            llm: Объект языковой модели
+            prompt_params: Параметры контекста сцены
+            text: Текущий текст сцены
+            iteration: Номер итерации редактирования
+            
+        Returns:
+            tuple[Optional[str], str]: (отредактированный текст или None, если
+                какая-то часть не получена; промпты частей)
+        """
+        chunks = group_paragraphs(split_paragraphs(clean_editor_notes(text)), self.chunk_words)
+        neighbours = [
+            (chunks[i - 1][-1] if i > 0 else None, chunks[i + 1][0] if i + 1 < len(chunks) else None)
+            for i in range(len(chunks))
+        ]
+        requests = []
+        for i, (chunk, (before, after)) in enumerate(zip(chunks, neighbours)):
+            task_prompt = self.load_prompt("editing_chunk.jinja2",
+                params={
+                    'text': "\n\n".join(chunk),
+                    'before': before,
+                    'after': after,
+                    'part': i + 1,
+                    'parts': len(chunks),
+                    'iteration': iteration
+                }
+            )
+            requests.append(self.plan_messages(llm, prompt_params, task_prompt))
+            
+        async def edit_all():
+            return await asyncio.gather(
+                *(self.generate(agent, llm, messages, None) for messages in requests),
+                return_exceptions=True
+            )
+            
+        results = await self.show_spinner(
+            f"Редактирование {len(chunks)} частей (итерация {iteration}/{self.iterations})", edit_all()
+        )
+        prompt = "\n\n---\n\n".join(self.format_prompt(messages) for messages in requests)
+        
+        edited_chunks = []
+        for i, result in enumerate(results):
+            if isinstance(result, (GenerationCancelled, asyncio.CancelledError)):
+                raise result
+            if isinstance(result, Exception) or not result or not result.content:
+                logger.error(f"Не удалось отредактировать часть {i+1}/{len(chunks)}: {result}")
+                return None, prompt
+            edited_chunks.append(self.smooth_chunk(result.content, chunks[i], *neighbours[i]))
+        return "\n\n".join(edited_chunks), prompt
+        
+    @staticmethod
+    def smooth_chunk(edited: str, original: List[str], before: Optional[str], after: Optional[str]) -> str:
+        """
+        Проверяет стык отредактированной части с соседними
+        
+        Модель иногда повторяет абзацы контекста — их убираем. Часть, объем
+        которой изменился слишком сильно (часть текста потеряна или дописано лишнее),
+        заменяется исходной.
+        
+        Args:
+            edited: Ответ модели для части
+            original: Исходные абзацы части
+            before: Последний абзац предыдущей части (контекст)
+            after: Первый абзац следующей части (контекст)
+            
+        Returns:
+            str: Текст части для склейки
+        """
+        paragraphs = split_paragraphs(clean_editor_notes(edited))
+        if before and len(paragraphs) > 1 and change_ratio(paragraphs[0], before, limit=0.2) < 0.2:
+            paragraphs = paragraphs[1:]
+        if after and len(paragraphs) > 1 and change_ratio(paragraphs[-1], after, limit=0.2) < 0.2:
+            paragraphs = paragraphs[:-1]
+        
+        original_words = sum(len(paragraph.split()) for paragraph in original)
+        edited_words = sum(len(paragraph.split()) for paragraph in paragraphs)
+        if not paragraphs or not 0.5 <= edited_words / max(original_words, 1) <= 2:
+            logger.warning(f"Часть сцены после правки: {edited_words} слов вместо {original_words}, оставляем исходную")
+            paragraphs = original
+        return "\n\n".join(paragraphs)
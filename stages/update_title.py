@@ -10,6 +10,11 @@ class UpdateProjectTitleStage(GorkyStage):
     def __init__(self):
         super().__init__()
         self.stage_name = "Обновление названия"
+        self.required_artifacts = ["title"]
+        
+    @property
+    def unit_name(self) -> str:
+        return "project_title"
         
     async def process(self, prev_result, llm, agent):
         """Обновляет название проекта сгенерированным заголовком"""
@@ -0,0 +1,6 @@
+# Вспомогательные модули Gorky AI.
+# Модули импортируются напрямую (utils.diff и т.д.), чтобы не тянуть лишнее при старте.
+import os
+
+# Директория с данными (индексы, манифесты, отчеты)
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable
+
+logger = logging.getLogger(__name__)
+
+Loader = Callable[[str], Awaitable[Any]]
+
+
+class BookContext:
+    """
+    Артефакты книги, общие для всех этапов одного запуска пайплайна
+
+    Каждый артефакт читается из хранилища и разбирается не больше одного
+    раза; одновременные запросы одного ключа ждут общее чтение. Этап может
+    заранее запустить чтение артефактов следующих этапов в фоне, пока сам
+    ждет ответа LLM. Сохраненные этапами артефакты обновляются на месте.
+    """
+
+    def __init__(self, book_id: Any):
+        self.book_id = book_id
+        self._values: Dict[str, Any] = {}
+        self._parsed: Dict[str, Any] = {}
+        self._loading: Dict[str, asyncio.Task] = {}
+
+    async def get(self, key: str, load: Loader) -> Any:
+        """
+        Возвращает значение артефакта, читая его при первом обращении
+
+        Args:
+            key: Ключ артефакта
+            load: Чтение артефакта из хранилища по ключу
+
+        Returns:
+            Any: Значение артефакта или None, если его еще нет
+        """
+        if key in self._values:
+            return self._values[key]
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.ensure_future(self._load(key, load))
+        # Отмена ожидающего этапа не должна прерывать общее чтение
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str, load: Loader) -> Any:
+        try:
+            value = await load(key)
+            # Отсутствующий артефакт не запоминаем: его может создать следующий этап
+            if value is not None and key not in self._values:
+                self._values[key] = value
+            return self._values.get(key, value)
+        finally:
+            self._loading.pop(key, None)
+
+    async def get_parsed(self, key: str, load: Loader) -> Any:
+        """Значение артефакта с JSON-строкой, разобранной один раз"""
+        if key in self._parsed:
+            return self._parsed[key]
+        value = await self.get(key, load)
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                pass
+        if value is not None and key in self._values:
+            self._parsed[key] = value
+        return value
+
+    def prefetch(self, keys: Iterable[str], load: Loader) -> None:
+        """Запускает фоновое чтение еще не загруженных артефактов"""
+        for key in keys:
+            if key not in self._values and key not in self._loading:
+                task = self._loading[key] = asyncio.ensure_future(self._load(key, load))
+                # Ошибка фонового чтения повторится при обычном обращении
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def update(self, key: str, value: Any) -> None:
+        """Запоминает артефакт, сохраненный этапом"""
+        self._values[key] = value
+        self._parsed.pop(key, None)
+
+    def close(self) -> None:
+        """Отменяет незавершенные фоновые чтения"""
+        for task in list(self._loading.values()):
+            task.cancel()
+        self._loading.clear()
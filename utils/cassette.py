@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from utils.usage import usage_to_dict
+
+logger = logging.getLogger(__name__)
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+class CassetteMiss(LookupError):
+    """В кассете нет ответа на запрос (строгий режим воспроизведения)"""
+
+
+class CassetteResponse:
+    """Ответ LLM, восстановленный из кассеты"""
+
+    def __init__(self, content: Optional[str], usage: Optional[Dict[str, Any]] = None,
+                 llm_attempts: Optional[List[Dict[str, Any]]] = None):
+        self.content = content
+        self.usage = usage
+        # Запросы к провайдерам, как их записал HedgedLLM (None — запрос без резервирования)
+        self.llm_attempts = llm_attempts
+
+
+def request_key(messages: List[Dict[str, Any]], **kwargs) -> str:
+    """Хэш запроса к LLM: сообщения и параметры генерации"""
+    payload = json.dumps({"messages": messages, "kwargs": kwargs},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CassetteLLM:
+    """
+    Запись и воспроизведение запросов к LLM
+
+    В режиме записи каждая пара запрос/ответ дописывается строкой в
+    JSONL-файл кассеты. В режиме воспроизведения ответы выдаются по хэшу
+    запроса без обращения к сети; одинаковые запросы (например, несколько
+    черновиков сцены) получают записанные ответы по порядку. Запрос,
+    которого нет в кассете, — ошибка CassetteMiss.
+    """
+
+    def __init__(self, path: str, mode: str, llm=None):
+        """
+        Args:
+            path: Путь к файлу кассеты
+            mode: RECORD или REPLAY
+            llm: Настоящая LLM (нужна только для записи)
+        """
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Неизвестный режим кассеты: {mode}")
+        if mode == RECORD and llm is None:
+            raise ValueError("Для записи кассеты нужна LLM")
+        self.path = path
+        self.mode = mode
+        self.llm = llm
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._responses: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._served: Dict[str, int] = defaultdict(int)
+        if mode == REPLAY:
+            self._load()
+            # Основная модель записи; в старых кассетах есть только модель ответа
+            models = {entry.get("primary", entry.get("model"))
+                      for entries in self._responses.values() for entry in entries}
+            models.discard(None)
+            self.provider = SimpleNamespace(
+                name="cassette",
+                model=models.pop() if len(models) == 1 else "replay"
+            )
+
+    def _load(self) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Последняя строка могла не дописаться при аварийной остановке записи
+                    logger.warning(f"Кассета {self.path}: пропущена поврежденная строка {line_no}")
+                    continue
+                self._responses[entry["key"]].append(entry)
+        logger.info(f"Кассета {self.path}: {sum(map(len, self._responses.values()))} ответов")
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Одна запись на строку в режиме дозаписи: процессы пакетной
+            # генерации могут писать в одну кассету
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    async def generate_response(self, messages, **kwargs):
+        key = request_key(messages, **kwargs)
+        if self.mode == REPLAY:
+            return self._replay(key, messages)
+
+        response = await self.llm.generate_response(messages, **kwargs)
+        primary = getattr(getattr(self.llm, "provider", None), "model", None)
+        # Ответить мог резервный провайдер: сохраняем модель ответа и все оплаченные запросы
+        attempts = getattr(response, "llm_attempts", None) or None
+        model = next((attempt["model"] for attempt in attempts or [] if attempt.get("won")), None) or primary
+        try:
+            self._append({
+                "key": key,
+                "model": model,
+                "primary": primary,
+                "content": getattr(response, "content", None),
+                "usage": usage_to_dict(getattr(response, "usage", None)) or None,
+                "attempts": attempts,
+            })
+        except OSError as e:
+            logger.error(f"Не удалось записать ответ в кассету {self.path}: {e}")
+        return response
+
+    def _replay(self, key: str, messages) -> CassetteResponse:
+        entries = self._responses.get(key)
+        if not entries:
+            preview = str(messages[-1].get("content", ""))[:200] if messages else ""
+            raise CassetteMiss(f"Запроса {key[:12]} нет в кассете {self.path}: {preview!r}")
+        with self._lock:
+            index = self._served[key]
+            self._served[key] = index + 1
+        # Повторных запросов больше, чем записано, — отдаем последний ответ
+        entry = entries[min(index, len(entries) - 1)]
+        self.hits += 1
+        return CassetteResponse(entry.get("content"), entry.get("usage"), entry.get("attempts"))
+
+    def __getattr__(self, name: str) -> Any:
+        llm = self.__dict__.get("llm")
+        if llm is None:
+            raise AttributeError(name)
+        return getattr(llm, name)
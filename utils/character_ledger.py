@@ -0,0 +1,102 @@
+import json
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+from utils.text_metrics import name_stem, words
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних изменений персонажа помнить
+MAX_CHANGES = 3
+
+
+class CharacterLedger:
+    """
+    Состояние персонажей книги по ходу сюжета
+
+    Строится один раз из артефакта characters и обновляется после каждой
+    сцены: где персонаж находится, когда, в какой сцене был последний раз
+    и что с ним произошло. Поиск по имени идет через индекс основ имен,
+    поэтому «Анна» из описания сцены находит «Анна Петрова».
+    """
+
+    def __init__(self, entries: Dict[str, Dict[str, Any]]):
+        self.entries = entries
+        self._index: Dict[str, List[str]] = {}
+        for name in entries:
+            for stem in self._stems(name):
+                self._index.setdefault(stem, []).append(name)
+
+    @staticmethod
+    def _stems(name: str) -> List[str]:
+        return [name_stem(part) for part in words(name) if len(part) > 2]
+
+    @classmethod
+    def from_characters(cls, characters: Any) -> "CharacterLedger":
+        """
+        Args:
+            characters: Артефакт characters (словарь со списком characters или JSON-строка)
+        """
+        if isinstance(characters, str):
+            try:
+                characters = json.loads(characters)
+            except json.JSONDecodeError:
+                characters = {}
+        profiles = characters.get("characters", []) if isinstance(characters, dict) else []
+        entries = {}
+        for profile in profiles:
+            if isinstance(profile, dict) and profile.get("name"):
+                entries[str(profile["name"])] = {"name": str(profile["name"]), "profile": profile, "state": {}}
+        return cls(entries)
+
+    def find(self, name: str) -> Optional[Dict[str, Any]]:
+        """Запись персонажа по имени из описания сцены (None, если он не описан)"""
+        if name in self.entries:
+            return self.entries[name]
+        for stem in self._stems(name):
+            for candidate in self._index.get(stem, []):
+                return self.entries[candidate]
+        # Основы не совпали точно (другой падеж) — ближайшая основа с общим префиксом
+        best, best_distance = None, None
+        for stem in self._stems(name):
+            for indexed, candidates in self._index.items():
+                if indexed.startswith(stem) or stem.startswith(indexed):
+                    distance = abs(len(indexed) - len(stem))
+                    if best_distance is None or distance < best_distance:
+                        best, best_distance = candidates[0], distance
+        return self.entries[best] if best else None
+
+    def for_cast(self, cast: Iterable[str]) -> List[Dict[str, Any]]:
+        """Записи действующих лиц сцены без повторов"""
+        result = []
+        for name in cast:
+            entry = self.find(name) if isinstance(name, str) else None
+            if entry is not None and entry not in result:
+                result.append(entry)
+        return result
+
+    def update(self, scene_key: str, scene: Dict[str, Any]) -> None:
+        """
+        Отмечает итоги сцены у ее действующих лиц
+
+        Args:
+            scene_key: Ключ сцены (chapterN/sceneM)
+            scene: Описание сцены из story_structure
+        """
+        # closing в story_structure — словарь {action, transition_type, next_scene_lead}
+        closing = scene.get("closing")
+        if isinstance(closing, dict):
+            closing = closing.get("action")
+        event = closing or scene.get("description")
+        for entry in self.for_cast(scene.get("characters", [])):
+            state = entry["state"]
+            state["location"] = scene.get("location")
+            state["time"] = scene.get("time")
+            state["last_scene"] = scene_key
+            if event:
+                changes = state.setdefault("changes", [])
+                changes.append(f"{scene.get('title', scene_key)}: {event}")
+                del changes[:-MAX_CHANGES]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"characters": list(self.entries.values())}
@@ -0,0 +1,64 @@
+import asyncio
+import contextvars
+import sys
+import threading
+from typing import Optional
+
+# True внутри фоновых задач: их вывод не должен перерисовывать строку ввода
+background = contextvars.ContextVar("background", default=False)
+
+
+class ConsoleInput:
+    """
+    Асинхронное чтение строк из консоли
+
+    Строки читает отдельный поток-демон и передает в очередь цикла событий,
+    поэтому ожидание ввода не блокирует цикл, а выход из программы не ждет
+    нажатия Enter. Все чтения (команды, вопросы опросника) идут через один
+    поток, чтобы не конкурировать за stdin.
+    """
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def _start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+
+        def reader():
+            while True:
+                line = sys.stdin.readline()
+                try:
+                    loop.call_soon_threadsafe(self._queue.put_nowait, line if line else None)
+                except RuntimeError:
+                    # Цикл событий уже закрыт
+                    return
+                if not line:
+                    return
+
+        self._thread = threading.Thread(target=reader, name="console-input", daemon=True)
+        self._thread.start()
+
+    async def readline(self, prompt: str = "") -> str:
+        """
+        Выводит приглашение и ожидает строку ввода
+
+        Raises:
+            EOFError: Если ввод закрыт
+        """
+        if self._thread is None:
+            self._start()
+        print(prompt, end="", flush=True)
+        line = await self._queue.get()
+        if line is None:
+            raise EOFError
+        return line.rstrip("\n")
+
+
+console = ConsoleInput()
+
+
+async def ainput(prompt: str = "") -> str:
+    """Асинхронный аналог input()"""
+    return await console.readline(prompt)
@@ -0,0 +1,215 @@
+import re
+from typing import List, Optional, Sequence, Tuple
+
+# Слово вместе с последующими пробелами — так склейка операций
+# восстанавливает исходный текст без потерь
+WORD_PATTERN = re.compile(r"\s+|\S+\s*")
+
+EQUAL = "equal"
+INSERT = "insert"
+DELETE = "delete"
+
+
+def tokenize_words(text: str) -> List[str]:
+    """
+    Разбивает текст на слова с сохранением пробельных символов
+
+    Args:
+        text: Исходный текст
+
+    Returns:
+        List[str]: Список токенов, конкатенация которых равна исходному тексту
+    """
+    if not text:
+        return []
+    return WORD_PATTERN.findall(text)
+
+
+def _bisect(a: Sequence[str], a_lo: int, a_hi: int,
+            b: Sequence[str], b_lo: int, b_hi: int, limit: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Находит «среднюю змейку» алгоритма Майерса в линейной памяти
+
+    Args:
+        limit: Наибольшее число шагов d в каждом направлении (None — без ограничения)
+
+    Returns:
+        Tuple[int, int]: Точка разбиения (x, y) относительно начала диапазонов
+        или (-1, -1), если общих токенов нет или змейка не найдена за limit шагов
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    max_d = (n + m + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d + 2
+    v1 = [-1] * v_length
+    v2 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2[v_offset + 1] = 0
+    delta = n - m
+    # Если разница длин нечетная, встреча произойдет на прямом проходе
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+
+    for d in range(max_d if limit is None else min(max_d, limit)):
+        # Прямой проход
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[a_lo + x1] == b[b_lo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
+                    if x1 >= n - v2[k2_offset]:
+                        return x1, y1
+
+        # Обратный проход
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[a_hi - x2 - 1] == b[b_hi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    y1 = v_offset + x1 - k1_offset
+                    if x1 >= n - x2:
+                        return x1, y1
+
+    return -1, -1
+
+
+def _diff_range(a: Sequence[str], a_lo: int, a_hi: int,
+                b: Sequence[str], b_lo: int, b_hi: int,
+                ops: List[Tuple[str, str]], limit: Optional[int] = None) -> None:
+    """Рекурсивно сравнивает диапазоны токенов и дописывает операции в ops"""
+    # Общий префикс
+    prefix_end = a_lo
+    while prefix_end < a_hi and b_lo < b_hi and a[prefix_end] == b[b_lo]:
+        ops.append((EQUAL, a[prefix_end]))
+        prefix_end += 1
+        b_lo += 1
+    a_lo = prefix_end
+
+    # Общий суффикс откладываем до конца
+    suffix_len = 0
+    while a_lo < a_hi - suffix_len and b_lo < b_hi - suffix_len \
+            and a[a_hi - suffix_len - 1] == b[b_hi - suffix_len - 1]:
+        suffix_len += 1
+    a_hi -= suffix_len
+    b_hi -= suffix_len
+
+    if a_lo == a_hi:
+        ops.extend((INSERT, token) for token in b[b_lo:b_hi])
+    elif b_lo == b_hi:
+        ops.extend((DELETE, token) for token in a[a_lo:a_hi])
+    else:
+        x, y = _bisect(a, a_lo, a_hi, b, b_lo, b_hi, limit)
+        if x < 0:
+            # Общих токенов нет или диапазон переписан слишком сильно: заменяем целиком
+            ops.extend((DELETE, token) for token in a[a_lo:a_hi])
+            ops.extend((INSERT, token) for token in b[b_lo:b_hi])
+        else:
+            _diff_range(a, a_lo, a_lo + x, b, b_lo, b_lo + y, ops, limit)
+            _diff_range(a, a_lo + x, a_hi, b, b_lo + y, b_hi, ops, limit)
+
+    ops.extend((EQUAL, token) for token in a[a_hi:a_hi + suffix_len])
+
+
+def diff_tokens(a: Sequence[str], b: Sequence[str], max_edits: Optional[int] = None) -> List[Tuple[str, str]]:
+    """
+    Сравнивает две последовательности токенов (алгоритм Майерса, линейная память)
+
+    Время O((N + M) · D), где D — число вставленных и удаленных токенов.
+    С max_edits поиск ограничен O((N + M) · max_edits): если диапазон
+    отличается больше чем на max_edits токенов, он заменяется целиком.
+    Пока D не больше max_edits, результат точный.
+
+    Args:
+        a: Исходные токены
+        b: Новые токены
+        max_edits: Предел расстояния редактирования (None — без ограничения)
+
+    Returns:
+        List[Tuple[str, str]]: Операции (equal/insert/delete, токен)
+    """
+    ops: List[Tuple[str, str]] = []
+    # Средняя змейка диапазона с расстоянием D находится не дальше ceil(D / 2) шагов
+    limit = None if max_edits is None else (max_edits + 1) // 2 + 1
+    _diff_range(a, 0, len(a), b, 0, len(b), ops, limit)
+    return ops
+
+
+def word_diff(text1: str, text2: str, max_edits: Optional[int] = None) -> List[List[str]]:
+    """
+    Пословное сравнение двух текстов
+
+    Args:
+        text1: Исходный текст
+        text2: Новый текст
+        max_edits: Предел расстояния редактирования в словах; сильнее
+            переписанные фрагменты показываются заменой целиком
+
+    Returns:
+        List[List[str]]: Список [операция, фрагмент], соседние одинаковые
+        операции склеены
+    """
+    result: List[List[str]] = []
+    for op, token in diff_tokens(tokenize_words(text1 or ""), tokenize_words(text2 or ""), max_edits):
+        if result and result[-1][0] == op:
+            result[-1][1] += token
+        else:
+            result.append([op, token])
+    return result
+
+
+def change_ratio(text1: str, text2: str, limit: Optional[float] = None) -> float:
+    """
+    Нормированное пословное расстояние редактирования между текстами
+
+    Args:
+        text1: Первый текст
+        text2: Второй текст
+        limit: Порог, с которым сравнивается результат. Если доля изменений
+            не меньше порога, точное значение не вычисляется: возвращается
+            оценка сверху, тоже не меньшая порога. Ниже порога результат точный
+
+    Returns:
+        float: Доля вставленных и удаленных слов от общего числа слов
+        обоих текстов: 0 — тексты совпадают, 1 — общих слов нет
+    """
+    a = (text1 or "").split()
+    b = (text2 or "").split()
+    if not a and not b:
+        return 0.0
+    total = len(a) + len(b)
+    max_edits = None
+    if limit is not None:
+        # Разница длин — нижняя граница расстояния, ее хватает для отказа без диффа
+        if abs(len(a) - len(b)) / total >= limit:
+            return abs(len(a) - len(b)) / total
+        max_edits = int(limit * total) + 1
+    changed = sum(1 for op, _ in diff_tokens(a, b, max_edits) if op != EQUAL)
+    return changed / total
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Размер файла событий, после которого он начинается заново (байты)
+EVENTS_MAX_BYTES = int(os.environ.get("GORKY_EVENTS_MAX_BYTES", 10 * 1024 * 1024))
+
+# Типы событий пайплайна
+STAGE_START = "stage_start"
+STAGE_FINISH = "stage_finish"
+SCENE_DRAFTED = "scene_drafted"
+SCENE_EDITED = "scene_edited"
+SCENE_DONE = "scene_done"
+TOKENS = "tokens"
+ERROR = "error"
+
+
+class Subscription:
+    """
+    Подписка на события шины
+
+    Хранит ограниченную очередь: если клиент не успевает читать,
+    самые старые события отбрасываются
+    """
+
+    def __init__(self, bus: "EventBus", max_events: int, book_id: Optional[str] = None):
+        self.bus = bus
+        self.book_id = book_id
+        self.dropped = 0
+        self._events: Deque[Dict[str, Any]] = deque(maxlen=max_events)
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+
+    def _push(self, event: Dict[str, Any]) -> None:
+        """Кладет событие в очередь (вызывается в цикле подписчика)"""
+        if len(self._events) == self._events.maxlen:
+            self.dropped += 1
+        self._events.append(event)
+        self._ready.set()
+
+    def push(self, event: Dict[str, Any]) -> None:
+        """Потокобезопасно передает событие подписчику"""
+        if self.book_id is not None and str(event.get("book_id")) != self.book_id:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._push, event)
+        except RuntimeError:
+            # Цикл подписчика уже закрыт
+            self.bus.unsubscribe(self)
+
+    async def get(self) -> Dict[str, Any]:
+        """Ожидает и возвращает следующее событие"""
+        while not self._events:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._events.popleft()
+
+    def close(self) -> None:
+        """Отписывается от шины"""
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    """
+    Внутрипроцессная шина событий пайплайна
+
+    Этапы публикуют события синхронно и без ожидания, подписчики
+    (например, SSE-клиенты веб-интерфейса) читают их из своих очередей.
+    Публикация безопасна из любого потока и цикла событий.
+    """
+
+    def __init__(self, max_events: int = 100):
+        self.max_events = max_events
+        self._subscribers: List[Subscription] = []
+        self._lock = threading.Lock()
+        self._sink = None
+        self._max_bytes = EVENTS_MAX_BYTES
+
+    def attach_file(self, path: str, max_bytes: Optional[int] = None) -> None:
+        """
+        Дублирует события в JSONL-файл
+
+        Нужно, когда веб-интерфейс работает в отдельных процессах:
+        они читают файл через follow_file и публикуют события у себя.
+        Читатели видят только новые строки, поэтому файл очищается при
+        подключении и начинается заново, когда превышает max_bytes.
+
+        Args:
+            path: Файл событий
+            max_bytes: Предельный размер файла (по умолчанию GORKY_EVENTS_MAX_BYTES)
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._sink = open(path, "w", encoding="utf-8", buffering=1)
+        self._max_bytes = max_bytes or EVENTS_MAX_BYTES
+
+    def subscribe(self, book_id: Optional[str] = None, max_events: Optional[int] = None) -> Subscription:
+        """
+        Создает подписку в текущем цикле событий
+
+        Args:
+            book_id: Получать события только этой книги
+            max_events: Размер очереди подписчика
+        """
+        subscription = Subscription(self, max_events or self.max_events,
+                                    str(book_id) if book_id is not None else None)
+        with self._lock:
+            self._subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """Удаляет подписку"""
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+
+    def publish(self, event_type: str, book_id: Any = None, **data) -> None:
+        """
+        Публикует событие всем подписчикам
+
+        Args:
+            event_type: Тип события (stage_start, scene_drafted, ...)
+            book_id: ID книги, к которой относится событие
+            **data: Дополнительные поля события
+        """
+        event = {"type": event_type, "book_id": book_id, "time": time.time(), **data}
+        if self._sink:
+            with self._lock:
+                if self._sink.tell() >= self._max_bytes:
+                    self._sink.seek(0)
+                    self._sink.truncate()
+                self._sink.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+        self.dispatch(event)
+
+    def dispatch(self, event: Dict[str, Any]) -> None:
+        """Передает готовое событие подписчикам процесса"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.push(event)
+
+    async def follow_file(self, path: str, poll_interval: float = 0.5) -> None:
+        """
+        Читает события, которые другой процесс пишет в JSONL-файл
+
+        Чтение начинается с конца файла: старые события не повторяются.
+        Если файл стал короче прочитанного (писатель начал его заново),
+        чтение продолжается с начала.
+        """
+        while not os.path.exists(path):
+            await asyncio.sleep(poll_interval)
+        with open(path, "r", encoding="utf-8") as f:
+            f.seek(0, os.SEEK_END)
+            buffer = ""
+            while True:
+                chunk = f.read()
+                if not chunk:
+                    if os.path.getsize(path) < f.tell():
+                        f.seek(0)
+                        buffer = ""
+                        continue
+                    await asyncio.sleep(poll_interval)
+                    continue
+                buffer += chunk
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    try:
+                        self.dispatch(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning(f"Некорректная строка в файле событий: {line[:100]}")
+
+
+# Общая шина процесса
+event_bus = EventBus()
@@ -0,0 +1,94 @@
+import logging
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Бюджет импорта точки входа в миллисекундах (медиана нескольких запусков)
+DEFAULT_IMPORT_BUDGET_MS = float(os.environ.get("GORKY_IMPORT_BUDGET_MS", 250))
+
+# Модули, которые не должны загружаться при импорте точки входа:
+# веб-стек, cognistruct с клиентами LLM и модули этапов
+LAZY_MODULES = ("uvicorn", "fastapi", "starlette", "jinja2", "web", "cognistruct", "stages", "commands", "tiktoken")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """Строки вывода -X importtime: (модуль с отступом, собственное время, накопленное время) в мкс"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # заголовок таблицы
+        # После разделителя один пробел, дальше — отступ вложенности
+        entries.append((parts[2][1:].rstrip(), int(parts[0]), int(parts[1])))
+    return entries
+
+
+def measure_import(module: str = "gorky_agent") -> Dict[str, Any]:
+    """
+    Импортирует модуль в чистом процессе под -X importtime
+
+    Args:
+        module: Имя модуля
+
+    Returns:
+        Dict[str, Any]: total_ms — накопленное время импорта модуля,
+            slowest — самые долгие вложенные импорты, modules — загруженные модули
+    """
+    code = f"import sys, {module}; print('\\n'.join(sorted(sys.modules)))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Не удалось импортировать {module}: {result.stderr.strip().splitlines()[-1:]}")
+    entries = _parse_importtime(result.stderr)
+    total = next((cumulative for name, _, cumulative in entries if name == module), 0)
+    # Вложенные импорты модуля идут в выводе перед ним самим
+    own = []
+    for name, _, cumulative in reversed(entries):
+        if name == name.lstrip() and name.strip() != module and own:
+            break
+        own.append((name.strip(), cumulative))
+    return {
+        "total_ms": total / 1000,
+        "slowest": sorted(own[1:], key=lambda item: item[1], reverse=True)[:10],
+        "modules": result.stdout.split(),
+    }
+
+
+def check_import_time(module: str = "gorky_agent", budget_ms: float = DEFAULT_IMPORT_BUDGET_MS,
+                      runs: int = 3) -> Tuple[bool, str]:
+    """
+    Проверяет время импорта точки входа и отсутствие тяжелых модулей
+
+    Args:
+        module: Имя модуля
+        budget_ms: Бюджет в миллисекундах
+        runs: Количество запусков (берется медиана: первый запуск греет кэш ФС)
+
+    Returns:
+        Tuple[bool, str]: (проверка пройдена, отчет)
+    """
+    measurements = [measure_import(module) for _ in range(max(runs, 1))]
+    median = statistics.median(item["total_ms"] for item in measurements)
+    last = measurements[-1]
+    eager = sorted({
+        name for name in last["modules"]
+        if name.split(".")[0] in LAZY_MODULES
+    })
+    ok = median <= budget_ms and not eager
+
+    lines = [f"{'✅' if ok else '❌'} Импорт {module}: {median:.0f} мс (медиана {len(measurements)} запусков, бюджет {budget_ms:.0f} мс)"]
+    for name, cumulative in last["slowest"]:
+        lines.append(f"   {cumulative / 1000:7.1f} мс  {name}")
+    if eager:
+        lines.append(f"❌ При импорте загружены модули, которые должны импортироваться лениво: {', '.join(eager)}")
+    return ok, "\n".join(lines)
@@ -0,0 +1,232 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from utils.console import background
+from utils.events import event_bus, STAGE_START, SCENE_DONE, ERROR
+from utils.run_control import BudgetExceeded, GenerationCancelled, RunControl
+
+logger = logging.getLogger(__name__)
+
+# Состояния фоновой задачи
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+BUDGET = "budget"  # остановлена перед запросом, который превысил бы бюджет книги
+PAUSED = "paused"  # только для отображения: задача выполняется, но стоит на паузе
+
+
+class GenerationJob:
+    """Фоновая задача генерации одной книги"""
+
+    def __init__(self, job_id: int, project, task: asyncio.Task, control: RunControl):
+        self.id = job_id
+        self.book_id = project.id
+        self.book_name = project.name
+        self.task = task
+        self.control = control
+        self.status = RUNNING
+        self.stage: Optional[str] = None
+        self.scene_index = 0
+        self.scene_total = 0
+        self.error: Optional[str] = None
+        self.result: Any = None
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self.status == RUNNING
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.time()) - self.started_at
+
+    def describe(self) -> str:
+        """Строка для списка задач"""
+        icons = {RUNNING: "⏳", PAUSED: "⏸", DONE: "✅", FAILED: "❌", CANCELLED: "⏹", BUDGET: "💰"}
+        status = PAUSED if self.running and self.control.paused else self.status
+        if self.running and self.control.cancel_requested:
+            status = "stopping"
+        line = f"{icons.get(status, '•')} #{self.id}: '{self.book_name}' (ID книги: {self.book_id}) — {status}"
+        if self.stage and self.running:
+            line += f", этап {self.stage}"
+        if self.scene_total:
+            line += f", сцены {self.scene_index}/{self.scene_total}"
+        line += f", {int(self.duration)} с"
+        if self.error:
+            line += f"\n    {self.error}"
+        return line
+
+
+class JobManager:
+    """
+    Менеджер фоновых задач генерации
+
+    Каждая книга генерируется в отдельной задаче asyncio, поэтому
+    командный цикл остается доступным, а несколько книг могут
+    генерироваться одновременно. Текущий этап и прогресс задач
+    обновляются по событиям шины.
+    """
+
+    def __init__(self):
+        self.jobs: Dict[int, GenerationJob] = {}
+        self._ids = itertools.count(1)
+        self._watcher: Optional[asyncio.Task] = None
+
+    def start(self, project, run: Callable[[RunControl], Awaitable[Any]],
+              on_finish: Optional[Callable[[GenerationJob], Awaitable[None]]] = None) -> GenerationJob:
+        """
+        Запускает генерацию книги в фоне
+
+        Args:
+            project: Проект книги
+            run: Функция, принимающая RunControl задачи и возвращающая
+                корутину генерации (результат True/False)
+            on_finish: Корутина, вызываемая после завершения задачи
+
+        Returns:
+            GenerationJob: Созданная задача
+
+        Raises:
+            RuntimeError: Если для этой книги уже идет генерация
+        """
+        if self.running_for(project.id):
+            raise RuntimeError(f"Генерация книги {project.id} уже запущена")
+        self._ensure_watcher()
+
+        job_id = next(self._ids)
+        control = RunControl()
+
+        async def runner():
+            # Фоновые этапы не рисуют спиннер поверх приглашения командной строки
+            background.set(True)
+            job = self.jobs[job_id]
+            try:
+                job.result = await run(control)
+                job.status = DONE if job.result else FAILED
+            except BudgetExceeded as e:
+                job.status = BUDGET
+                job.error = str(e)
+            except GenerationCancelled:
+                job.status = CANCELLED
+            except asyncio.CancelledError:
+                job.status = CANCELLED
+                raise
+            except Exception as e:
+                logger.exception(f"Ошибка в фоновой задаче #{job_id}")
+                job.status = FAILED
+                job.error = str(e)
+            finally:
+                job.finished_at = time.time()
+                if on_finish:
+                    try:
+                        # Отмена не должна прерывать сохранение итогового статуса
+                        await asyncio.shield(on_finish(job))
+                    except Exception as e:
+                        logger.error(f"Ошибка при завершении задачи #{job_id}: {e}")
+
+        task = asyncio.create_task(runner(), name=f"generation-{job_id}")
+        self.jobs[job_id] = GenerationJob(job_id, project, task, control)
+        return self.jobs[job_id]
+
+    def get(self, job_id: int) -> Optional[GenerationJob]:
+        return self.jobs.get(job_id)
+
+    def list(self) -> List[GenerationJob]:
+        return list(self.jobs.values())
+
+    def running(self) -> List[GenerationJob]:
+        return [job for job in self.jobs.values() if job.running]
+
+    def running_for(self, book_id: Any) -> Optional[GenerationJob]:
+        """Возвращает выполняющуюся задачу книги"""
+        for job in self.running():
+            if str(job.book_id) == str(book_id):
+                return job
+        return None
+
+    def _latest_for(self, book_id: Any) -> Optional[GenerationJob]:
+        for job in reversed(list(self.jobs.values())):
+            if str(job.book_id) == str(book_id):
+                return job
+        return None
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        Останавливает задачу в ближайшей точке проверки
+
+        Текущий запрос к LLM доводится до конца и сохраняется
+
+        Returns:
+            bool: True если задача выполнялась
+        """
+        job = self.jobs.get(job_id)
+        if not job or not job.running:
+            return False
+        job.control.cancel()
+        return True
+
+    def pause(self, job_id: int) -> bool:
+        """Приостанавливает задачу перед следующим запросом к LLM"""
+        job = self.jobs.get(job_id)
+        if not job or not job.running:
+            return False
+        job.control.pause()
+        return True
+
+    def resume(self, job_id: int) -> bool:
+        """Продолжает приостановленную задачу"""
+        job = self.jobs.get(job_id)
+        if not job or not job.running:
+            return False
+        job.control.resume()
+        return True
+
+    async def shutdown(self, grace: float = 0) -> None:
+        """
+        Останавливает все задачи и дожидается их завершения
+
+        Args:
+            grace: Сколько секунд ждать мягкой остановки (завершения текущих
+                запросов к LLM), прежде чем отменить задачи принудительно
+        """
+        tasks = [job.task for job in self.running()]
+        if tasks and grace > 0:
+            for job in self.running():
+                job.control.cancel()
+            await asyncio.wait(tasks, timeout=grace)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self._watcher:
+            self._watcher.cancel()
+            self._watcher = None
+
+    def _ensure_watcher(self) -> None:
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self._watch_events(), name="jobs-watcher")
+
+    async def _watch_events(self) -> None:
+        """Обновляет состояние задач по событиям пайплайна"""
+        subscription = event_bus.subscribe(max_events=1000)
+        try:
+            while True:
+                event = await subscription.get()
+                # События дочитываются и после завершения задачи, поэтому берем последнюю задачу книги
+                job = self._latest_for(event.get("book_id"))
+                if not job:
+                    continue
+                if event["type"] == STAGE_START:
+                    job.stage = event.get("stage")
+                elif event["type"] == SCENE_DONE:
+                    job.scene_index = event.get("scene_index", job.scene_index)
+                    job.scene_total = event.get("scene_total", job.scene_total)
+                elif event["type"] == ERROR:
+                    job.error = event.get("message")
+        finally:
+            subscription.close()
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, Optional
+
+from utils.tracing import tracer
+from utils.usage import usage_to_dict
+
+logger = logging.getLogger(__name__)
+
+# Потоки ожидания межпроцессного семафора: ожидание занимает поток целиком,
+# поэтому у него свой пул, а не общий пул цикла событий (файлы, SQLite)
+SEMAPHORE_WAIT_THREADS = 8
+
+
+class ConcurrencyLimitedLLM:
+    """
+    Обертка над LLM, ограничивающая число одновременных запросов
+
+    Семафор может быть межпроцессным (multiprocessing), тогда лимит
+    общий для всех воркеров пакетной генерации. Ожидание семафора
+    выполняется в отдельном небольшом пуле потоков, чтобы не блокировать
+    цикл событий и не занимать потоки его пула по умолчанию; ожидающие
+    сверх размера пула стоят в очереди пула.
+    """
+
+    _executor: Optional[ThreadPoolExecutor] = None
+
+    def __init__(self, llm, semaphore):
+        self.llm = llm
+        self.semaphore = semaphore
+
+    @classmethod
+    def executor(cls) -> ThreadPoolExecutor:
+        """Общий для процесса пул ожидания семафора"""
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(SEMAPHORE_WAIT_THREADS, thread_name_prefix="llm-semaphore")
+        return cls._executor
+
+    async def generate_response(self, *args, **kwargs):
+        acquire = asyncio.get_running_loop().run_in_executor(self.executor(), self.semaphore.acquire)
+        try:
+            await asyncio.shield(acquire)
+        except asyncio.CancelledError:
+            # Поток все равно захватит семафор — освобождаем его сразу после захвата
+            acquire.add_done_callback(
+                lambda f: self.semaphore.release() if not f.cancelled() and not f.exception() else None
+            )
+            raise
+        try:
+            return await self.llm.generate_response(*args, **kwargs)
+        finally:
+            self.semaphore.release()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.llm, name)
+
+
+class ProviderStats:
+    """Задержки и здоровье одного провайдера LLM"""
+
+    def __init__(self, window: int = 100, failure_threshold: int = 3, cooldown: float = 60.0):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.hedges_won = 0
+        self.consecutive_failures = 0
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.unhealthy_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Перцентиль задержки успешных запросов (None, пока данных мало)"""
+        if len(self.latencies) < 5:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def record_success(self, latency: float) -> None:
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.latencies.append(latency)
+
+    def record_failure(self, timeout: bool = False) -> None:
+        self.failures += 1
+        if timeout:
+            self.timeouts += 1
+        self.consecutive_failures += 1
+        # Несколько ошибок подряд — провайдер временно уходит в конец очереди
+        if self.consecutive_failures >= self.failure_threshold:
+            self.unhealthy_until = time.monotonic() + self.cooldown
+
+    def to_dict(self) -> Dict[str, Any]:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "hedges_won": self.hedges_won,
+            "p50": round(p50, 2) if p50 is not None else None,
+            "p95": round(p95, 2) if p95 is not None else None,
+        }
+
+
+class LLMProvider:
+    """Провайдер в маршрутизаторе: экземпляр LLM, таймаут запроса и статистика"""
+
+    def __init__(self, name: str, llm, timeout: float = 300.0):
+        self.name = name
+        self.llm = llm
+        self.timeout = timeout
+        self.stats = ProviderStats()
+
+    @property
+    def model(self) -> Optional[str]:
+        """Имя модели провайдера (для стоимости запросов)"""
+        return getattr(getattr(self.llm, 'provider', None), 'model', None)
+
+
+class HedgedLLM:
+    """
+    Маршрутизатор запросов к нескольким провайдерам LLM
+
+    Запрос уходит первому здоровому провайдеру. Если ответа нет дольше
+    наблюдаемого p95 его задержки, параллельно отправляется страховочный
+    запрос следующему провайдеру, и используется первый полученный ответ.
+    Запросы ограничены таймаутом; при ошибке или таймауте всех запущенных
+    запросов пробуются оставшиеся провайдеры по порядку.
+
+    Ответ получает атрибут llm_attempts — отправленные провайдерам запросы
+    ({provider, model, usage, won}), чтобы расход учитывался по цене модели,
+    которая ответила. Проигравший страховочный запрос и запрос, прерванный
+    по таймауту, ответа не вернули: их usage — промпт победившего ответа
+    (провайдер тарифицирует его), длина прерванного ответа неизвестна.
+    """
+
+    def __init__(self, providers: List[LLMProvider], hedge_after: Optional[float] = None,
+                 min_hedge_delay: float = 5.0):
+        """
+        Args:
+            providers: Провайдеры в порядке приоритета (первый — основной)
+            hedge_after: Задержка страховочного запроса, пока p95 еще неизвестен
+                (None — без страховки до накопления статистики)
+            min_hedge_delay: Нижняя граница задержки страховочного запроса
+        """
+        if not providers:
+            raise ValueError("Нужен хотя бы один провайдер LLM")
+        self.providers = providers
+        self.hedge_after = hedge_after
+        self.min_hedge_delay = min_hedge_delay
+
+    @property
+    def primary(self):
+        return self.providers[0].llm
+
+    def _ordered(self) -> List[LLMProvider]:
+        """Провайдеры по приоритету, нездоровые — в конце"""
+        return sorted(self.providers, key=lambda provider: not provider.stats.healthy)
+
+    def _hedge_delay(self, provider: LLMProvider) -> Optional[float]:
+        p95 = provider.stats.percentile(0.95)
+        if p95 is None:
+            return self.hedge_after
+        return max(p95, self.min_hedge_delay)
+
+    async def _call(self, provider: LLMProvider, messages, kwargs):
+        """Запрос к одному провайдеру с таймаутом и учетом статистики"""
+        provider.stats.requests += 1
+        started = time.monotonic()
+        try:
+            with tracer.span("provider", provider=provider.name):
+                response = await asyncio.wait_for(
+                    provider.llm.generate_response(messages, **kwargs), provider.timeout
+                )
+        except asyncio.TimeoutError:
+            provider.stats.record_failure(timeout=True)
+            logger.warning(f"{provider.name}: нет ответа за {provider.timeout} с")
+            raise
+        except asyncio.CancelledError:
+            # Проигравший страховочный запрос — не ошибка провайдера
+            raise
+        except Exception as e:
+            provider.stats.record_failure()
+            logger.warning(f"{provider.name}: ошибка запроса: {e}")
+            raise
+        provider.stats.record_success(time.monotonic() - started)
+        return response
+
+    async def generate_response(self, messages, **kwargs):
+        queue = self._ordered()
+        pending: Dict[asyncio.Task, LLMProvider] = {}
+        timed_out: List[LLMProvider] = []
+        last_error: Optional[BaseException] = None
+
+        def launch():
+            provider = queue.pop(0)
+            task = asyncio.create_task(self._call(provider, messages, kwargs))
+            pending[task] = provider
+            return provider
+
+        try:
+            leader = launch()
+            while pending:
+                # Пока есть запасной провайдер, ждем не дольше задержки страховки
+                timeout = self._hedge_delay(leader) if queue else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    hedge = launch()
+                    logger.info(f"{leader.name}: ответа нет дольше {timeout:.1f} с, страховочный запрос к {hedge.name}")
+                    continue
+
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is None:
+                        if provider is not leader:
+                            provider.stats.hedges_won += 1
+                        response = task.result()
+                        self._attach_attempts(response, provider, [*pending.values(), *timed_out])
+                        return response
+                    last_error = task.exception()
+                    if isinstance(last_error, asyncio.TimeoutError):
+                        timed_out.append(provider)
+
+                # Все запущенные запросы завершились ошибкой — переходим к следующему провайдеру
+                if not pending and queue:
+                    leader = launch()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise last_error or RuntimeError("Нет доступных провайдеров LLM")
+
+    @staticmethod
+    def _attach_attempts(response, winner: LLMProvider, interrupted: List[LLMProvider]) -> None:
+        """Записывает в ответ запросы, за которые провайдеры выставят счет"""
+        usage = usage_to_dict(getattr(response, 'usage', None))
+        prompt = {"prompt_tokens": usage.get("prompt_tokens") or 0, "completion_tokens": 0}
+        attempts = [{"provider": winner.name, "model": winner.model, "usage": usage, "won": True}]
+        attempts += [
+            {"provider": provider.name, "model": provider.model, "usage": dict(prompt), "won": False}
+            for provider in interrupted
+        ]
+        try:
+            response.llm_attempts = attempts
+        except AttributeError:
+            logger.debug(f"Ответ {type(response).__name__} не принимает атрибуты, расход учитывается по основной модели")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Статистика провайдеров по именам"""
+        return {provider.name: provider.stats.to_dict() for provider in self.providers}
+
+    def __getattr__(self, name: str) -> Any:
+        # provider, model и прочие атрибуты — от основного провайдера
+        return getattr(self.providers[0].llm, name)
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, Iterable, Optional
+
+from utils import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_DIR = os.path.join(DATA_DIR, "manifests")
+
+# Состояния единицы работы (этапа или сцены)
+COMPLETE = "complete"   # выполнена, входные данные не менялись
+PARTIAL = "partial"     # начата, входные данные не менялись
+STALE = "stale"         # выполнялась, но входные данные изменились
+MISSING = "missing"     # нет записи (или входы неизвестны) — нужна проверка хранилища
+
+
+def content_hash(value: Any) -> str:
+    """
+    Хэш содержимого артефакта
+
+    JSON-строки хэшируются в разобранном виде, чтобы значение,
+    сохраненное словарем и прочитанное строкой, давало тот же хэш
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            pass
+    if isinstance(value, str):
+        data = value
+    else:
+        data = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def write_json_atomic(path: str, data: Any) -> None:
+    """Атомарно записывает JSON-файл (через временный файл и rename)"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class BookManifest:
+    """
+    Манифест выполненной работы над книгой
+
+    Хранит хэши всех сохраненных артефактов (outputs) и записи о выполненных
+    единицах работы (units) с хэшем их входных данных. Единица считается
+    выполненной, пока хэш ее входов совпадает с записанным, поэтому
+    продолжение генерации не читает хранилище для готовых этапов и сцен,
+    а изменение артефакта выше по цепочке делает зависимые единицы устаревшими.
+    """
+
+    _cache: Dict[str, "BookManifest"] = {}
+
+    def __init__(self, book_id: Any, path: str):
+        self.book_id = str(book_id)
+        self.path = path
+        self.outputs: Dict[str, str] = {}
+        self.units: Dict[str, Dict[str, Any]] = {}
+        self.load()
+
+    @classmethod
+    def for_book(cls, book_id: Any, directory: Optional[str] = None) -> "BookManifest":
+        """Возвращает (кэшированный) манифест книги"""
+        path = os.path.join(directory or MANIFEST_DIR, f"book{book_id}.json")
+        manifest = cls._cache.get(path)
+        if manifest is None:
+            manifest = cls._cache[path] = cls(book_id, path)
+        return manifest
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.outputs = data.get("outputs", {})
+            self.units = data.get("units", {})
+        except (OSError, json.JSONDecodeError) as e:
+            # Манифест — только ускорение: без него работа сверяется с хранилищем
+            logger.warning(f"Не удалось прочитать манифест {self.path}: {e}")
+
+    def save(self) -> None:
+        write_json_atomic(self.path, {
+            "book_id": self.book_id,
+            "outputs": self.outputs,
+            "units": self.units
+        })
+
+    def record_output(self, key: str, value: Any) -> str:
+        """Запоминает хэш нового значения артефакта"""
+        self.outputs[key] = content_hash(value)
+        return self.outputs[key]
+
+    def observe_output(self, key: str, value: Any) -> None:
+        """Запоминает хэш прочитанного артефакта, если он еще неизвестен (старые книги)"""
+        if key not in self.outputs and value is not None:
+            self.record_output(key, value)
+
+    def inputs_hash(self, keys: Iterable[str], *values: Any) -> Optional[str]:
+        """
+        Хэш входных данных единицы работы
+
+        Args:
+            keys: Ключи артефактов, от которых зависит единица
+            *values: Дополнительные значения (например, описание сцены)
+
+        Returns:
+            Optional[str]: Хэш или None, если хэш какого-то артефакта неизвестен
+        """
+        parts = []
+        for key in keys:
+            if key not in self.outputs:
+                return None
+            parts.append(f"{key}={self.outputs[key]}")
+        parts.extend(content_hash(value) for value in values)
+        return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+    def status(self, unit: str, inputs_hash: Optional[str]) -> str:
+        """Состояние единицы работы относительно текущих входных данных"""
+        record = self.units.get(unit)
+        if record is None or inputs_hash is None:
+            return MISSING
+        if record.get("inputs") != inputs_hash:
+            return STALE
+        return COMPLETE if record.get("done") else PARTIAL
+
+    def unit(self, unit: str) -> Dict[str, Any]:
+        """Запись о единице работы (пустой словарь, если ее нет)"""
+        return self.units.get(unit, {})
+
+    def update_unit(self, unit: str, inputs_hash: Optional[str], done: bool = False, **data) -> None:
+        """
+        Записывает прогресс единицы работы
+
+        Без известного хэша входов запись не делается: иначе единица
+        позже оказалась бы ложно устаревшей
+        """
+        if inputs_hash is None:
+            self.units.pop(unit, None)
+            return
+        self.units[unit] = {"inputs": inputs_hash, "done": done, **data}
+
+    def mark_complete(self, unit: str, inputs_hash: Optional[str], **data) -> None:
+        """Отмечает единицу работы выполненной"""
+        self.update_unit(unit, inputs_hash, done=True, **data)
+
+    def delete(self) -> None:
+        """Удаляет манифест книги"""
+        self._cache.pop(self.path, None)
+        if os.path.exists(self.path):
+            os.remove(self.path)
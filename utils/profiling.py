@@ -0,0 +1,288 @@
+import array
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from utils import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.environ.get("GORKY_PROFILE_DIR", os.path.join(DATA_DIR, "profiles"))
+# Обратный вызов, занявший цикл событий дольше порога, попадает в отчет со стеком
+DEFAULT_BLOCK_THRESHOLD_MS = 100
+
+# Период пульса цикла событий и период снятия стека (секунды)
+HEARTBEAT_INTERVAL = 0.05
+SAMPLE_INTERVAL = 0.01
+
+# Сколько блокировок и функций показывать в отчете
+MAX_BLOCKS = 50
+TOP_FUNCTIONS = 15
+STACK_DEPTH = 12
+
+
+def profile_enabled() -> bool:
+    """
+    Включено ли профилирование (GORKY_PROFILE=1)
+
+    Окружение читается при каждом вызове: gorky_agent.py --profile выставляет
+    переменную уже после импорта, а веб-сервер в потоке и процессы веб-сервера
+    и пакетной генерации получают ее через окружение
+    """
+    return os.environ.get("GORKY_PROFILE") == "1"
+
+
+def block_threshold_ms() -> float:
+    """Порог блокировки цикла событий в миллисекундах (GORKY_PROFILE_BLOCK_MS)"""
+    return float(os.environ.get("GORKY_PROFILE_BLOCK_MS", DEFAULT_BLOCK_THRESHOLD_MS))
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _label(frame) -> str:
+    """
+    К чему относится стек: этап пайплайна или обработчик веб-сервера
+
+    Стек снимается из другого потока, поэтому contextvars недоступны;
+    этап находится по кадру GorkyStage._run в цепочке вызовов корутин
+    """
+    web_handler = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name == "_run" and code.co_filename.endswith(os.path.join("stages", "base.py")):
+            stage = frame.f_locals.get("self")
+            return f"stage:{getattr(stage, 'stage_name', '?')}"
+        if code.co_filename.endswith(os.path.join("web", "server.py")) and code.co_name != "<module>":
+            web_handler = code.co_name
+        frame = frame.f_back
+    return f"web:{web_handler}" if web_handler else "other"
+
+
+def _is_idle(frame) -> bool:
+    """Цикл событий ждет ввода-вывода в select/epoll"""
+    return frame.f_code.co_filename.endswith("selectors.py")
+
+
+def _percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+class LoopProfiler:
+    """
+    Профилирование процесса, работающего на цикле событий asyncio
+
+    - Пульс: задача цикла засыпает на HEARTBEAT_INTERVAL и измеряет, насколько
+      позже положенного проснулась, — это задержка цикла событий.
+    - Сторожевой поток раз в SAMPLE_INTERVAL снимает стек потока цикла.
+      Стеки вне ожидания в select складываются по этапам пайплайна
+      (и обработчикам веб-сервера) — выборочный профиль процессорного времени.
+    - Если пульса нет дольше порога, сторожевой поток запоминает стек,
+      на котором стоит цикл: это и есть блокирующий вызов.
+
+    При остановке пишет отчет data/profiles/<метка>_<время>_<pid>.json и
+    свернутые стеки в .folded (формат flamegraph.pl / speedscope).
+    """
+
+    def __init__(self, label: str, directory: Optional[str] = None, threshold_ms: Optional[float] = None):
+        """
+        Args:
+            label: Метка процесса в имени отчета (cli, web, batch)
+            directory: Директория отчетов
+            threshold_ms: Порог блокировки цикла в миллисекундах (по умолчанию — GORKY_PROFILE_BLOCK_MS)
+        """
+        self.label = label
+        self.directory = directory or PROFILE_DIR
+        self.threshold = (threshold_ms if threshold_ms is not None else block_threshold_ms()) / 1000
+        self.lags = array.array("d")
+        self.blocks: List[Dict[str, Any]] = []
+        self.stacks: Counter = Counter()
+        self.samples: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._beat = time.perf_counter()
+        self._pending: Optional[Dict[str, Any]] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._thread_id: Optional[int] = None
+        self.started_at: Optional[datetime] = None
+        self._started = 0.0
+
+    def start(self) -> None:
+        """Запускает профилирование текущего цикла событий"""
+        self._thread_id = threading.get_ident()
+        self.started_at = datetime.now()
+        self._started = self._beat = time.perf_counter()
+        self._heartbeat = asyncio.get_running_loop().create_task(self._pulse(), name="profiler-heartbeat")
+        self._watchdog = threading.Thread(target=self._watch, name="profiler-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(f"Профилирование включено ({self.label}), порог блокировки {self.threshold * 1000:.0f} мс")
+
+    async def _pulse(self) -> None:
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            now = time.perf_counter()
+            lag = max(now - before - HEARTBEAT_INTERVAL, 0.0)
+            self.lags.append(lag)
+            with self._lock:
+                self._beat = now
+                if lag >= self.threshold:
+                    block = self._pending or {"label": "other", "stack": []}
+                    block["duration_ms"] = round(lag * 1000, 1)
+                    block["at"] = round(before - self._started, 3)
+                    self.blocks.append(block)
+                self._pending = None
+
+    def _watch(self) -> None:
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            if not _is_idle(frame):
+                label = _label(frame)
+                names = []
+                current = frame
+                while current is not None:
+                    names.append(_frame_name(current))
+                    current = current.f_back
+                self.samples[label] += 1
+                self.stacks[label + ";" + ";".join(reversed(names))] += 1
+            with self._lock:
+                stalled = time.perf_counter() - self._beat > HEARTBEAT_INTERVAL + self.threshold
+                if stalled and self._pending is None:
+                    # Стек снимаем, пока цикл еще стоит на блокирующем вызове
+                    self._pending = {
+                        "label": _label(frame),
+                        "stack": [line.rstrip() for line in traceback.format_stack(frame)[-STACK_DEPTH:]]
+                    }
+            del frame
+
+    async def stop(self) -> Optional[str]:
+        """
+        Останавливает профилирование и пишет отчет
+
+        Returns:
+            Optional[str]: Путь к отчету (None, если записать не удалось)
+        """
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            await asyncio.gather(self._heartbeat, return_exceptions=True)
+        if self._watchdog:
+            await asyncio.to_thread(self._watchdog.join)
+        report = self.report()
+        name = f"{self.label}_{self.started_at:%Y%m%d_%H%M%S}_{os.getpid()}"
+        path = os.path.join(self.directory, name + ".json")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            with open(os.path.join(self.directory, name + ".folded"), "w", encoding="utf-8") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            logger.error(f"Не удалось записать отчет профилирования: {e}")
+            return None
+        print(self.summary(report))
+        print(f"📄 Отчет профилирования: {path}")
+        return path
+
+    def _functions(self, label: str) -> List[Dict[str, Any]]:
+        """Самые затратные функции метки: собственные и включающие выборки"""
+        own: Counter = Counter()
+        inclusive: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            if frames[0] != label:
+                continue
+            own[frames[-1]] += count
+            for name in set(frames[1:]):
+                inclusive[name] += count
+        ranked = sorted(inclusive, key=lambda name: (own[name], inclusive[name]), reverse=True)
+        return [{"function": name, "self": own[name], "total": inclusive[name]} for name in ranked[:TOP_FUNCTIONS]]
+
+    def report(self) -> Dict[str, Any]:
+        """Отчет профилирования"""
+        lags = sorted(self.lags)
+        blocks = sorted(self.blocks, key=lambda block: block["duration_ms"], reverse=True)
+        return {
+            "label": self.label,
+            "pid": os.getpid(),
+            "argv": sys.argv,
+            "started_at": self.started_at.isoformat(timespec="seconds") if self.started_at else None,
+            "duration": round(time.perf_counter() - self._started, 1),
+            "block_threshold_ms": self.threshold * 1000,
+            "loop_lag_ms": {
+                "heartbeats": len(lags),
+                "mean": round(sum(lags) / len(lags) * 1000, 2) if lags else 0.0,
+                "p50": round(_percentile(lags, 0.5) * 1000, 2),
+                "p95": round(_percentile(lags, 0.95) * 1000, 2),
+                "p99": round(_percentile(lags, 0.99) * 1000, 2),
+                "max": round(lags[-1] * 1000, 2) if lags else 0.0,
+            },
+            "blocks": blocks[:MAX_BLOCKS],
+            "blocks_total": len(blocks),
+            "sample_interval_ms": SAMPLE_INTERVAL * 1000,
+            "stages": {
+                label: {
+                    "samples": count,
+                    "busy_seconds": round(count * SAMPLE_INTERVAL, 2),
+                    "functions": self._functions(label)
+                }
+                for label, count in self.samples.most_common()
+            }
+        }
+
+    @staticmethod
+    def summary(report: Dict[str, Any]) -> str:
+        """Краткая сводка отчета для консоли"""
+        lag = report["loop_lag_ms"]
+        lines = [f"⏱ Профиль ({report['label']}): задержка цикла p50 {lag['p50']} мс, "
+                 f"p99 {lag['p99']} мс, максимум {lag['max']} мс; "
+                 f"блокировок дольше {report['block_threshold_ms']:.0f} мс: {report['blocks_total']}"]
+        for label, stage in list(report["stages"].items())[:8]:
+            top = stage["functions"][0]["function"] if stage["functions"] else "-"
+            lines.append(f"   {label}: ~{stage['busy_seconds']} с занятости цикла, больше всего в {top}")
+        for block in report["blocks"][:3]:
+            where = block["stack"][-1].strip().splitlines()[0] if block["stack"] else "стек не снят"
+            lines.append(f"   ⚠ {block['duration_ms']} мс ({block['label']}): {where}")
+        return "\n".join(lines)
+
+
+@asynccontextmanager
+async def profiling(label: str, enabled: Optional[bool] = None,
+                    threshold_ms: Optional[float] = None) -> AsyncIterator[Optional[LoopProfiler]]:
+    """
+    Профилирует блок, если профилирование включено
+
+    Args:
+        label: Метка процесса в имени отчета
+        enabled: Включено ли профилирование (по умолчанию — GORKY_PROFILE)
+        threshold_ms: Порог блокировки цикла в миллисекундах
+
+    Yields:
+        Optional[LoopProfiler]: Профилировщик (None, если выключено)
+    """
+    if not (profile_enabled() if enabled is None else enabled):
+        yield None
+        return
+    profiler = LoopProfiler(label, threshold_ms=threshold_ms)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        await profiler.stop()
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationCancelled(Exception):
+    """
+    Генерация остановлена по запросу в точке проверки
+
+    Обычное исключение, а не CancelledError: наследник CancelledError,
+    поднятый в задаче, отменяет ее, и asyncio.gather, wait_for и повторное
+    ожидание задачи получают вместо него простой CancelledError. Обработчики
+    `except Exception` на пути от запроса к LLM до GorkyStage._run должны
+    пропускать его явно (`except GenerationCancelled: raise`).
+    """
+
+
+class BudgetExceeded(GenerationCancelled):
+    """
+    Генерация остановлена: следующий запрос превысил бы бюджет книги
+
+    Остановка происходит до отправки запроса, поэтому после увеличения
+    бюджета генерация продолжается с того же места
+    """
+
+    def __init__(self, spent: float, projected: float, budget: float):
+        super().__init__(f"Бюджет книги ${budget:g} исчерпан: потрачено ${spent:.4f}, "
+                         f"следующий запрос ~${projected:.4f}")
+        self.spent = spent
+        self.projected = projected
+        self.budget = budget
+
+
+class RunControl:
+    """
+    Управление выполняющейся генерацией: пауза, продолжение и мягкая отмена
+
+    Этапы вызывают checkpoint() между запросами к LLM. Запрос, который уже
+    отправлен, доводится до конца и сохраняется, поэтому после остановки
+    продолжение не повторяет оплаченных вызовов.
+    """
+
+    def __init__(self):
+        self.cancel_requested = False
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._resumed.is_set()
+
+    def pause(self) -> None:
+        """Приостанавливает генерацию в ближайшей точке проверки"""
+        self._resumed.clear()
+
+    def resume(self) -> None:
+        """Продолжает приостановленную генерацию"""
+        self._resumed.set()
+
+    def cancel(self) -> None:
+        """Останавливает генерацию в ближайшей точке проверки (в том числе на паузе)"""
+        self.cancel_requested = True
+        self._resumed.set()
+
+    async def checkpoint(self) -> None:
+        """
+        Точка проверки между запросами к LLM
+
+        Raises:
+            GenerationCancelled: Если запрошена остановка
+        """
+        if self.cancel_requested:
+            raise GenerationCancelled()
+        if self.paused:
+            logger.info("Генерация приостановлена")
+            await self._resumed.wait()
+            if self.cancel_requested:
+                raise GenerationCancelled()
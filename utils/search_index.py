@@ -0,0 +1,231 @@
+import html
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.text import clean_editor_notes, normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Артефакты, которые попадают в индекс помимо сцен
+INDEXED_ARTIFACTS = {
+    "title": "Название",
+    "creative_brief": "Creative Brief",
+    "story_outline": "Story Outline",
+    "story_structure": "Story Structure",
+    "characters": "Characters",
+}
+
+SCENE_KEY_PATTERN = re.compile(r"^chapter(\d+)/scene(\d+)$")
+
+# Маркеры подсветки в сниппетах; заменяются на <mark> после экранирования HTML
+_MARK_START = "\x02"
+_MARK_END = "\x03"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents_meta (
+    doc_id INTEGER PRIMARY KEY,
+    book_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    title TEXT NOT NULL,
+    UNIQUE (book_id, key)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+    title,
+    body,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def _flatten(value: Any) -> List[str]:
+    """Собирает все строки из вложенной JSON-структуры"""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        return [text for item in value.values() for text in _flatten(item)]
+    if isinstance(value, list):
+        return [text for item in value for text in _flatten(item)]
+    if value is None:
+        return []
+    return [str(value)]
+
+
+def _build_match_query(query: str) -> str:
+    """
+    Превращает пользовательский запрос в безопасный запрос FTS5
+
+    Каждое слово берется в кавычки (все слова обязательны),
+    последнее слово ищется по префиксу
+    """
+    words = re.findall(r"\w+", normalize_text(query))
+    if not words:
+        return ""
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+class SearchIndex:
+    """
+    Полнотекстовый индекс сцен и ключевых артефактов (SQLite FTS5)
+
+    Обновляется инкрементально при каждом сохранении артефакта:
+    документ с тем же ключом заменяется новой версией
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def describe(key: str) -> Optional[Dict[str, str]]:
+        """
+        Определяет тип и заголовок документа по ключу артефакта
+
+        Returns:
+            Optional[Dict[str, str]]: {'kind', 'title'} или None, если артефакт не индексируется
+        """
+        match = SCENE_KEY_PATTERN.match(key)
+        if match:
+            return {"kind": "scene", "title": f"Глава {match.group(1)}, сцена {match.group(2)}"}
+        if key in INDEXED_ARTIFACTS:
+            return {"kind": key, "title": INDEXED_ARTIFACTS[key]}
+        return None
+
+    @staticmethod
+    def describe_scene(key: str) -> Optional[Tuple[int, int]]:
+        """Возвращает (номер главы, номер сцены) для ключа сцены"""
+        match = SCENE_KEY_PATTERN.match(key)
+        if not match:
+            return None
+        return int(match.group(1)), int(match.group(2))
+
+    @staticmethod
+    def extract_text(kind: str, value: Any) -> str:
+        """Извлекает текст для индексации из значения артефакта"""
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                pass
+        if kind == "scene":
+            if isinstance(value, dict):
+                value = value.get("scene_text", "")
+            return clean_editor_notes(value if isinstance(value, str) else "")
+        return "\n".join(_flatten(value))
+
+    def update_artifact(self, book_id: Any, key: str, value: Any) -> bool:
+        """
+        Добавляет или заменяет документ артефакта в индексе
+
+        Args:
+            book_id: ID книги
+            key: Ключ артефакта (например, 'chapter1/scene2' или 'characters')
+            value: Значение артефакта
+
+        Returns:
+            bool: True если артефакт проиндексирован
+        """
+        info = self.describe(key)
+        if not info:
+            return False
+        body = normalize_text(self.extract_text(info["kind"], value))
+        book_id = str(book_id)
+
+        with self._lock, self.conn:
+            row = self.conn.execute(
+                "SELECT doc_id FROM documents_meta WHERE book_id = ? AND key = ?",
+                (book_id, key)
+            ).fetchone()
+            if row:
+                doc_id = row[0]
+                self.conn.execute("DELETE FROM documents WHERE rowid = ?", (doc_id,))
+            else:
+                doc_id = self.conn.execute(
+                    "INSERT INTO documents_meta (book_id, key, kind, title) VALUES (?, ?, ?, ?)",
+                    (book_id, key, info["kind"], info["title"])
+                ).lastrowid
+            self.conn.execute(
+                "INSERT INTO documents (rowid, title, body) VALUES (?, ?, ?)",
+                (doc_id, info["title"], body)
+            )
+        return True
+
+    def delete_book(self, book_id: Any) -> None:
+        """Удаляет из индекса все документы книги"""
+        book_id = str(book_id)
+        with self._lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM documents WHERE rowid IN (SELECT doc_id FROM documents_meta WHERE book_id = ?)",
+                (book_id,)
+            )
+            self.conn.execute("DELETE FROM documents_meta WHERE book_id = ?", (book_id,))
+
+    def search(self, query: str, book_id: Any = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        Ищет документы по запросу, лучшие совпадения первыми
+
+        Args:
+            query: Поисковый запрос
+            book_id: Искать только в этой книге
+            limit: Максимальное количество результатов
+
+        Returns:
+            List[Dict[str, Any]]: Результаты с HTML-сниппетами (совпадения в <mark>)
+        """
+        match_query = _build_match_query(query)
+        if not match_query:
+            return []
+
+        sql = """
+            SELECT m.book_id, m.key, m.kind, m.title,
+                   snippet(documents, 1, ?, ?, '…', 24) AS snippet,
+                   rank AS score
+            FROM documents
+            JOIN documents_meta m ON m.doc_id = documents.rowid
+            WHERE documents MATCH ?
+        """
+        params: List[Any] = [_MARK_START, _MARK_END, match_query]
+        if book_id is not None:
+            sql += " AND m.book_id = ?"
+            params.append(str(book_id))
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+
+        results = []
+        for row_book_id, key, kind, title, snippet, score in rows:
+            snippet = html.escape(snippet).replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>")
+            results.append({
+                "book_id": row_book_id,
+                "key": key,
+                "kind": kind,
+                "title": title,
+                "snippet": snippet,
+                "score": score,
+            })
+        return results
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,460 @@
+import asyncio
+import inspect
+import logging
+import os
+import re
+import sqlite3
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from utils import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# Директории файлов книг и архива в режиме шардирования (gorky_agent.py --sharded-storage)
+SHARD_DIR = os.path.join(DATA_DIR, "books")
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+
+# Состояния книги в каталоге шардов
+ACTIVE = "active"
+ARCHIVED = "archived"
+
+# Ключи артефактов начинаются с компонента книги (см. GorkyStage.get_book_path)
+_BOOK_KEY = re.compile(r"^book(\d+)(?:/|$)")
+
+# Параметры конструктора плагина хранилища, задающие файл базы (см. store_factory)
+_PATH_PARAMS = ("db_path", "database", "db_file", "path", "filename", "file_path", "storage_path")
+
+
+def find_sqlite_connection(storage) -> Optional[sqlite3.Connection]:
+    """
+    Ищет открытое соединение SQLite внутри плагина хранилища
+
+    Просматриваются атрибуты экземпляра плагина и объектов, которые он
+    держит (обертка соединения, помощник работы с базой), независимо от имен
+    атрибутов в конкретной версии cognistruct.
+    """
+    nested = []
+    for value in getattr(storage, "__dict__", {}).values():
+        if isinstance(value, sqlite3.Connection):
+            return value
+        if hasattr(value, "__dict__") and not isinstance(value, type):
+            nested.append(value)
+    for value in nested:
+        for inner in vars(value).values():
+            if isinstance(inner, sqlite3.Connection):
+                return inner
+    return None
+
+
+def set_pragma(storage, pragma: str, purpose: str) -> bool:
+    """
+    Выполняет PRAGMA на соединении SQLite плагина хранилища
+
+    Args:
+        storage: Плагин хранилища
+        pragma: Текст прагмы, например "journal_mode=WAL"
+        purpose: Что теряется без прагмы (для предупреждения)
+
+    Returns:
+        bool: True если прагма применена
+    """
+    conn = find_sqlite_connection(storage)
+    if conn is None:
+        logger.warning(f"Соединение SQLite в {type(storage).__name__} не найдено, "
+                       f"PRAGMA {pragma} не применена: {purpose}")
+        return False
+    try:
+        conn.execute(f"PRAGMA {pragma}")
+        return True
+    except sqlite3.Error as e:
+        logger.warning(f"Не удалось применить PRAGMA {pragma} в {type(storage).__name__}: {e}; {purpose}")
+        return False
+
+
+# Последствия работы без прагм в режиме --web process
+_WAL_PURPOSE = "чтение из процессов веб-интерфейса будет ждать записи генерации"
+_QUERY_ONLY_PURPOSE = "соединение веб-интерфейса не защищено от записи на уровне SQLite"
+
+
+def enable_concurrent_readers(storage) -> bool:
+    """
+    Переключает SQLite-хранилище в режим WAL
+
+    В WAL читатели из других процессов не блокируют писателя и не ждут его.
+    Режим сохраняется в файле базы, поэтому достаточно включить его один раз
+    со стороны процесса генерации.
+
+    Returns:
+        bool: True если режим включен
+    """
+    if isinstance(storage, ShardedStoragePlugin):
+        # Файлы книг открываются по требованию, WAL включается при их открытии;
+        # в общем хранилище остаются книги до шардирования и ключи без книги
+        storage.concurrent_readers = True
+        for shard in list(storage._shards.values()):
+            enable_concurrent_readers(shard)
+        return enable_concurrent_readers(storage.fallback)
+    return set_pragma(storage, "journal_mode=WAL", _WAL_PURPOSE)
+
+
+class ReadOnlyStorage:
+    """
+    Обертка над плагином хранилища, запрещающая запись
+
+    Используется веб-интерфейсом, когда он работает в отдельных процессах:
+    воркеры только читают артефакты, которые пишет процесс генерации
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+
+    async def setup(self) -> None:
+        store = self._storage
+        if isinstance(store, ShardedStoragePlugin):
+            # Файлы книг получают query_only при открытии
+            store.read_only = True
+            await store.setup()
+            store = store.fallback
+        else:
+            await store.setup()
+        # Соединение воркера только читает
+        set_pragma(store, "query_only=ON", _QUERY_ONLY_PURPOSE)
+
+    async def read(self, key: str, version: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        if version is None:
+            return await self._storage.read(key)
+        return await self._storage.read(key, version=version)
+
+    async def search(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return await self._storage.search(query)
+
+    def generate_hierarchical_id(self, *parts) -> str:
+        return self._storage.generate_hierarchical_id(*parts)
+
+    async def create(self, *args, **kwargs):
+        raise PermissionError("Хранилище открыто только для чтения")
+
+    async def update(self, *args, **kwargs):
+        raise PermissionError("Хранилище открыто только для чтения")
+
+    async def delete(self, *args, **kwargs):
+        raise PermissionError("Хранилище открыто только для чтения")
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._storage, name)
+
+
+def book_of_key(key: str) -> Optional[str]:
+    """ID книги из ключа артефакта или префикса поиска (None — ключ не относится к книге)"""
+    match = _BOOK_KEY.match(key or "")
+    return match.group(1) if match else None
+
+
+async def _close_store(store) -> None:
+    """Закрывает плагин хранилища (cleanup плагина или соединение SQLite)"""
+    cleanup = getattr(store, "cleanup", None)
+    if callable(cleanup):
+        await cleanup()
+        return
+    conn = find_sqlite_connection(store)
+    if conn is not None:
+        conn.close()
+
+
+class ShardedStoragePlugin:
+    """
+    Хранилище артефактов с отдельным файлом на каждую книгу
+
+    Операция направляется в файл книги по компоненту book ключа
+    (generate_hierarchical_id), поэтому параллельные генерации разных книг
+    не ждут общей блокировки записи, а удаление или архивирование книги —
+    это удаление или перенос одного файла. Каталог catalog.db в директории
+    шардов перечисляет книги, их файлы и состояние; по нему же процессы
+    (генерация, воркеры, веб-сервер) узнают о файлах, созданных другими.
+
+    Книги, созданные до включения шардирования, остаются в общем хранилище
+    fallback: оно же обслуживает ключи без компонента книги.
+    """
+
+    def __init__(self, factory: Callable[[str], Any], fallback, directory: Optional[str] = None,
+                 archive_dir: Optional[str] = None):
+        """
+        Args:
+            factory: Создает плагин хранилища для файла книги
+            fallback: Общее хранилище (старые книги и ключи без книги)
+            directory: Директория файлов книг и каталога
+            archive_dir: Директория архива
+        """
+        self.factory = factory
+        self.fallback = fallback
+        self.directory = directory or SHARD_DIR
+        self.archive_dir = archive_dir or ARCHIVE_DIR
+        # concurrent_readers выставляет enable_concurrent_readers (после setup,
+        # действует на файлы, открытые позже), read_only — ReadOnlyStorage до setup
+        self.concurrent_readers = False
+        self.read_only = False
+        self._shards: Dict[str, Any] = {}
+        # Записи каталога о книгах, открытых этим процессом (см. _route)
+        self._states: Dict[str, Dict[str, Any]] = {}
+        self._legacy: Dict[str, bool] = {}
+        self._lock = asyncio.Lock()
+        self._catalog: Optional[sqlite3.Connection] = None
+
+    async def setup(self) -> None:
+        await self.fallback.setup()
+        os.makedirs(self.directory, exist_ok=True)
+        self._catalog = sqlite3.connect(os.path.join(self.directory, "catalog.db"),
+                                        check_same_thread=False, timeout=30)
+        self._catalog.row_factory = sqlite3.Row
+        self._catalog.execute("PRAGMA journal_mode=WAL")
+        self._catalog.execute(
+            "CREATE TABLE IF NOT EXISTS books ("
+            "book_id TEXT PRIMARY KEY, path TEXT NOT NULL, status TEXT NOT NULL, "
+            "created_at REAL NOT NULL, archived_at REAL)"
+        )
+        self._catalog.commit()
+
+    def catalog(self) -> List[Dict[str, Any]]:
+        """Книги каталога: book_id, path, status, created_at, archived_at"""
+        rows = self._catalog.execute("SELECT * FROM books ORDER BY CAST(book_id AS INTEGER)").fetchall()
+        return [dict(row) for row in rows]
+
+    def book_state(self, book_id: Any) -> Optional[Dict[str, Any]]:
+        """Запись каталога о книге (None — книга хранится в общем хранилище)"""
+        row = self._catalog.execute("SELECT * FROM books WHERE book_id = ?", (str(book_id),)).fetchone()
+        return dict(row) if row else None
+
+    async def _open(self, path: str):
+        async with self._lock:
+            shard = self._shards.get(path)
+            if shard is None:
+                shard = self.factory(path)
+                await shard.setup()
+                if not os.path.exists(path):
+                    # Плагин проигнорировал путь: запись ушла бы в чужую базу
+                    await _close_store(shard)
+                    raise RuntimeError(f"Хранилище не создало файл книги {path}: проверьте параметры "
+                                       f"конструктора плагина (--sharded-storage)")
+                if self.concurrent_readers:
+                    set_pragma(shard, "journal_mode=WAL", _WAL_PURPOSE)
+                if self.read_only:
+                    set_pragma(shard, "query_only=ON", _QUERY_ONLY_PURPOSE)
+                self._shards[path] = shard
+            return shard
+
+    async def _route(self, key: str, write: bool = False):
+        """
+        Хранилище, в котором лежит ключ
+
+        Запись каталога об открытой книге запоминается: пока ее файл на месте,
+        операции не обращаются к каталогу. Каталог перечитывается для
+        незнакомых книг (файл мог создать другой процесс) и когда файл
+        пропал (другой процесс перенес книгу в архив или удалил ее).
+        Возвращает None для книги в архиве.
+        """
+        book_id = book_of_key(key)
+        if book_id is None:
+            return self.fallback
+        state = self._states.get(book_id)
+        if state is not None:
+            if os.path.exists(state["path"]):
+                return await self._open(state["path"])
+            await self._detach(book_id)
+        if self._legacy.get(book_id):
+            return self.fallback
+        state = self.book_state(book_id)
+        if state is None:
+            if not write or self.read_only or await self._is_legacy(book_id):
+                return self.fallback
+            state = self._register(book_id)
+        if state["status"] != ACTIVE:
+            if write:
+                raise PermissionError(f"Книга {book_id} в архиве")
+            return None
+        shard = await self._open(state["path"])
+        self._states[book_id] = state
+        return shard
+
+    async def _is_legacy(self, book_id: str) -> bool:
+        """Есть ли у книги артефакты в общем хранилище (книга создана до шардирования)"""
+        if book_id not in self._legacy:
+            self._legacy[book_id] = bool(await self.fallback.search({"key_prefix": f"book{book_id}/"}))
+        return self._legacy[book_id]
+
+    def _register(self, book_id: str) -> Dict[str, Any]:
+        path = os.path.join(self.directory, f"book{book_id}.db")
+        with self._catalog:
+            # Книгу мог одновременно зарегистрировать другой процесс: файл у нее тот же
+            self._catalog.execute(
+                "INSERT OR IGNORE INTO books (book_id, path, status, created_at) VALUES (?, ?, ?, ?)",
+                (book_id, path, ACTIVE, time.time())
+            )
+        return self.book_state(book_id)
+
+    async def create(self, data: Dict[str, Any]):
+        return await (await self._route(data["key"], write=True)).create(data)
+
+    async def update(self, key: str, *args, **kwargs):
+        return await (await self._route(key, write=True)).update(key, *args, **kwargs)
+
+    async def read(self, key: str, version: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        store = await self._route(key)
+        if store is None:
+            return None
+        if version is None:
+            return await store.read(key)
+        return await store.read(key, version=version)
+
+    async def delete(self, key: str):
+        return await (await self._route(key, write=True)).delete(key)
+
+    async def search(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if book_of_key(query.get("key_prefix", "")) is not None:
+            store = await self._route(query["key_prefix"])
+            return await store.search(query) if store is not None else []
+        # Запрос не ограничен книгой: обходим общее хранилище и все файлы книг
+        results = list(await self.fallback.search(query))
+        for state in self.catalog():
+            if state["status"] == ACTIVE:
+                results.extend(await (await self._open(state["path"])).search(query))
+        return results
+
+    def generate_hierarchical_id(self, *parts) -> str:
+        return self.fallback.generate_hierarchical_id(*parts)
+
+    async def _detach(self, book_id: str) -> Optional[Dict[str, Any]]:
+        """Закрывает файл книги в этом процессе и возвращает запись каталога"""
+        cached = self._states.pop(book_id, None)
+        state = self.book_state(book_id)
+        paths = {entry["path"] for entry in (cached, state) if entry is not None}
+        async with self._lock:
+            shards = [self._shards.pop(path, None) for path in paths]
+        for shard in shards:
+            if shard is not None:
+                await _close_store(shard)
+        return state
+
+    @staticmethod
+    def _move(source: str, target: str) -> None:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Вместе с базой переносим журнал WAL, если он не был слит при закрытии
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(source + suffix):
+                os.replace(source + suffix, target + suffix)
+
+    async def archive_book(self, book_id: Any) -> Optional[str]:
+        """
+        Переносит файл книги в архив
+
+        Returns:
+            Optional[str]: Путь к файлу в архиве (None — книга не в отдельном файле или уже в архиве)
+        """
+        state = await self._detach(str(book_id))
+        if state is None or state["status"] != ACTIVE:
+            return None
+        target = os.path.join(self.archive_dir, os.path.basename(state["path"]))
+        await asyncio.to_thread(self._move, state["path"], target)
+        with self._catalog:
+            self._catalog.execute(
+                "UPDATE books SET path = ?, status = ?, archived_at = ? WHERE book_id = ?",
+                (target, ARCHIVED, time.time(), str(book_id))
+            )
+        return target
+
+    async def restore_book(self, book_id: Any) -> Optional[str]:
+        """
+        Возвращает файл книги из архива
+
+        Returns:
+            Optional[str]: Путь к файлу книги (None — книги нет в архиве)
+        """
+        state = await self._detach(str(book_id))
+        if state is None or state["status"] != ARCHIVED:
+            return None
+        target = os.path.join(self.directory, os.path.basename(state["path"]))
+        await asyncio.to_thread(self._move, state["path"], target)
+        with self._catalog:
+            self._catalog.execute(
+                "UPDATE books SET path = ?, status = ?, archived_at = NULL WHERE book_id = ?",
+                (target, ACTIVE, str(book_id))
+            )
+        return target
+
+    async def drop_book(self, book_id: Any) -> bool:
+        """
+        Удаляет файл книги и ее запись в каталоге
+
+        Returns:
+            bool: False — книга хранится в общем хранилище, артефакты нужно удалять по ключам
+        """
+        state = await self._detach(str(book_id))
+        if state is None:
+            return False
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(state["path"] + suffix):
+                os.remove(state["path"] + suffix)
+        with self._catalog:
+            self._catalog.execute("DELETE FROM books WHERE book_id = ?", (str(book_id),))
+        return True
+
+    async def cleanup(self) -> None:
+        async with self._lock:
+            shards, self._shards = list(self._shards.values()), {}
+            self._states = {}
+        for shard in shards:
+            await _close_store(shard)
+        await _close_store(self.fallback)
+        if self._catalog is not None:
+            self._catalog.close()
+            self._catalog = None
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "fallback":
+            raise AttributeError(name)
+        return getattr(self.fallback, name)
+
+
+def store_factory(plugin_class) -> Callable[[str], Any]:
+    """
+    Фабрика хранилищ книг: плагин, открытый на заданном файле
+
+    Имя параметра с путем к базе берется из сигнатуры конструктора плагина,
+    чтобы несовместимая версия cognistruct останавливала запуск, а не первую
+    запись артефакта. Что плагин действительно открыл этот файл, проверяет
+    ShardedStoragePlugin._open.
+
+    Raises:
+        TypeError: Если конструктор плагина не принимает путь к файлу базы
+    """
+    parameters = inspect.signature(plugin_class.__init__).parameters
+    for name in _PATH_PARAMS:
+        param = parameters.get(name)
+        if param is not None and param.kind in (param.POSITIONAL_OR_KEYWORD, param.KEYWORD_ONLY):
+            return lambda path: plugin_class(**{name: path})
+    # Конструктор с **kwargs проверить по сигнатуре нельзя: файл проверяет _open после setup()
+    if any(param.kind == param.VAR_KEYWORD for param in parameters.values()):
+        return lambda path: plugin_class(**{_PATH_PARAMS[0]: path})
+    raise TypeError(
+        f"{plugin_class.__name__}({', '.join(p for p in parameters if p != 'self')}) не принимает путь к файлу базы: "
+        f"раздельное хранение книг (--sharded-storage) с этой версией cognistruct недоступно"
+    )
+
+
+def create_storage():
+    """
+    Создает хранилище артефактов
+
+    GORKY_STORAGE_SHARDS (gorky_agent.py --sharded-storage) включает отдельный
+    файл на каждую книгу в указанной директории; иначе все книги в одном хранилище.
+
+    Raises:
+        TypeError: Если для шардирования плагин хранилища не принимает путь к файлу
+    """
+    from cognistruct.plugins.storage.versioned.plugin import VersionedStoragePlugin
+
+    storage = VersionedStoragePlugin()
+    shard_dir = os.environ.get("GORKY_STORAGE_SHARDS")
+    if not shard_dir:
+        return storage
+    return ShardedStoragePlugin(store_factory(VersionedStoragePlugin), storage, directory=shard_dir)
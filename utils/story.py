@@ -0,0 +1,149 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.manifest import content_hash
+
+logger = logging.getLogger(__name__)
+
+# Сколько разобранных структур держать в памяти (по одной на книгу)
+MAX_CACHED_STORIES = 32
+
+
+@dataclass(slots=True, eq=False)
+class SceneRef:
+    """Сцена книги с готовым ключом артефакта и ссылками на соседей"""
+
+    chapter: "ChapterRef" = field(repr=False)
+    number: int
+    title: str
+    key: str
+    index: int
+    data: Dict[str, Any] = field(repr=False)
+    prev: Optional["SceneRef"] = field(default=None, repr=False)
+    next: Optional["SceneRef"] = field(default=None, repr=False)
+
+    def info(self) -> Dict[str, Any]:
+        """Краткое описание сцены для контекста соседней сцены"""
+        return {
+            'title': self.data['title'],
+            'description': self.data['description'],
+            'characters': self.data['characters'],
+            'location': self.data['location'],
+            'time': self.data['time'],
+            'dramatic_info': self.data['dramatic_info']
+        }
+
+
+@dataclass(slots=True, eq=False)
+class ChapterRef:
+    """Глава книги"""
+
+    number: int
+    title: str
+    data: Dict[str, Any] = field(repr=False)
+    scenes: List[SceneRef] = field(default_factory=list, repr=False)
+
+
+@dataclass(slots=True, eq=False)
+class StoryModel:
+    """
+    Разобранная структура книги (story_structure)
+
+    Строится один раз на версию артефакта: поиск сцены по (глава, сцена)
+    и переход к соседним сценам не требуют обхода всей структуры. Исходные
+    словари глав и сцен доступны в data — их получают шаблоны промптов.
+    """
+
+    chapters: List[ChapterRef]
+    scenes: List[SceneRef]
+    _chapters: Dict[int, ChapterRef] = field(repr=False)
+    _scenes: Dict[Tuple[int, int], SceneRef] = field(repr=False)
+
+    @classmethod
+    def build(cls, structure: Dict[str, Any]) -> "StoryModel":
+        """Строит модель из словаря story_structure"""
+        chapters: List[ChapterRef] = []
+        scenes: List[SceneRef] = []
+        for chapter_data in structure.get('chapters', []):
+            chapter = ChapterRef(chapter_data['number'], chapter_data.get('title', ''), chapter_data)
+            for scene_data in chapter_data.get('scenes', []):
+                scene = SceneRef(
+                    chapter=chapter,
+                    number=scene_data['number'],
+                    title=scene_data.get('title', ''),
+                    key=f"chapter{chapter.number}/scene{scene_data['number']}",
+                    index=len(scenes),
+                    data=scene_data,
+                    prev=scenes[-1] if scenes else None
+                )
+                if scenes:
+                    scenes[-1].next = scene
+                chapter.scenes.append(scene)
+                scenes.append(scene)
+            chapters.append(chapter)
+        return cls(
+            chapters=chapters,
+            scenes=scenes,
+            _chapters={chapter.number: chapter for chapter in chapters},
+            _scenes={(scene.chapter.number, scene.number): scene for scene in scenes}
+        )
+
+    def chapter(self, number: int) -> Optional[ChapterRef]:
+        return self._chapters.get(number)
+
+    def scene(self, chapter_number: int, scene_number: int) -> Optional[SceneRef]:
+        return self._scenes.get((chapter_number, scene_number))
+
+    @property
+    def total(self) -> int:
+        """Общее количество сцен"""
+        return len(self.scenes)
+
+
+_stories: "OrderedDict[str, StoryModel]" = OrderedDict()
+_stories_lock = threading.Lock()
+
+
+def parse_story(value: Any) -> StoryModel:
+    """
+    Возвращает модель структуры книги, разбирая каждую версию один раз
+
+    Args:
+        value: Значение артефакта story_structure (JSON-строка или словарь)
+            либо уже готовая модель
+
+    Returns:
+        StoryModel: Модель структуры
+
+    Raises:
+        ValueError: Если структура не разбирается
+    """
+    if isinstance(value, StoryModel):
+        return value
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Некорректный JSON структуры книги: {e}") from e
+    if not isinstance(value, dict):
+        raise ValueError("Структура книги должна быть объектом")
+
+    key = content_hash(value)
+    with _stories_lock:
+        story = _stories.get(key)
+        if story is not None:
+            _stories.move_to_end(key)
+            return story
+    try:
+        story = StoryModel.build(value)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Некорректная структура книги: {e}") from e
+    with _stories_lock:
+        _stories[key] = story
+        if len(_stories) > MAX_CACHED_STORIES:
+            _stories.popitem(last=False)
+    return story
@@ -0,0 +1,406 @@
+import json
+import logging
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Ожидаемая форма артефактов: словарь — обязательные ключи, список из одного
+# элемента — схема каждого элемента, тип (или кортеж типов) — проверка типа.
+# Проверяются только поля, от которых зависят следующие этапы.
+SCENE_SCHEMA = {
+    "number": int,
+    "title": str,
+    "description": str,
+    "characters": [str],
+    "location": str,
+    "time": str,
+    "dramatic_info": dict,
+}
+
+ARTIFACT_SCHEMAS: Dict[str, Any] = {
+    "creative_brief": {
+        "concept": dict,
+        "book_size": {"chapters": int},
+    },
+    "title": {
+        "title": str,
+    },
+    "story_outline": {
+        "synopsis": str,
+    },
+    "story_structure": {
+        "chapters": [{
+            "number": int,
+            "title": str,
+            "scenes": [SCENE_SCHEMA],
+        }],
+    },
+    "characters": {
+        "characters": [{"name": str}],
+    },
+}
+
+_PATH_PART = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
+
+
+class JSONScanner:
+    """
+    Инкрементальный разбор JSON-ответа LLM
+
+    Принимает текст частями (feed), поэтому подходит и для потоковых ответов.
+    По ходу чтения исправляет типичные дефекты: текст до и после JSON
+    (в том числе блоки ```json), лишние запятые перед } и ]. Отслеживает
+    незакрытые строки и скобки, чтобы отличить обрезанный ответ от
+    синтаксической ошибки и при необходимости аккуратно его закрыть.
+    """
+
+    _CLOSING = {"{": "}", "[": "]"}
+
+    def __init__(self):
+        self.out: List[str] = []
+        self.stack: List[str] = []
+        # Позиции запятых и открывающей скобки для каждого уровня вложенности
+        self.separators: List[List[int]] = []
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.done = False
+        self.pending_comma: Optional[int] = None
+        self.repairs: List[str] = []
+        self._skipped_prefix = False
+        self._skipped_suffix = False
+
+    def _note(self, repair: str) -> None:
+        if repair not in self.repairs:
+            self.repairs.append(repair)
+
+    def feed(self, chunk: str) -> None:
+        """Обрабатывает очередную часть ответа"""
+        for char in chunk:
+            if self.done:
+                if not char.isspace() and not self._skipped_suffix:
+                    self._skipped_suffix = True
+                    self._note("отброшен текст после JSON")
+                continue
+
+            if not self.started:
+                if char in "{[":
+                    self.started = True
+                else:
+                    if not char.isspace() and not self._skipped_prefix:
+                        self._skipped_prefix = True
+                        self._note("отброшен текст перед JSON")
+                    continue
+
+            if self.in_string:
+                self.out.append(char)
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.pending_comma = None
+            elif char in "{[":
+                self.stack.append(char)
+                self.separators.append([len(self.out)])
+                self.pending_comma = None
+            elif char in "}]":
+                if self.pending_comma is not None:
+                    del self.out[self.pending_comma]
+                    self.separators[-1].pop()
+                    self.pending_comma = None
+                    self._note("удалена лишняя запятая")
+                if self.stack:
+                    self.stack.pop()
+                    self.separators.pop()
+                if not self.stack:
+                    self.out.append(char)
+                    self.done = True
+                    continue
+            elif char == ",":
+                self.pending_comma = len(self.out)
+                if self.separators:
+                    self.separators[-1].append(len(self.out))
+            elif not char.isspace():
+                self.pending_comma = None
+            self.out.append(char)
+
+    @property
+    def truncated(self) -> bool:
+        """Ответ оборвался внутри JSON"""
+        return self.started and not self.done
+
+    def text(self) -> str:
+        """Исправленный текст JSON (для обрезанного ответа — как есть)"""
+        return "".join(self.out)
+
+    def close(self) -> str:
+        """
+        Закрывает обрезанный JSON
+
+        Незаконченный последний элемент (обрывок строки, ключ без значения)
+        отбрасывается до ближайшей запятой, затем закрываются все скобки
+
+        Returns:
+            str: Текст, который стоит попробовать разобрать
+        """
+        if not self.truncated:
+            return self.text()
+        self._note("закрыт обрезанный JSON")
+        out = list(self.out)
+        stack = list(self.stack)
+        separators = [list(level) for level in self.separators]
+
+        # Пробуем сохранить последний элемент, затем отбрасываем его целиком
+        for keep_last in (True, False):
+            candidate = list(out)
+            if keep_last:
+                if self.in_string:
+                    if self.escape:
+                        candidate.pop()
+                    candidate.append('"')
+            else:
+                cut = separators[-1][-1]
+                # Запятую удаляем, открывающую скобку оставляем
+                candidate = candidate[:cut] if candidate[cut] == "," else candidate[:cut + 1]
+            text = "".join(candidate).rstrip()
+            if text.endswith(","):
+                text = text[:-1]
+            text += "".join(self._CLOSING[bracket] for bracket in reversed(stack))
+            try:
+                json.loads(text)
+                return text
+            except json.JSONDecodeError:
+                continue
+        return text
+
+
+def parse_json(content: str) -> Tuple[Any, JSONScanner, Optional[str]]:
+    """
+    Разбирает JSON с локальным исправлением
+
+    Returns:
+        Tuple[Any, JSONScanner, Optional[str]]: (значение или None, сканер, ошибка)
+    """
+    scanner = JSONScanner()
+    scanner.feed(content or "")
+    if not scanner.started:
+        return None, scanner, "в ответе нет JSON"
+    if scanner.truncated:
+        return None, scanner, "ответ обрезан"
+    try:
+        return json.loads(scanner.text()), scanner, None
+    except json.JSONDecodeError as e:
+        return None, scanner, str(e)
+
+
+def validate(value: Any, schema: Any, path: str = "") -> List[str]:
+    """
+    Проверяет значение по упрощенной схеме
+
+    Returns:
+        List[str]: Ошибки вида "chapters[0].scenes[1].location: поле отсутствует"
+    """
+    errors = []
+    where = path or "<корень>"
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            return [f"{where}: ожидается объект"]
+        for key, sub_schema in schema.items():
+            sub_path = f"{path}.{key}" if path else key
+            if key not in value or value[key] is None:
+                errors.append(f"{sub_path}: поле отсутствует")
+            else:
+                errors.extend(validate(value[key], sub_schema, sub_path))
+    elif isinstance(schema, list):
+        if not isinstance(value, list):
+            return [f"{where}: ожидается список"]
+        if not value:
+            return [f"{where}: пустой список"]
+        for i, item in enumerate(value):
+            errors.extend(validate(item, schema[0], f"{path}[{i}]"))
+    elif isinstance(schema, (type, tuple)):
+        expected = schema
+        # Числа LLM иногда пишет строками ("3") — это не ошибка схемы
+        if expected is int and isinstance(value, str) and value.strip().isdigit():
+            return []
+        if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+            errors.append(f"{where}: ожидается {getattr(expected, '__name__', expected)}")
+    return errors
+
+
+def parse_path(path: str) -> List[Any]:
+    """Разбирает путь вида chapters[0].scenes[1].title на ключи и индексы"""
+    return [int(index) if index else key for key, index in _PATH_PART.findall(path)]
+
+
+def apply_patch(value: Any, patch: Dict[str, Any]) -> List[str]:
+    """
+    Применяет исправления {путь: значение} к разобранному JSON
+
+    Returns:
+        List[str]: Пути, которые не удалось применить
+    """
+    failed = []
+    for path, new_value in patch.items():
+        parts = parse_path(path)
+        target = value
+        try:
+            for part in parts[:-1]:
+                target = target[part]
+            target[parts[-1]] = new_value
+        except (KeyError, IndexError, TypeError):
+            failed.append(path)
+    return failed
+
+
+CONTINUE_PROMPT = (
+    "Твой ответ оборвался. Продолжи JSON ровно с места обрыва: не повторяй "
+    "уже написанное, не добавляй пояснений и не начинай заново."
+)
+
+PATCH_PROMPT = """В твоем JSON найдены ошибки:
+{errors}
+
+Не переписывай документ целиком. Верни JSON-объект, где ключи — пути из списка ошибок
+(в том же формате, например "chapters[0].scenes[1].location"), а значения — исправленные
+значения этих полей, согласованные с остальным документом."""
+
+FIX_PROMPT = """Твой ответ не разбирается как JSON: {error}
+
+Верни тот же документ исправленным, строго валидным JSON, без пояснений и без изменения содержания."""
+
+
+class StructuredOutput:
+    """
+    Получение структурированного (JSON) артефакта от LLM без полной перегенерации
+
+    Порядок действий:
+    1. локальный разбор с исправлением типичных дефектов;
+    2. для обрезанного ответа — запросы "продолжи с места обрыва";
+    3. для ошибок схемы — запрос исправлений только ошибочных полей;
+    4. для неисправимого синтаксиса — запрос исправить документ;
+    5. если запросы не помогли — локальное закрытие обрезанного JSON.
+    """
+
+    def __init__(self, schema: Any = None, max_continuations: int = 3, max_fixes: int = 2):
+        self.schema = schema
+        self.max_continuations = max_continuations
+        self.max_fixes = max_fixes
+
+    async def complete(self, generate: Callable[[List[Dict[str, str]], str, bool], Awaitable[Any]],
+                       messages: List[Dict[str, str]], content: str) -> Tuple[Optional[Any], List[str]]:
+        """
+        Доводит ответ LLM до значения, прошедшего проверку схемы
+
+        Args:
+            generate: Функция запроса к LLM (сообщения, текст спиннера,
+                нужен ли ответ строго в JSON) -> ответ
+            messages: Сообщения исходного запроса
+            content: Текст исходного ответа
+
+        Returns:
+            Tuple[Optional[Any], List[str]]: (значение или None, журнал исправлений)
+        """
+        log: List[str] = []
+
+        # Обрезанный ответ продолжаем, а не генерируем заново
+        value, scanner, error = parse_json(content)
+        continuations = 0
+        while scanner.truncated and continuations < self.max_continuations:
+            continuations += 1
+            print(f"✂️ Ответ обрезан, запрашиваем продолжение ({continuations}/{self.max_continuations})")
+            response = await generate(
+                messages + [
+                    {"role": "assistant", "content": content},
+                    {"role": "user", "content": CONTINUE_PROMPT}
+                ],
+                "Продолжение ответа",
+                False
+            )
+            tail = response.content if response else ""
+            if not tail:
+                break
+            content += self._strip_fences(tail)
+            log.append("получено продолжение обрезанного ответа")
+            value, scanner, error = parse_json(content)
+
+        if scanner.truncated:
+            # Продолжить не удалось — закрываем JSON локально
+            try:
+                value = json.loads(scanner.close())
+                error = None
+            except json.JSONDecodeError as e:
+                error = str(e)
+
+        fixes = 0
+        while error and fixes < self.max_fixes:
+            fixes += 1
+            print(f"🔧 Ответ не разбирается ({error}), запрашиваем исправление")
+            response = await generate(
+                messages + [
+                    {"role": "assistant", "content": content},
+                    {"role": "user", "content": FIX_PROMPT.format(error=error)}
+                ],
+                "Исправление JSON",
+                True
+            )
+            if not response or not response.content:
+                break
+            content = response.content
+            log.append("синтаксис исправлен повторным запросом")
+            value, scanner, error = parse_json(content)
+            if scanner.truncated:
+                try:
+                    value = json.loads(scanner.close())
+                    error = None
+                except json.JSONDecodeError as e:
+                    error = str(e)
+
+        log.extend(scanner.repairs)
+        if error:
+            logger.error(f"Не удалось получить JSON: {error}")
+            return None, log
+
+        # Ошибки схемы исправляем точечно
+        errors = validate(value, self.schema) if self.schema is not None else []
+        fixes = 0
+        while errors and fixes < self.max_fixes:
+            fixes += 1
+            print(f"🩹 Ошибки схемы ({len(errors)}), запрашиваем исправление полей")
+            for item in errors[:10]:
+                print(f"   - {item}")
+            response = await generate(
+                messages + [
+                    {"role": "assistant", "content": json.dumps(value, ensure_ascii=False)},
+                    {"role": "user", "content": PATCH_PROMPT.format(errors="\n".join(f"- {e}" for e in errors))}
+                ],
+                "Исправление полей",
+                True
+            )
+            patch, _, patch_error = parse_json(response.content if response else "")
+            if patch_error or not isinstance(patch, dict):
+                logger.warning(f"Исправления полей не разобраны: {patch_error}")
+                continue
+            failed = apply_patch(value, patch)
+            if failed:
+                logger.warning(f"Не применены исправления: {failed}")
+            log.append(f"исправлены поля: {', '.join(p for p in patch if p not in failed)}")
+            errors = validate(value, self.schema)
+
+        if errors:
+            logger.error(f"Артефакт не соответствует схеме: {errors[:10]}")
+            return None, log
+        return value, log
+
+    @staticmethod
+    def _strip_fences(text: str) -> str:
+        """Убирает ``` вокруг продолжения, если модель их добавила"""
+        text = re.sub(r"^\s*```(?:json)?\s*\n?", "", text)
+        return re.sub(r"\n?```\s*$", "", text)
@@ -0,0 +1,306 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from utils import DATA_DIR
+from utils.run_control import BudgetExceeded, GenerationCancelled
+
+logger = logging.getLogger(__name__)
+
+# Очередь по умолчанию; GORKY_TASK_QUEUE (gorky_agent.py --task-queue FILE)
+# включает генерацию сцен через очередь, которую разбирают и воркеры --worker
+DEFAULT_QUEUE_PATH = os.path.join(DATA_DIR, "tasks.db")
+
+# Аренда задачи (секунды): воркер продлевает ее каждые LEASE_SECONDS / 3,
+# задача умершего воркера возвращается в очередь после истечения аренды
+LEASE_SECONDS = float(os.environ.get("GORKY_TASK_LEASE", 120))
+MAX_ATTEMPTS = 3
+
+# Состояния задачи
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    book_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    depends_on TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    owner TEXT,
+    lease_expires REAL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status, book_id);
+"""
+
+
+def worker_id() -> str:
+    """Идентификатор процесса-исполнителя (хост:pid)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+@dataclass
+class Task:
+    """Задача, полученная в аренду"""
+
+    id: int
+    key: str
+    kind: str
+    book_id: str
+    payload: Dict[str, Any]
+    attempts: int
+    max_attempts: int
+
+
+class TaskQueue:
+    """
+    Надежная очередь задач на SQLite с арендой
+
+    Задачу получает один исполнитель на время аренды и продлевает ее, пока
+    работает. Если исполнитель пропал, аренда истекает и задача снова
+    становится доступной; после max_attempts попыток она считается
+    проваленной. Задача с depends_on выдается только после выполнения
+    задачи, от которой зависит. Файл очереди могут делить процессы на
+    одной машине или на нескольких машинах с общим диском.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Транзакции открываются явно (BEGIN IMMEDIATE), чтобы выдача задачи была атомарной
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _transaction(self, operation: Callable[[sqlite3.Connection], Any]) -> Any:
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = operation(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    def enqueue(self, key: str, kind: str, book_id: Any, payload: Dict[str, Any],
+                depends_on: Optional[str] = None, max_attempts: int = MAX_ATTEMPTS, reset: bool = False) -> str:
+        """
+        Добавляет задачу (повторное добавление того же ключа не создает дубликат)
+
+        Args:
+            key: Уникальный ключ задачи
+            kind: Тип задачи (по нему исполнитель выбирает обработчик)
+            book_id: ID книги
+            payload: Параметры задачи
+            depends_on: Ключ задачи, которая должна быть выполнена раньше
+            max_attempts: Максимальное количество попыток
+            reset: Вернуть в очередь уже выполненную задачу (ее результат устарел)
+
+        Returns:
+            str: Состояние задачи после добавления
+        """
+        def operation(conn):
+            now = time.time()
+            row = conn.execute("SELECT status FROM tasks WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO tasks (key, kind, book_id, payload, depends_on, max_attempts, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, kind, str(book_id), json.dumps(payload, ensure_ascii=False), depends_on,
+                     max_attempts, now, now)
+                )
+                return PENDING
+            status = row["status"]
+            # Проваленную задачу повторный запуск пробует заново; выданную не трогаем
+            if status == FAILED or (reset and status == DONE):
+                status = PENDING
+            conn.execute(
+                "UPDATE tasks SET payload = ?, depends_on = ?, max_attempts = ?, status = ?, "
+                "attempts = CASE WHEN ? = 'pending' AND status != 'pending' THEN 0 ELSE attempts END, "
+                "error = CASE WHEN ? = 'pending' THEN NULL ELSE error END, updated_at = ? WHERE key = ?",
+                (json.dumps(payload, ensure_ascii=False), depends_on, max_attempts, status,
+                 status, status, now, key)
+            )
+            return status
+
+        return self._transaction(operation)
+
+    def claim(self, owner: str, lease_seconds: float = LEASE_SECONDS, book_id: Any = None) -> Optional[Task]:
+        """
+        Выдает в аренду первую готовую к выполнению задачу
+
+        Args:
+            owner: Идентификатор исполнителя
+            lease_seconds: Срок аренды
+            book_id: Брать задачи только этой книги
+
+        Returns:
+            Optional[Task]: Задача или None, если готовых задач нет
+        """
+        def operation(conn):
+            now = time.time()
+            # Задачи исполнителей, переставших продлевать аренду, возвращаются в очередь
+            conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END, "
+                "owner = NULL, error = 'аренда истекла (' || owner || ')', updated_at = ? "
+                "WHERE status = 'leased' AND lease_expires < ?",
+                (now, now)
+            )
+            query = (
+                "SELECT t.* FROM tasks t LEFT JOIN tasks d ON d.key = t.depends_on "
+                "WHERE t.status = 'pending' AND (t.depends_on IS NULL OR d.id IS NULL OR d.status = 'done')"
+            )
+            params: List[Any] = []
+            if book_id is not None:
+                query += " AND t.book_id = ?"
+                params.append(str(book_id))
+            row = conn.execute(query + " ORDER BY t.id LIMIT 1", params).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE id = ?",
+                (owner, now + lease_seconds, now, row["id"])
+            )
+            return Task(row["id"], row["key"], row["kind"], row["book_id"], json.loads(row["payload"]),
+                        row["attempts"] + 1, row["max_attempts"])
+
+        return self._transaction(operation)
+
+    def _update_owned(self, task: Task, owner: str, assignments: str, params: tuple) -> bool:
+        with self._lock:
+            cursor = self.conn.execute(
+                f"UPDATE tasks SET {assignments}, updated_at = ? WHERE id = ? AND owner = ? AND status = 'leased'",
+                (*params, time.time(), task.id, owner)
+            )
+            return cursor.rowcount == 1
+
+    def heartbeat(self, task: Task, owner: str, lease_seconds: float = LEASE_SECONDS) -> bool:
+        """Продлевает аренду; False — аренда потеряна (задачу забрал другой исполнитель)"""
+        return self._update_owned(task, owner, "lease_expires = ?", (time.time() + lease_seconds,))
+
+    def complete(self, task: Task, owner: str) -> bool:
+        """Отмечает задачу выполненной"""
+        return self._update_owned(task, owner, "status = 'done', owner = NULL, lease_expires = NULL, error = NULL", ())
+
+    def fail(self, task: Task, owner: str, error: str, retry: bool = True) -> bool:
+        """Возвращает задачу в очередь или, если попытки исчерпаны (или retry=False), отмечает проваленной"""
+        status = PENDING if retry and task.attempts < task.max_attempts else FAILED
+        return self._update_owned(task, owner, "status = ?, owner = NULL, lease_expires = NULL, error = ?",
+                                  (status, error[:1000]))
+
+    def release(self, task: Task, owner: str) -> bool:
+        """Возвращает задачу в очередь без траты попытки (остановка исполнителя)"""
+        return self._update_owned(task, owner, "status = 'pending', owner = NULL, lease_expires = NULL, "
+                                               "attempts = MAX(attempts - 1, 0)", ())
+
+    def book_tasks(self, book_id: Any) -> List[Dict[str, Any]]:
+        """Задачи книги в порядке добавления"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT key, kind, status, attempts, owner, error FROM tasks WHERE book_id = ? ORDER BY id",
+                (str(book_id),)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete_book(self, book_id: Any) -> None:
+        """Удаляет задачи книги"""
+        with self._lock:
+            self.conn.execute("DELETE FROM tasks WHERE book_id = ?", (str(book_id),))
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+async def run_leased(queue: TaskQueue, task: Task, owner: str, work: Callable[[], Awaitable[bool]],
+                     lease_seconds: float = LEASE_SECONDS) -> bool:
+    """
+    Выполняет задачу, продлевая аренду, и записывает итог в очередь
+
+    Если аренда потеряна (исполнитель завис дольше срока аренды и задачу
+    забрал другой), работа прерывается: все, что она успела сохранить,
+    отмечено в манифесте книги, и новый исполнитель продолжит с того же места.
+
+    Args:
+        queue: Очередь задач
+        task: Задача в аренде
+        owner: Идентификатор исполнителя
+        work: Корутина выполнения задачи (True — успех)
+        lease_seconds: Срок аренды
+
+    Returns:
+        bool: True если задача выполнена
+
+    Raises:
+        BudgetExceeded: Бюджет книги исчерпан (задача отмечается проваленной
+            без повторов; следующий запуск генерации вернет ее в очередь)
+        GenerationCancelled, asyncio.CancelledError: При остановке исполнителя
+            (задача возвращается в очередь)
+    """
+    job = asyncio.ensure_future(work())
+    lost = False
+
+    async def heartbeat():
+        nonlocal lost
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            if not await asyncio.to_thread(queue.heartbeat, task, owner, lease_seconds):
+                logger.warning(f"Аренда задачи {task.key} потеряна, прерываем выполнение")
+                lost = True
+                job.cancel()
+                return
+
+    beats = asyncio.ensure_future(heartbeat())
+    try:
+        ok = await job
+    except BudgetExceeded as e:
+        await asyncio.shield(asyncio.to_thread(queue.fail, task, owner, str(e), False))
+        raise
+    except GenerationCancelled:
+        await asyncio.shield(asyncio.to_thread(queue.release, task, owner))
+        raise
+    except asyncio.CancelledError:
+        if lost:
+            return False
+        await asyncio.shield(asyncio.to_thread(queue.release, task, owner))
+        raise
+    except Exception as e:
+        logger.exception(f"Ошибка при выполнении задачи {task.key}")
+        await asyncio.to_thread(queue.fail, task, owner, f"{type(e).__name__}: {e}")
+        return False
+    finally:
+        beats.cancel()
+    if ok:
+        await asyncio.to_thread(queue.complete, task, owner)
+    else:
+        await asyncio.to_thread(queue.fail, task, owner, "задача завершилась с ошибкой")
+    return bool(ok)
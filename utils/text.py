@@ -0,0 +1,59 @@
+import re
+from typing import List
+
+# Блок изменений, который редактор добавляет перед текстом:
+# ===== ИЗМЕНЕНИЯ ===== ... ====================
+# (?s) - флаг DOTALL, позволяет . матчить переносы строк
+# (?m) - флаг MULTILINE, обрабатывает текст построчно
+EDITOR_NOTES_PATTERN = re.compile(r"(?sm)==+.*\n==+")
+
+
+def clean_editor_notes(text: str) -> str:
+    """
+    Очищает текст от примечаний редактора
+
+    Args:
+        text: Исходный текст
+
+    Returns:
+        str: Очищенный текст
+    """
+    if not text:
+        return ""
+
+    # Заменяем найденные блоки на пустую строку
+    cleaned_text = EDITOR_NOTES_PATTERN.sub("", text)
+
+    # Убираем двойные переносы строк
+    cleaned_text = re.sub(r"\n{3,}", "\n\n", cleaned_text)
+
+    return cleaned_text.strip()
+
+
+def normalize_text(text: str) -> str:
+    """Приводит «ё» к «е», чтобы «Пётр» находился по запросу «Петр»"""
+    return text.replace("ё", "е").replace("Ё", "Е")
+
+
+def split_paragraphs(text: str) -> List[str]:
+    """Абзацы текста (разделены пустыми строками)"""
+    return [paragraph.strip() for paragraph in re.split(r"\n\s*\n", text or "") if paragraph.strip()]
+
+
+def group_paragraphs(paragraphs: List[str], max_words: int) -> List[List[str]]:
+    """
+    Группирует подряд идущие абзацы в части не длиннее max_words слов
+
+    Абзац длиннее max_words становится отдельной частью
+    """
+    groups: List[List[str]] = []
+    size = 0
+    for paragraph in paragraphs:
+        paragraph_words = len(paragraph.split())
+        if groups and size + paragraph_words <= max_words:
+            groups[-1].append(paragraph)
+            size += paragraph_words
+        else:
+            groups.append([paragraph])
+            size = paragraph_words
+    return groups
@@ -0,0 +1,93 @@
+import re
+from typing import Any, Dict, Iterable, List
+
+from utils.text import clean_editor_notes, normalize_text
+
+WORD_PATTERN = re.compile(r"\w+(?:-\w+)*")
+
+# Веса составляющих общей оценки черновика
+SCORE_WEIGHTS = {
+    "length": 0.4,
+    "characters": 0.4,
+    "variety": 0.2,
+}
+
+
+def words(text: str) -> List[str]:
+    """Слова текста в нижнем регистре (ё приведена к е)"""
+    return WORD_PATTERN.findall(normalize_text(text or "").lower())
+
+
+def length_score(word_count: int, target: int) -> float:
+    """1.0 при попадании в целевой объем, линейно падает до 0 при отклонении на 100%"""
+    if target <= 0:
+        return 1.0
+    return max(0.0, 1.0 - abs(word_count - target) / target)
+
+
+def name_stem(name: str) -> str:
+    """
+    Основа имени для поиска с учетом падежей
+
+    Отбрасываем окончание: «Анна» находится как «Анну», «Анной»
+    """
+    name = normalize_text(name).lower()
+    return name if len(name) <= 3 else name[:-1]
+
+
+def character_coverage(text_words: Iterable[str], characters: Iterable[str]) -> float:
+    """
+    Доля персонажей сцены, упомянутых в тексте
+
+    Персонаж считается упомянутым, если встречается основа любого
+    слова его имени (например, только имя или только фамилия)
+    """
+    names = [name for name in characters if isinstance(name, str) and name.strip()]
+    if not names:
+        return 1.0
+    vocabulary = set(text_words)
+    found = 0
+    for name in names:
+        stems = [name_stem(part) for part in words(name) if len(part) > 2]
+        if any(word.startswith(stem) for stem in stems for word in vocabulary):
+            found += 1
+    return found / len(names)
+
+
+def repetition_ratio(text_words: List[str], n: int = 3) -> float:
+    """Доля повторяющихся n-грамм слов (0 — повторов нет)"""
+    if len(text_words) < n:
+        return 0.0
+    ngrams = [tuple(text_words[i:i + n]) for i in range(len(text_words) - n + 1)]
+    return 1.0 - len(set(ngrams)) / len(ngrams)
+
+
+def score_scene(text: str, target_word_count: int, characters: Iterable[str]) -> Dict[str, Any]:
+    """
+    Быстрая локальная оценка черновика сцены без обращения к LLM
+
+    Args:
+        text: Текст сцены
+        target_word_count: Целевой объем в словах
+        characters: Имена персонажей, которые должны участвовать в сцене
+
+    Returns:
+        Dict[str, Any]: Составляющие оценки и итог 'score' (от 0 до 1)
+    """
+    text_words = words(clean_editor_notes(text))
+    repetition = repetition_ratio(text_words)
+    metrics = {
+        "word_count": len(text_words),
+        "length": length_score(len(text_words), target_word_count),
+        "characters": character_coverage(text_words, characters),
+        "repetition": repetition,
+        "variety": 1.0 - repetition,
+    }
+    metrics["score"] = sum(metrics[name] * weight for name, weight in SCORE_WEIGHTS.items())
+    return metrics
+
+
+def in_cast(name: str, cast: Iterable[str]) -> bool:
+    """Относится ли персонаж к действующим лицам сцены (по основе имени или фамилии)"""
+    stems = [name_stem(part) for member in cast if isinstance(member, str) for part in words(member) if len(part) > 2]
+    return any(word.startswith(stem) for stem in stems for word in words(name))
@@ -0,0 +1,166 @@
+import logging
+import os
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Размер контекста моделей (токенов); для неизвестных моделей — DEFAULT_CONTEXT_TOKENS
+MODEL_CONTEXT_TOKENS = {
+    "deepseek-chat": 64000,
+    "deepseek-reasoner": 64000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+DEFAULT_CONTEXT_TOKENS = 32000
+
+# Сколько токенов контекста оставлять под ответ модели
+DEFAULT_OUTPUT_RESERVE = 8192
+
+# Накладные расходы на одно сообщение чата (роль, служебные токены)
+MESSAGE_OVERHEAD = 4
+
+
+class TokenEstimator:
+    """
+    Локальная оценка числа токенов промпта
+
+    Использует tiktoken, если он установлен, иначе — эвристику по символам
+    (кириллица дробится на токены мельче латиницы). Поправочный коэффициент
+    подстраивается по фактическому prompt_tokens из ответов провайдера.
+    Словарь tiktoken загружается при первой оценке, а не при импорте.
+    """
+
+    def __init__(self, encoding: str = "cl100k_base"):
+        self._encoding_name = encoding
+        self._encoding = None
+        self._loaded = False
+        self.ratio = 1.0
+        self._lock = threading.Lock()
+
+    def _get_encoding(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    try:
+                        import tiktoken
+                        self._encoding = tiktoken.get_encoding(self._encoding_name)
+                    except ImportError:
+                        # Необязательная зависимость: без нее работает эвристика
+                        pass
+                    except Exception as e:
+                        logger.warning(f"tiktoken недоступен, используется эвристика: {e}")
+                    self._loaded = True
+        return self._encoding
+
+    @property
+    def method(self) -> str:
+        return "tiktoken" if self._get_encoding() is not None else "heuristic"
+
+    def raw_count(self, text: str) -> int:
+        """Оценка без поправочного коэффициента"""
+        if not text:
+            return 0
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        ascii_chars = sum(1 for char in text if ord(char) < 128)
+        other_chars = len(text) - ascii_chars
+        return int(ascii_chars / 4 + other_chars / 2.5) + 1
+
+    def count(self, text: str) -> int:
+        """Оценка числа токенов текста"""
+        return int(self.raw_count(text) * self.ratio)
+
+    def count_messages(self, messages: List[Dict[str, Any]]) -> int:
+        """Оценка числа токенов промпта из сообщений чата"""
+        return sum(self.count(str(message.get("content") or "")) + MESSAGE_OVERHEAD for message in messages)
+
+    def calibrate(self, estimated: int, actual: int) -> None:
+        """Подстраивает коэффициент по фактическому числу токенов (скользящее среднее)"""
+        if estimated <= 0 or actual <= 0:
+            return
+        with self._lock:
+            observed = self.ratio * actual / estimated
+            self.ratio = min(2.0, max(0.5, 0.8 * self.ratio + 0.2 * observed))
+
+
+# Общий оценщик процесса (коэффициент накапливается по всем запросам)
+estimator = TokenEstimator()
+
+
+def context_budget(model: Optional[str], output_reserve: int = DEFAULT_OUTPUT_RESERVE) -> int:
+    """
+    Бюджет токенов промпта для модели
+
+    GORKY_CONTEXT_BUDGET переопределяет бюджет явно
+    """
+    override = os.environ.get("GORKY_CONTEXT_BUDGET")
+    if override:
+        return int(override)
+    context = MODEL_CONTEXT_TOKENS.get(model or "", DEFAULT_CONTEXT_TOKENS)
+    return max(context - output_reserve, 1024)
+
+
+def keep_tail(text: str, max_tokens: int) -> str:
+    """
+    Оставляет конец текста в пределах max_tokens, начиная с целого абзаца или предложения
+
+    Для предыдущей сцены важнее всего ее окончание
+    """
+    if not text or estimator.count(text) <= max_tokens:
+        return text
+    # Доля текста, которая помещается в бюджет
+    keep_chars = int(len(text) * max_tokens / max(estimator.count(text), 1))
+    tail = text[-keep_chars:] if keep_chars > 0 else ""
+    boundary = re.search(r"\n\s*\n|(?<=[.!?…])\s+", tail)
+    if boundary and boundary.end() < len(tail) // 2:
+        tail = tail[boundary.end():]
+    return "…\n\n" + tail.lstrip() if tail else ""
+
+
+class ContextPlanner:
+    """
+    Подгоняет промпт под бюджет токенов до отправки запроса
+
+    Промпт собирается функцией render из параметров. Пока оценка превышает
+    бюджет, по очереди применяются сокращения — от наименее важных частей
+    к более важным — и промпт собирается заново.
+    """
+
+    def __init__(self, budget: int, token_estimator: Optional[TokenEstimator] = None):
+        self.budget = budget
+        self.estimator = token_estimator or estimator
+
+    def fit(self, render: Callable[[Dict[str, Any]], List[Dict[str, Any]]], params: Dict[str, Any],
+            reductions: List[Tuple[str, Callable[[Dict[str, Any], int], bool]]]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Args:
+            render: Собирает сообщения из параметров
+            params: Параметры промпта (сокращения изменяют их)
+            reductions: Пары (название, функция); функция получает параметры
+                и сколько токенов нужно освободить и возвращает True, если
+                что-то сократила. Функция может применяться повторно.
+
+        Returns:
+            Tuple[List[Dict[str, Any]], Dict[str, Any]]: (сообщения, план:
+                budget, initial, planned, reductions)
+        """
+        messages = render(params)
+        initial = planned = self.estimator.count_messages(messages)
+        applied: List[str] = []
+        for name, reduce in reductions:
+            while planned > self.budget:
+                if not reduce(params, planned - self.budget):
+                    break
+                applied.append(name)
+                messages = render(params)
+                planned = self.estimator.count_messages(messages)
+            if planned <= self.budget:
+                break
+
+        plan = {"budget": self.budget, "initial": initial, "planned": planned, "reductions": applied}
+        if applied:
+            logger.info(f"Промпт сокращен с ~{initial} до ~{planned} токенов (бюджет {self.budget}): {', '.join(applied)}")
+        return messages, plan
@@ -0,0 +1,235 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from utils import DATA_DIR
+from utils.run_control import GenerationCancelled
+
+logger = logging.getLogger(__name__)
+
+# Файл трасс в формате OTLP JSON (одна строка — один ExportTraceServiceRequest);
+# интервалы книг пишутся в соседние файлы по книгам (см. book_trace_file).
+# GORKY_TRACE_FILE=off выключает трассировку
+TRACE_FILE = os.environ.get("GORKY_TRACE_FILE", os.path.join(DATA_DIR, "traces.jsonl"))
+
+SERVICE_NAME = "gorky"
+
+# Коды статуса OTLP
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+def book_trace_file(path: str, book_id: Any) -> str:
+    """Файл трасс книги рядом с общим: traces.jsonl -> traces.book<ID>.jsonl"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.book{book_id}{ext}"
+
+
+def _attribute_value(value: Any) -> Dict[str, Any]:
+    """Значение атрибута в кодировке OTLP JSON"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64 в OTLP JSON передается строкой
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _plain_value(value: Dict[str, Any]) -> Any:
+    """Обратное преобразование значения атрибута OTLP"""
+    if "intValue" in value:
+        return int(value["intValue"])
+    for key in ("boolValue", "doubleValue", "stringValue"):
+        if key in value:
+            return value[key]
+    return None
+
+
+class Span:
+    """Интервал трассы: книга, этап, сцена, черновик/правка или запрос к LLM"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns",
+                 "attributes", "status", "message")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+        self.status = STATUS_UNSET
+        self.message = ""
+
+    def set(self, **attributes) -> None:
+        """Добавляет атрибуты (например, токены из ответа)"""
+        self.attributes.update({key: value for key, value in attributes.items() if value is not None})
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [{"key": key, "value": _attribute_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": self.status, **({"message": self.message} if self.message else {})},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class Tracer:
+    """
+    Трассировка пайплайна с записью в файл OTLP JSON Lines
+
+    Родительский интервал передается через contextvars, поэтому вложенность
+    сохраняется и в задачах asyncio.gather. Каждый завершенный интервал
+    дописывается одной строкой в файл своей книги (book_trace_file), чтобы
+    страница трасс не перечитывала запуски всех книг; интервалы без книги —
+    в общий файл.
+    """
+
+    def __init__(self, path: Optional[str] = TRACE_FILE):
+        self.path = path if path and path != "off" else None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    @contextmanager
+    def span(self, name: str, new_trace: bool = False, **attributes) -> Iterator[Optional[Span]]:
+        """
+        Открывает интервал на время блока with
+
+        Args:
+            name: Имя интервала
+            new_trace: Начать новую трассу (например, запуск генерации книги)
+            **attributes: Атрибуты интервала
+
+        Yields:
+            Optional[Span]: Интервал (None, если трассировка выключена)
+        """
+        if not self.enabled:
+            yield None
+            return
+        parent = None if new_trace else _current_span.get()
+        trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        if parent:
+            # Атрибуты книги наследуются, чтобы фильтровать трассы по book_id
+            attributes = {"book_id": parent.attributes.get("book_id"), **attributes}
+        span = Span(name, trace_id, parent.span_id if parent else None, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+            if span.status == STATUS_UNSET:
+                span.status = STATUS_OK
+        except (GenerationCancelled, asyncio.CancelledError):
+            span.status, span.message = STATUS_ERROR, "cancelled"
+            raise
+        except BaseException as e:
+            span.status, span.message = STATUS_ERROR, f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+            self.export(span)
+
+    def export(self, span: Span) -> None:
+        """Дописывает интервал в файл трасс его книги"""
+        record = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": [span.to_otlp()]}]
+            }]
+        }
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        book_id = span.attributes.get("book_id")
+        path = book_trace_file(self.path, book_id) if book_id is not None else self.path
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(line)
+        except OSError as e:
+            logger.error(f"Не удалось записать трассу: {e}")
+
+
+def current_span() -> Optional[Span]:
+    """Текущий интервал (None вне трассы)"""
+    return _current_span.get()
+
+
+def read_spans(path: str = TRACE_FILE, book_id: Optional[Any] = None,
+               trace_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Читает интервалы из файла трасс
+
+    С book_id читается только файл книги; общий файл — лишь для книги, у
+    которой его еще нет (трассы, записанные до разделения по книгам).
+
+    Args:
+        path: Общий файл трасс
+        book_id: Оставить только интервалы книги
+        trace_id: Оставить только интервалы трассы
+
+    Returns:
+        List[Dict[str, Any]]: Интервалы (trace_id, span_id, parent_id, name,
+            start, end в секундах, attributes, status, message)
+    """
+    spans: List[Dict[str, Any]] = []
+    if not path:
+        return spans
+    if book_id is not None and os.path.exists(book_trace_file(path, book_id)):
+        path = book_trace_file(path, book_id)
+    if not os.path.exists(path):
+        return spans
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            # Строки чужих трасс пропускаем, не разбирая JSON
+            if trace_id and trace_id not in line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            for resource in record.get("resourceSpans", []):
+                for scope in resource.get("scopeSpans", []):
+                    for raw in scope.get("spans", []):
+                        if trace_id and raw["traceId"] != trace_id:
+                            continue
+                        attributes = {item["key"]: _plain_value(item["value"]) for item in raw.get("attributes", [])}
+                        if book_id is not None and str(attributes.get("book_id")) != str(book_id):
+                            continue
+                        spans.append({
+                            "trace_id": raw["traceId"],
+                            "span_id": raw["spanId"],
+                            "parent_id": raw.get("parentSpanId"),
+                            "name": raw["name"],
+                            "start": int(raw["startTimeUnixNano"]) / 1e9,
+                            "end": int(raw["endTimeUnixNano"]) / 1e9,
+                            "attributes": attributes,
+                            "status": raw.get("status", {}).get("code", STATUS_UNSET),
+                            "message": raw.get("status", {}).get("message", ""),
+                        })
+    return spans
+
+
+# Общий трассировщик процесса
+tracer = Tracer()
@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from utils import DATA_DIR
+from utils.manifest import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+USAGE_DIR = os.path.join(DATA_DIR, "usage")
+
+# Счетчики, которые накапливаются по книге и по этапам
+COUNTERS = ("requests", "prompt_tokens", "completion_tokens", "cache_hit_tokens", "cache_miss_tokens")
+
+# Цены моделей в долларах за 1M токенов: (промпт из кэша, промпт без кэша, ответ)
+PRICES: Dict[str, Tuple[float, float, float]] = {
+    "deepseek-chat": (0.07, 0.27, 1.10),
+    "deepseek-reasoner": (0.14, 0.55, 2.19),
+    "gpt-4o": (1.25, 2.50, 10.00),
+    "gpt-4o-mini": (0.075, 0.15, 0.60),
+}
+# Цена неизвестной модели: лучше переоценить расход, чем не заметить его
+DEFAULT_PRICE = PRICES["gpt-4o"]
+
+# Бюджет книги в долларах по умолчанию (metadata["budget"] проекта важнее)
+DEFAULT_BUDGET = os.environ.get("GORKY_BOOK_BUDGET")
+
+
+def usage_to_dict(usage: Any) -> Dict[str, Any]:
+    """Приводит объект usage из ответа LLM к словарю"""
+    if not usage:
+        return {}
+    if isinstance(usage, dict):
+        return dict(usage)
+    if hasattr(usage, "model_dump"):
+        return usage.model_dump()
+    return {k: v for k, v in vars(usage).items() if not k.startswith("_")}
+
+
+def cache_tokens(usage: Dict[str, Any]) -> Tuple[int, int]:
+    """
+    Токены промпта, взятые из кэша провайдера и пересчитанные заново
+
+    DeepSeek сообщает prompt_cache_hit_tokens/prompt_cache_miss_tokens,
+    OpenAI-совместимые провайдеры — prompt_tokens_details.cached_tokens
+
+    Returns:
+        Tuple[int, int]: (попадания в кэш, промахи); (0, 0), если провайдер не сообщает о кэше
+    """
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    hit = usage.get("prompt_cache_hit_tokens")
+    if hit is not None:
+        miss = usage.get("prompt_cache_miss_tokens")
+        return hit, miss if miss is not None else max(prompt_tokens - hit, 0)
+    details = usage.get("prompt_tokens_details") or {}
+    if not isinstance(details, dict):
+        details = vars(details)
+    hit = details.get("cached_tokens")
+    if hit is None:
+        # Провайдер не сообщает о кэше
+        return 0, 0
+    return hit, max(prompt_tokens - hit, 0)
+
+
+def model_price(model: Optional[str]) -> Tuple[float, float, float]:
+    """Цены модели за 1M токенов (промпт из кэша, промпт без кэша, ответ)"""
+    if model in PRICES:
+        return PRICES[model]
+    # Версии с датой (gpt-4o-2024-08-06) тарифицируются как базовая модель
+    for name in sorted(PRICES, key=len, reverse=True):
+        if model and model.startswith(name):
+            return PRICES[name]
+    return DEFAULT_PRICE
+
+
+def request_cost(counters: Dict[str, int], model: Optional[str]) -> float:
+    """
+    Стоимость запроса в долларах
+
+    Args:
+        counters: Счетчики запроса (prompt_tokens, completion_tokens, cache_hit_tokens)
+        model: Имя модели
+
+    Returns:
+        float: Стоимость
+    """
+    hit_price, miss_price, output_price = model_price(model)
+    hit = counters.get("cache_hit_tokens", 0)
+    miss = max(counters.get("prompt_tokens", 0) - hit, 0)
+    return (hit * hit_price + miss * miss_price + counters.get("completion_tokens", 0) * output_price) / 1_000_000
+
+
+def book_budget(metadata: Optional[Dict[str, Any]]) -> Optional[float]:
+    """Бюджет книги в долларах (None — без ограничения)"""
+    value = (metadata or {}).get("budget", DEFAULT_BUDGET)
+    try:
+        return float(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        logger.warning(f"Некорректный бюджет книги: {value!r}")
+        return None
+
+
+def cache_hit_rate(counters: Dict[str, int]) -> Optional[float]:
+    """Доля токенов промпта из кэша (None, если провайдер не сообщает о кэше)"""
+    total = counters.get("cache_hit_tokens", 0) + counters.get("cache_miss_tokens", 0)
+    if not total:
+        return None
+    return counters.get("cache_hit_tokens", 0) / total
+
+
+class BookUsage:
+    """
+    Расход токенов книги: итог и разбивка по этапам
+
+    Хранится в data/usage/book<id>.json и пополняется после каждого
+    запроса к LLM. Кроме токенов учитывается стоимость (cost, в долларах)
+    по таблице цен PRICES.
+    """
+
+    _cache: Dict[str, "BookUsage"] = {}
+
+    def __init__(self, book_id: Any, path: str):
+        self.book_id = str(book_id)
+        self.path = path
+        self.totals: Dict[str, int] = dict.fromkeys(COUNTERS, 0)
+        self.stages: Dict[str, Dict[str, int]] = {}
+        self.load()
+
+    @classmethod
+    def for_book(cls, book_id: Any, directory: Optional[str] = None) -> "BookUsage":
+        """Возвращает (кэшированный) учет расхода книги"""
+        path = os.path.join(directory or USAGE_DIR, f"book{book_id}.json")
+        usage = cls._cache.get(path)
+        if usage is None:
+            usage = cls._cache[path] = cls(book_id, path)
+        return usage
+
+    @classmethod
+    def read(cls, book_id: Any, directory: Optional[str] = None) -> "BookUsage":
+        """Читает учет расхода с диска без кэша (для других процессов, например веб-интерфейса)"""
+        return cls(book_id, os.path.join(directory or USAGE_DIR, f"book{book_id}.json"))
+
+    @property
+    def cost(self) -> float:
+        """Потраченная сумма в долларах"""
+        return self.totals.get("cost", 0.0)
+
+    def average_completion(self, stage: Optional[str] = None) -> int:
+        """Средняя длина ответа этапа (или всей книги) в токенах (0, если запросов еще не было)"""
+        counters = self.totals if stage is None else self.stages.get(stage) or {}
+        requests = counters.get("requests", 0)
+        return counters.get("completion_tokens", 0) // requests if requests else 0
+
+    def summary(self) -> Dict[str, Any]:
+        """Сводка расхода для метаданных проекта: итог и разбивка по этапам"""
+        keys = ("requests", "prompt_tokens", "completion_tokens", "cache_hit_tokens", "cost")
+        return {
+            **{key: round(self.totals.get(key, 0), 4) for key in keys},
+            "stages": {
+                stage: {key: round(counters.get(key, 0), 4) for key in keys}
+                for stage, counters in self.stages.items()
+            }
+        }
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.totals.update(data.get("totals", {}))
+            self.stages = data.get("stages", {})
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Не удалось прочитать учет расхода {self.path}: {e}")
+
+    def save(self) -> None:
+        write_json_atomic(self.path, {
+            "book_id": self.book_id,
+            "totals": self.totals,
+            "stages": self.stages
+        })
+
+    def record(self, stage: str, usage: Dict[str, Any], model: Optional[str] = None,
+               interrupted: bool = False) -> Dict[str, Any]:
+        """
+        Учитывает один ответ LLM
+
+        Args:
+            stage: Имя этапа
+            usage: Словарь usage из ответа
+            model: Имя модели (для стоимости)
+            interrupted: Прерванный запрос (проигравший страховочный или по
+                таймауту): токены и стоимость учитываются, а в requests он не
+                входит, чтобы не занижать среднюю длину ответа для прогноза бюджета
+
+        Returns:
+            Dict[str, Any]: Счетчики этого запроса, включая стоимость cost
+        """
+        hit, miss = cache_tokens(usage)
+        delta = {
+            "interrupted_requests" if interrupted else "requests": 1,
+            "prompt_tokens": usage.get("prompt_tokens") or 0,
+            "completion_tokens": usage.get("completion_tokens") or 0,
+            "cache_hit_tokens": hit,
+            "cache_miss_tokens": miss,
+        }
+        delta["cost"] = request_cost(delta, model)
+        stage_counters = self.stages.setdefault(stage, dict.fromkeys(COUNTERS, 0))
+        for name, value in delta.items():
+            self.totals[name] = self.totals.get(name, 0) + value
+            stage_counters[name] = stage_counters.get(name, 0) + value
+        return delta
+
+    def add(self, stage: str, name: str, value: int = 1) -> None:
+        """Увеличивает счетчик книги и этапа, не связанный с ответом LLM (например, пропущенные правки)"""
+        stage_counters = self.stages.setdefault(stage, dict.fromkeys(COUNTERS, 0))
+        self.totals[name] = self.totals.get(name, 0) + value
+        stage_counters[name] = stage_counters.get(name, 0) + value
+
+    def delete(self) -> None:
+        """Удаляет учет расхода книги"""
+        self._cache.pop(self.path, None)
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,13 +1,22 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from typing import Dict, List, Optional
+import asyncio
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 import json
 import os
 
-from cognistruct.plugins.storage.versioned.plugin import VersionedStoragePlugin
 from cognistruct.plugins.storage.project.plugin import ProjectStoragePlugin
+from utils.diff import word_diff, DELETE, INSERT
+from utils.profiling import LoopProfiler, profile_enabled
+from utils.events import event_bus
+from utils.search_index import SearchIndex
+from utils.storage import ReadOnlyStorage, create_storage
+from utils.story import parse_story
+from utils.tracing import TRACE_FILE, read_spans
+from utils.usage import BookUsage, book_budget
 
 app = FastAPI(title="Gorky AI Web Interface")
 
@@ -17,15 +26,52 @@ app.mount("/static", StaticFiles(directory="web/static"), name="static")
 # Инициализируем шаблоны
 templates = Jinja2Templates(directory="web/templates")
 
-# Инициализируем хранилище
-storage = VersionedStoragePlugin()
+# Веб-интерфейс в отдельных процессах открывает хранилище только на чтение
+# и получает события пайплайна через файл (см. gorky_agent.start_web_process)
+READ_ONLY = os.environ.get("GORKY_STORAGE_READONLY") == "1"
+EVENTS_FILE = os.environ.get("GORKY_EVENTS_FILE")
+
+# Инициализируем хранилище (общее или по файлу на книгу, как у процесса генерации)
+storage = create_storage()
 project_storage = ProjectStoragePlugin()
+if READ_ONLY:
+    storage = ReadOnlyStorage(storage)
+    project_storage = ReadOnlyStorage(project_storage)
+
+# Полнотекстовый индекс, который пополняет процесс генерации
+search_index = SearchIndex(os.environ.get("GORKY_SEARCH_INDEX", "data/search.db"))
+
+# Интервал keep-alive комментариев в SSE-потоке (секунды)
+SSE_KEEPALIVE = 15
+
+# Кэш диффов между версиями: версии артефактов неизменяемы,
+# поэтому результат для (ключ, v1, v2) можно хранить без инвалидации
+DIFF_CACHE_SIZE = 256
+# Пределы пословного диффа: время Майерса растет с произведением длины
+# текстов на число правок, поэтому сильно переписанные фрагменты (больше
+# DIFF_MAX_EDITS слов) и слишком большие тексты показываются заменой целиком
+DIFF_MAX_EDITS = 1000
+DIFF_MAX_CHARS = 400_000
+_diff_cache: "OrderedDict[Tuple[str, int, int], List[List[str]]]" = OrderedDict()
 
 @app.on_event("startup")
 async def startup_event():
     """Инициализация при запуске сервера"""
     await storage.setup()
     await project_storage.setup()
+    if EVENTS_FILE:
+        app.state.events_task = asyncio.create_task(event_bus.follow_file(EVENTS_FILE))
+    # gorky_agent.py --profile: отчет пишет каждый процесс веб-сервера
+    app.state.profiler = None
+    if profile_enabled():
+        app.state.profiler = LoopProfiler("web")
+        app.state.profiler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Запись отчета профилирования при остановке сервера"""
+    if app.state.profiler:
+        await app.state.profiler.stop()
 
 def get_book_path(book_id: str, *parts: str) -> str:
     """
@@ -73,6 +119,47 @@ async def get_latest_artifact(book_id: str, artifact_path: str) -> Optional[Dict
     full_path = get_book_path(book_id, artifact_path)
     return await storage.read(full_path)
 
+async def get_version_count(book_id: str, artifact_path: str) -> int:
+    """Возвращает количество версий артефакта без чтения всех версий"""
+    latest = await get_latest_artifact(book_id, artifact_path)
+    if not latest:
+        return 0
+    return latest.get('version', 0)
+
+async def get_artifact_version(book_id: str, artifact_path: str, version: int) -> Optional[Dict]:
+    """Получает конкретную версию артефакта"""
+    full_path = get_book_path(book_id, artifact_path)
+    return await storage.read(full_path, version=version)
+
+async def get_versions_diff(book_id: str, artifact_path: str, v1: int, v2: int) -> Optional[List[List[str]]]:
+    """
+    Возвращает пословный дифф между двумя версиями артефакта
+    
+    Результат кэшируется по (ключ, v1, v2)
+    """
+    cache_key = (get_book_path(book_id, artifact_path), v1, v2)
+    if cache_key in _diff_cache:
+        _diff_cache.move_to_end(cache_key)
+        return _diff_cache[cache_key]
+    
+    version1 = await get_artifact_version(book_id, artifact_path, v1)
+    version2 = await get_artifact_version(book_id, artifact_path, v2)
+    if not version1 or not version2:
+        return None
+    
+    text1 = str(version1.get('value') or '')
+    text2 = str(version2.get('value') or '')
+    if len(text1) + len(text2) > DIFF_MAX_CHARS:
+        # Слишком большие тексты не сравниваем: показываем замену целиком
+        diff = [[op, text] for op, text in ((DELETE, text1), (INSERT, text2)) if text]
+    else:
+        # Дифф считается в потоке, чтобы не останавливать SSE-потоки и другие запросы
+        diff = await asyncio.to_thread(word_diff, text1, text2, DIFF_MAX_EDITS)
+    _diff_cache[cache_key] = diff
+    if len(_diff_cache) > DIFF_CACHE_SIZE:
+        _diff_cache.popitem(last=False)
+    return diff
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     """Главная страница со списком книг"""
@@ -107,18 +194,25 @@ async def book_details(request: Request, book_id: str):
             {"request": request, "message": "Книга не найдена"}
         )
     
+    try:
+        story = parse_story(story_structure.get('value'))
+    except ValueError:
+        return templates.TemplateResponse(
+            "error.html",
+            {"request": request, "message": "Структура книги повреждена"}
+        )
+    
+    usage = await book_usage(book_id)
+    
     # Собираем информацию о сценах
     scenes = []
-    for chapter in story_structure.get('value', {}).get('chapters', []):
-        for scene in chapter.get('scenes', []):
-            scene_path = f"chapter{chapter['number']}/scene{scene['number']}"
-            scene_versions = await get_artifact_versions(book_id, scene_path)
-            scenes.append({
-                'chapter': chapter['number'],
-                'scene': scene['number'],
-                'title': scene.get('title', ''),
-                'versions': len(scene_versions)
-            })
+    for scene in story.scenes:
+        scenes.append({
+            'chapter': scene.chapter.number,
+            'scene': scene.number,
+            'title': scene.title,
+            'versions': await get_version_count(book_id, scene.key)
+        })
     
     return templates.TemplateResponse(
         "book.html",
@@ -126,13 +220,41 @@ async def book_details(request: Request, book_id: str):
             "request": request,
             "book_id": book_id,
             "title": title.get('value', {}).get('title', ''),
-            "scenes": scenes
+            "scenes": scenes,
+            "usage": usage
         }
     )
 
+async def book_usage(book_id: str) -> Dict:
+    """
+    Расход токенов и стоимость книги по этапам
+    
+    Файл учета пополняет процесс генерации, поэтому читается без кэша
+    """
+    usage = await asyncio.to_thread(BookUsage.read, book_id)
+    budget = None
+    try:
+        project = await project_storage.read(int(book_id))
+        budget = book_budget(project.metadata) if project else None
+    except ValueError:
+        pass
+    totals = usage.summary()
+    return {
+        "stages": totals.pop("stages"),
+        "totals": totals,
+        "budget": budget,
+        "remaining": max(budget - usage.cost, 0) if budget is not None else None
+    }
+
+@app.get("/api/book/{book_id}/usage")
+async def api_usage(book_id: str):
+    """Расход токенов и стоимость книги (JSON)"""
+    return await book_usage(book_id)
+
 @app.get("/book/{book_id}/scene/{chapter_num}/{scene_num}", response_class=HTMLResponse)
-async def scene_versions(request: Request, book_id: str, chapter_num: int, scene_num: int):
-    """Страница сравнения версий сцены"""
+async def scene_versions(request: Request, book_id: str, chapter_num: int, scene_num: int,
+                         v1: Optional[int] = None, v2: Optional[int] = None):
+    """Страница сравнения версий сцены (загружает только две выбранные версии)"""
     # Получаем название книги для breadcrumbs
     title_artifact = await get_latest_artifact(book_id, 'title')
     if not title_artifact:
@@ -142,19 +264,32 @@ async def scene_versions(request: Request, book_id: str, chapter_num: int, scene
         )
     book_title = title_artifact.get('value', {}).get('title', f'Книга {book_id}')
     
-    # Получаем версии сцены
+    # Узнаем количество версий по последней версии сцены
     scene_path = f"chapter{chapter_num}/scene{scene_num}"
-    versions = await get_artifact_versions(book_id, scene_path)
+    version_count = await get_version_count(book_id, scene_path)
     
-    if not versions:
+    if not version_count:
         return templates.TemplateResponse(
             "error.html",
             {"request": request, "message": "Сцена не найдена"}
         )
     
-    # Добавляем промпты к версиям
-    for version in versions:
-        version['prompt'] = version.get('metadata', {}).get('prompt', '')
+    # По умолчанию сравниваем первую и последнюю версии
+    v1 = min(max(v1 or 1, 1), version_count)
+    v2 = min(max(v2 or version_count, 1), version_count)
+    
+    selected = {}
+    for number in {v1, v2}:
+        version = await get_artifact_version(book_id, scene_path, number)
+        if not version:
+            return templates.TemplateResponse(
+                "error.html",
+                {"request": request, "message": f"Версия {number} не найдена"}
+            )
+        selected[number] = {
+            'text': version.get('value', ''),
+            'prompt': version.get('metadata', {}).get('prompt', '')
+        }
     
     return templates.TemplateResponse(
         "scene_versions.html",
@@ -164,10 +299,23 @@ async def scene_versions(request: Request, book_id: str, chapter_num: int, scene
             "title": book_title,  # Добавляем название книги
             "chapter_num": chapter_num,
             "scene_num": scene_num,
-            "versions": versions
+            "version_count": version_count,
+            "v1": v1,
+            "v2": v2,
+            "version1": selected[v1],
+            "version2": selected[v2]
         }
     )
 
+@app.get("/book/{book_id}/scene/{chapter_num}/{scene_num}/diff")
+async def scene_diff(book_id: str, chapter_num: int, scene_num: int, v1: int, v2: int):
+    """Пословный дифф между двумя версиями сцены"""
+    scene_path = f"chapter{chapter_num}/scene{scene_num}"
+    diff = await get_versions_diff(book_id, scene_path, v1, v2)
+    if diff is None:
+        return JSONResponse({"error": "Версия не найдена"}, status_code=404)
+    return {"v1": v1, "v2": v2, "diff": diff}
+
 @app.get("/book/{book_id}/prompt/{artifact_path:path}", response_class=HTMLResponse)
 async def prompt_response(request: Request, book_id: str, artifact_path: str):
     """Страница с промптом и ответом"""
@@ -199,4 +347,153 @@ async def prompt_response(request: Request, book_id: str, artifact_path: str):
             "prompt": artifact.get('metadata', {}).get('prompt', ''),
             "response": json.dumps(response) if isinstance(response, (dict, list)) else response
         }
-    ) 
\ No newline at end of file
+    )
+
+def build_waterfall(spans: List[Dict], trace_id: Optional[str] = None) -> Optional[Dict]:
+    """
+    Раскладывает интервалы трассы для временной диаграммы
+    
+    Args:
+        spans: Интервалы книги из файла трасс
+        trace_id: Трасса (по умолчанию — последний запуск)
+        
+    Returns:
+        Optional[Dict]: Трасса с интервалами в порядке обхода дерева (offset и
+        width — доли от длительности трассы, depth — вложенность) или None
+    """
+    if not trace_id:
+        roots = [span for span in spans if not span['parent_id']]
+        if not roots:
+            return None
+        trace_id = max(roots, key=lambda span: span['start'])['trace_id']
+    trace = [span for span in spans if span['trace_id'] == trace_id]
+    if not trace:
+        return None
+    
+    start = min(span['start'] for span in trace)
+    end = max(span['end'] for span in trace)
+    total = max(end - start, 1e-6)
+    children: Dict[Optional[str], List[Dict]] = {}
+    known = {span['span_id'] for span in trace}
+    for span in sorted(trace, key=lambda span: span['start']):
+        # Родитель мог не записаться (запуск прерван) — показываем интервал от корня
+        parent = span['parent_id'] if span['parent_id'] in known else None
+        children.setdefault(parent, []).append(span)
+    
+    rows = []
+    stack = [(span, 0) for span in reversed(children.get(None, []))]
+    while stack:
+        span, depth = stack.pop()
+        duration = span['end'] - span['start']
+        rows.append({
+            **span,
+            'depth': depth,
+            'duration': duration,
+            'offset': (span['start'] - start) / total * 100,
+            'width': max(duration / total * 100, 0.2),
+            'label': next((span['attributes'][key] for key in ('scene', 'provider', 'stage', 'book_name')
+                           if span['attributes'].get(key)), '')
+        })
+        stack.extend((child, depth + 1) for child in reversed(children.get(span['span_id'], [])))
+    
+    llm_rows = [row for row in rows if row['name'] == 'llm']
+    return {
+        'trace_id': trace_id,
+        'duration': total,
+        'rows': rows,
+        'llm_calls': len(llm_rows),
+        'llm_time': sum(row['duration'] for row in llm_rows),
+        'slowest': sorted((row for row in rows if row['name'] in ('scene', 'llm')),
+                          key=lambda row: row['duration'], reverse=True)[:10]
+    }
+
+@app.get("/api/book/{book_id}/trace")
+async def api_trace(book_id: str, trace: Optional[str] = None):
+    """Интервалы запуска генерации книги (JSON)"""
+    spans = await asyncio.to_thread(read_spans, TRACE_FILE, book_id, trace)
+    waterfall = build_waterfall(spans, trace)
+    if waterfall is None:
+        return JSONResponse({"error": "Трасса не найдена"}, status_code=404)
+    return waterfall
+
+@app.get("/book/{book_id}/trace", response_class=HTMLResponse)
+async def trace_page(request: Request, book_id: str, trace: Optional[str] = None):
+    """Временная диаграмма запуска генерации: этапы, сцены, правки и запросы к LLM"""
+    spans = await asyncio.to_thread(read_spans, TRACE_FILE, book_id)
+    runs = sorted(
+        (span for span in spans if not span['parent_id']),
+        key=lambda span: span['start'], reverse=True
+    )
+    return templates.TemplateResponse(
+        "trace.html",
+        {
+            "request": request,
+            "book_id": book_id,
+            "runs": runs,
+            "waterfall": build_waterfall(spans, trace)
+        }
+    )
+
+@app.get("/events")
+async def events(request: Request, book_id: Optional[str] = None):
+    """
+    SSE-поток событий пайплайна
+    
+    Медленные клиенты получают только последние события:
+    старые отбрасываются очередью подписки
+    """
+    subscription = event_bus.subscribe(book_id=book_id)
+    
+    async def stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscription.get(), timeout=SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if subscription.dropped:
+                    event = {**event, "dropped": subscription.dropped}
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+        finally:
+            subscription.close()
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def search_result_url(result: Dict) -> str:
+    """Ссылка на страницу найденного артефакта"""
+    if result['kind'] == 'scene':
+        chapter, scene = SearchIndex.describe_scene(result['key'])
+        return f"/book/{result['book_id']}/scene/{chapter}/{scene}"
+    return f"/book/{result['book_id']}/prompt/{result['key']}"
+
+@app.get("/api/search")
+async def api_search(q: str, book_id: Optional[str] = None, limit: int = 50):
+    """Полнотекстовый поиск (JSON)"""
+    results = await asyncio.to_thread(search_index.search, q, book_id, limit)
+    for result in results:
+        result['url'] = search_result_url(result)
+    return {"query": q, "results": results}
+
+@app.get("/search", response_class=HTMLResponse)
+async def search_page(request: Request, q: str = "", book_id: Optional[str] = None):
+    """Страница полнотекстового поиска по всем книгам"""
+    results = []
+    if q.strip():
+        results = await asyncio.to_thread(search_index.search, q, book_id)
+        for result in results:
+            result['url'] = search_result_url(result)
+    
+    return templates.TemplateResponse(
+        "search.html",
+        {
+            "request": request,
+            "query": q,
+            "book_id": book_id,
+            "results": results
+        }
+    )
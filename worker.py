@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import signal
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Пауза между опросами пустой очереди (секунды)
+POLL_INTERVAL = 2.0
+
+
+async def run_worker(queue_path: str, idle_exit: float = 0, poll_interval: float = POLL_INTERVAL) -> int:
+    """
+    Воркер очереди задач: выполняет сцены любых книг, пока его не остановят
+
+    Воркеры на одной или нескольких машинах делят с процессом генерации
+    директорию данных (хранилище, манифесты книг) и файл очереди. Каждая
+    задача выполняется в аренде: если воркер пропал, сцену продолжит
+    другой исполнитель с последней сохраненной итерации.
+
+    Args:
+        queue_path: Файл очереди задач
+        idle_exit: Завершиться после стольких секунд без задач (0 — работать постоянно)
+        poll_interval: Пауза между опросами пустой очереди
+
+    Returns:
+        int: Код завершения процесса
+    """
+    from gorky_agent import create_agent
+    from stages.scene_generation import SceneGenerationStage, SCENE_TASK
+    from utils.run_control import BudgetExceeded
+    from utils.task_queue import LEASE_SECONDS, run_leased, worker_id
+
+    agent, storage, project, _, _ = create_agent()
+    await storage.setup()
+    await project.setup()
+    agent.plugin_manager.register_plugin("storage", storage)
+    agent.plugin_manager.register_plugin("project", project)
+    await agent.start()
+
+    stage = next(stage for stage in agent.stages if isinstance(stage, SceneGenerationStage))
+    queue = agent.task_queue
+    owner = worker_id()
+
+    # SIGTERM останавливает воркер так же, как Ctrl+C: текущая задача возвращается в очередь
+    current = asyncio.current_task()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, current.cancel)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+    print(f"🛠 Воркер {owner} разбирает очередь {queue_path}")
+    completed = failed = 0
+    idle_since: Optional[float] = None
+    try:
+        while True:
+            task = await asyncio.to_thread(queue.claim, owner, LEASE_SECONDS)
+            if task is None:
+                idle_since = idle_since or time.monotonic()
+                if idle_exit and time.monotonic() - idle_since >= idle_exit:
+                    print(f"💤 Задач нет {idle_exit:g} с, воркер завершает работу")
+                    break
+                await asyncio.sleep(poll_interval)
+                continue
+            idle_since = None
+
+            if task.kind != SCENE_TASK:
+                await asyncio.to_thread(queue.fail, task, owner, f"Неизвестный тип задачи: {task.kind}", False)
+                continue
+            book = await project.read(int(task.book_id))
+            if book is None:
+                await asyncio.to_thread(queue.fail, task, owner, f"Книга {task.book_id} не найдена", False)
+                continue
+
+            # Каждая задача выполняется от имени своей книги
+            book_agent = agent.for_project(book)
+            print(f"📥 Задача {task.key} (попытка {task.attempts}/{task.max_attempts})")
+            try:
+                if await run_leased(queue, task, owner,
+                                    lambda: stage.run_scene_task(book_agent, book_agent.llm, task.payload)):
+                    completed += 1
+                else:
+                    failed += 1
+            except BudgetExceeded as e:
+                # Задача отмечена проваленной; продолжение — после увеличения бюджета книги
+                print(f"💰 {task.key}: {e}")
+                failed += 1
+    except asyncio.CancelledError:
+        print("⏹ Воркер остановлен")
+    finally:
+        print(f"🛠 Воркер {owner}: выполнено задач {completed}, с ошибкой {failed}")
+        queue.close()
+        await agent.cleanup()
+    return 0